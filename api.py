@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# api.py
+"""
+Encoding for the JSON API (/api/v1/...; see the API parts of
+appcurator.py).
+
+A result is encoded once, into a Body: its JSON text, the text
+gzipped (if it is long enough to be worth it) and an ETag. Bodies are
+what the API caches, so a cached response is sent as it is, without
+copying, pruning or serializing anything again:
+
+    body = make_body(200, prune(result, fields=["name", "icon"]))
+    body.text      # '{"app_summaries":[{"name":"Kick Perfect",...}]}'
+    body.gzipped   # the same, gzipped, or None if it is short
+
+project() is the only pass over a row straight from a query: it drops
+the None values (as delete_nulls_dict() does for the pages) and keeps
+only the fields asked for, copying as it goes, so the row it was given
+is left alone. prune() does the same for nested values.
+
+Bodies are joined as text, so a batch or a list of cached app summaries
+is never decoded:
+
+    join_list([a.text, b.text])           # '[...,...]'
+    batch_text([body_a, body_b])          # '[{"status":200,"body":...},...]'
+"""
+import collections
+import datetime
+import decimal
+import hashlib
+import json
+import zlib
+
+
+GZIP_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+
+
+class Body(collections.namedtuple("Body", "status text gzipped etag")):
+    """An encoded API response: status, JSON text, gzipped text or None,
+    and ETag."""
+    __slots__ = ()
+
+
+def parse_fields(text):
+    """Return the frozenset of names in a 'fields=a,b,c' value, or None
+    (all fields) if there are none."""
+    if not text:
+        return None
+    fields = frozenset(f.strip() for f in text.split(",") if f.strip())
+    return fields or None
+
+
+def parse_ids(text, limit):
+    """Return the distinct integer ids in an 'ids=1,2,3' value, in order.
+
+    Raise ValueError if any is not an integer or there are more than
+    limit of them.
+    """
+    ids = []
+    for part in text.split(","):
+        if part.strip():
+            i = int(part)
+            if i not in ids:
+                ids.append(i)
+    if len(ids) > limit:
+        raise ValueError("At most %d ids at a time." % limit)
+    return ids
+
+
+def project(row, fields=None):
+    """Return a copy of the flat dictionary row without None values and,
+    if fields is given, with only those keys."""
+    return dict((k, v) for k, v in row.iteritems()
+                if v is not None and (fields is None or k in fields))
+
+
+def prune(value, fields=None):
+    """Return a copy of value without None values.
+
+    If fields is given, only those keys of value itself (or, for a
+    list, of its items) are kept; nested values keep all theirs.
+    Records (see records.py) become dictionaries.
+    """
+    if hasattr(value, "asdict"):
+        value = value.asdict()
+    if isinstance(value, dict):
+        return dict((k, prune(v)) for k, v in value.iteritems()
+                    if v is not None and (fields is None or k in fields))
+    elif isinstance(value, (list, tuple)):
+        return [prune(v, fields) for v in value]
+    return value
+
+
+def _default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    elif isinstance(value, decimal.Decimal):
+        return float(value)
+    elif isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+
+def dumps(value):
+    """Return value as compact JSON text (dates as ISO 8601 strings)."""
+    return json.dumps(value, separators=(",", ":"), default=_default)
+
+
+def gzip_text(text, level=GZIP_LEVEL):
+    """Return text gzipped, as for Content-Encoding: gzip."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(text) + compressor.flush()
+
+
+def make_body(status, value=None, text=None, min_bytes=GZIP_MIN_BYTES,
+              level=GZIP_LEVEL):
+    """Return the Body for value, already pruned (or for its JSON text)."""
+    if text is None:
+        text = dumps(value)
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    gzipped = gzip_text(text, level) if len(text) >= min_bytes else None
+    return Body(status, text, gzipped, hashlib.md5(text).hexdigest())
+
+
+def join_list(texts):
+    """Return the JSON list of the JSON texts."""
+    return "[" + ",".join(texts) + "]"
+
+
+def batch_text(bodies):
+    """Return the JSON text of a batch response: a list with, for each
+    request, {status:, body:}."""
+    return join_list('{"status":%d,"body":%s}' % (b.status, b.text)
+                     for b in bodies)
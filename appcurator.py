@@ -19,13 +19,48 @@ The pages we want to make are:
     /reviews/
     /reviews/<id>
 """
+import bisect
+import datetime
+import hashlib
+import itertools
+import json
+import logging
+import mimetypes
 import os
 import pg8000  # Postgres database (we are using 9.3)
-
-from flask import abort, flash, Flask, g, jsonify
-from flask import redirect, render_template, request, session, url_for
+import re
+import socket
+import time
+
+import api
+import assets
+import avatars
+import cache
+import dbpool
+import profiler
+import records
+import requestlog
+import sessions
+import snapshot
+import statements
+import summaries
+
+from flask import abort, flash, Flask, g, has_app_context, jsonify
+from flask import redirect, render_template, request, send_from_directory
+from flask import session, url_for
+from flask import make_response, Markup, Response, stream_with_context
 from flask.views import MethodView
-from jinja2 import Environment, Template
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.exceptions import HTTPException
+from werkzeug.urls import url_decode
+
+try:
+    # Only present (and only used) in the cooperative serving mode;
+    # see gunicorn_async.py.
+    import gevent
+    import gevent.socket
+except ImportError:
+    gevent = None
 
 ## Local configuration settings -- database connection, passwords
 try:
@@ -44,6 +79,33 @@ except ImportError:
                     ssl=True
                     )
 
+        POOL_MIN_CONNECTIONS = int(os.environ.get('POOL_MIN_CONNECTIONS', 1))
+        POOL_MAX_CONNECTIONS = int(os.environ.get('POOL_MAX_CONNECTIONS', 10))
+        SUMMARY_MAX_STALENESS = int(os.environ.get('SUMMARY_MAX_STALENESS', 30))
+        SUMMARY_REFRESH_INTERVAL = int(os.environ.get('SUMMARY_REFRESH_INTERVAL', 15))
+        CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 1000))
+        PARALLEL_QUERIES = os.environ.get('PARALLEL_QUERIES', '1') == '1'
+        REVIEWS_PAGE_SIZE = int(os.environ.get('REVIEWS_PAGE_SIZE', 20))
+        APPS_PAGE_SIZE = int(os.environ.get('APPS_PAGE_SIZE', 50))
+        CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 16 * 2**20))
+        PUBLIC_MAX_AGE = int(os.environ.get('PUBLIC_MAX_AGE', 30))
+        AVATAR_MAX_BYTES = int(os.environ.get('AVATAR_MAX_BYTES', 4 * 2**20))
+        AVATAR_WORKERS = int(os.environ.get('AVATAR_WORKERS', 2))
+        AVATAR_UPLOAD_DIR = os.environ.get('AVATAR_UPLOAD_DIR')
+        LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+        LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 1.0))
+        LOG_SLOW_MS = int(os.environ.get('LOG_SLOW_MS', 500))
+        EXPLAIN_MS = int(os.environ.get('EXPLAIN_MS', 500))
+        PROFILE_DEBUG = os.environ.get('PROFILE_DEBUG', '0') == '1'
+        FRAGMENT_CACHE_MAX_BYTES = int(os.environ.get('FRAGMENT_CACHE_MAX_BYTES', 8 * 2**20))
+        SECRET_KEY = os.environ.get('SECRET_KEY')
+        SESSION_LIFETIME = int(os.environ.get('SESSION_LIFETIME', 30 * 86400))
+        API_MAX_BATCH = int(os.environ.get('API_MAX_BATCH', 20))
+        API_MAX_IDS = int(os.environ.get('API_MAX_IDS', 100))
+        API_GZIP_MIN_BYTES = int(os.environ.get('API_GZIP_MIN_BYTES', 1024))
+        SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH')
+        SNAPSHOT_EVERY = int(os.environ.get('SNAPSHOT_EVERY', 300))
+
         @staticmethod
         def reset_db():
             with closing(connect_db()) as db:
@@ -62,26 +124,199 @@ app.config["STATIC_DIR"] = os.path.join(
             'static')
 app.config["AVATAR_DIR"] = "images/avatars/"
 app.config["ICON_DIR"] = "images/icons/"
+app.config["AVATAR_MAX_BYTES"] = getattr(conf, 'AVATAR_MAX_BYTES', 4 * 2**20)
+app.config["AVATAR_SIZES"] = getattr(conf, 'AVATAR_SIZES', (48, 128, 256))
+# Refuse larger requests before reading them (413 Request Entity Too Large).
+app.config["MAX_CONTENT_LENGTH"] = app.config["AVATAR_MAX_BYTES"] + 2**16
+
+# Compiled templates are kept on disk, so a new worker or dyno loads
+# them instead of compiling them again (see compile_templates()). Flask
+# already makes the session available to the templates.
+app.config["TEMPLATE_CACHE_DIR"] = getattr(conf, 'TEMPLATE_CACHE_DIR',
+        os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                     '.jinja_cache'))
+try:
+    os.makedirs(app.config["TEMPLATE_CACHE_DIR"])
+except OSError:
+    pass  # already there
+app.jinja_options = dict(Flask.jinja_options,
+        bytecode_cache=FileSystemBytecodeCache(app.config["TEMPLATE_CACHE_DIR"]))
+
+
+## -------------------------------------------------- Logging parts ----- ##
+# Everything is logged through a queue and written by a background
+# thread (see requestlog.py); nothing on the request path touches stdout.
+log = logging.getLogger("appcurator")
+log_listener = requestlog.setup("appcurator",
+        level=getattr(conf, 'LOG_LEVEL', 'INFO'),
+        queue_size=getattr(conf, 'LOG_QUEUE_SIZE', 10000))
+request_logger = requestlog.RequestLogger(log,
+        sample_rate=getattr(conf, 'LOG_SAMPLE_RATE', 1.0),
+        slow_ms=getattr(conf, 'LOG_SLOW_MS', 500))
+
+
+# Every query is also timed per fingerprint (see profiler.py), and
+# read-only queries slower than EXPLAIN_MS get their plan captured, now
+# and then, by a background thread.
+# With PROFILE_DEBUG set, /debug/queries/ shows the totals, and a
+# request sent with an 'X-Query-Profile' header gets its own query
+# timeline back in that response header.
+query_profiler = profiler.QueryProfiler(
+        explain_ms=getattr(conf, 'EXPLAIN_MS', 500))
+PROFILE_DEBUG = getattr(conf, 'PROFILE_DEBUG', False)
+
 
-env = Environment()
-env.globals["session"] = session  # Makes session available for the template.
+@app.before_first_request
+def start_log_listener():
+    log_listener.start()
+
+
+@app.before_request
+def start_request_stats():
+    g._request_stats = requestlog.RequestStats()
+    g._query_profile = profiler.RequestProfile()
+
+
+@app.after_request
+def log_request(response):
+    """Log the request (if sampled) with its timing and query counts.
+
+    A streamed response is logged when its headers are ready, so the
+    time does not include rendering the body.
+    """
+    stats = getattr(g, "_request_stats", None)
+    if stats is not None:
+        g._request_stats = None
+        request_logger.finish(request.method, request.endpoint,
+                              response.status_code, stats)
+    query_profile = getattr(g, "_query_profile", None)
+    if (PROFILE_DEBUG and query_profile is not None
+            and "X-Query-Profile" in request.headers):
+        response.headers["X-Query-Profile"] = json.dumps(
+                query_profile.asdict(), separators=(",", ":"))
+    return response
+
+
+@app.teardown_request
+def log_failed_request(exception):
+    """Log requests that ended in an exception (after_request is skipped)."""
+    stats = getattr(g, "_request_stats", None)
+    if stats is not None and exception is not None:
+        g._request_stats = None
+        request_logger.finish(request.method, request.endpoint, 500, stats)
+
+
+def note_query(query, seconds, rows=0):
+    """Count a query in the profiler and the current request's statistics.
+
+    Return the query's fingerprint.
+    """
+    fp = profiler.fingerprint(query)
+    query_profiler.record(fp, 1000 * seconds, rows)
+    if has_app_context():
+        stats = getattr(g, "_request_stats", None)
+        if stats is not None:
+            stats.query(seconds, rows)
+        query_profile = getattr(g, "_query_profile", None)
+        if query_profile is not None:
+            query_profile.add(fp, 1000 * seconds, rows)
+    return fp
 
 
 ## ------------------------------------------------- Database parts ----- ##
+# One pool per process: connections are opened lazily and reused
+# across requests, rather than reconnecting (with SSL) every time.
+pool = dbpool.ConnectionPool(
+        conf.connect_db,
+        minconn=getattr(conf, 'POOL_MIN_CONNECTIONS', 1),
+        maxconn=getattr(conf, 'POOL_MAX_CONNECTIONS', 10),
+        timeout=getattr(conf, 'POOL_TIMEOUT', 30),
+        max_idle=getattr(conf, 'POOL_MAX_IDLE', 300),
+        ping_after=getattr(conf, 'POOL_PING_AFTER', 10))
+
+
+# Hot queries are declared once as named statements, with fixed text
+# that the driver prepares once per pooled connection (see statements.py
+# and the declarations above get_apps()).
+statement_registry = statements.StatementRegistry()
+
+
 def get_db():
-    """Set the flask 'g' value for _database, and return it."""
+    """Set the flask 'g' value for _database, and return it.
+
+    The connection is checked out of the process-wide pool.
+    """
     db = getattr(g, "_database", None)
     if db is None:
-        db = g._database = conf.connect_db()
+        start = time.time()
+        db = g._database = pool.getconn()
+        query_profile = getattr(g, "_query_profile", None)
+        if query_profile is not None:
+            query_profile.pool_wait += time.time() - start
     return db
 
 
+# The app_summaries table is precomputed; this keeps it from
+# falling more than SUMMARY_MAX_STALENESS seconds behind.
+summary_refresher = summaries.SummaryRefresher(
+        pool,
+        max_staleness=getattr(conf, 'SUMMARY_MAX_STALENESS', 30),
+        interval=getattr(conf, 'SUMMARY_REFRESH_INTERVAL', 15),
+        on_change=lambda: invalidate_apps())
+
+# With SNAPSHOT_PATH set, the /apps/ pages for anonymous users are read
+# from a memory-mapped copy of the catalog that snapshot.py rewrites
+# every SNAPSHOT_EVERY seconds, rather than from the database; see
+# snapshot_for(). Logged-in users, who may just have written a review,
+# always get the live pages.
+SNAPSHOT_PATH = getattr(conf, 'SNAPSHOT_PATH', None)
+SNAPSHOT_EVERY = getattr(conf, 'SNAPSHOT_EVERY', 300)
+catalog_snapshot = (snapshot.SnapshotReader(
+        SNAPSHOT_PATH,
+        check_every=getattr(conf, 'SNAPSHOT_CHECK_EVERY', 5),
+        on_change=lambda: invalidate_apps())
+    if SNAPSHOT_PATH else None)
+
+
+@app.before_first_request
+def start_summary_refresher():
+    """Start refreshing in the background (once per worker process)."""
+    summary_refresher.start()
+
+
+@app.before_first_request
+def start_query_explainer():
+    query_profiler.start(pool)
+
+
+# Uploaded avatars are resized by background threads, not in the
+# request (see avatars.py and post_profile()).
+avatar_processor = avatars.AvatarProcessor(
+        os.path.join(app.config['STATIC_DIR'], app.config['AVATAR_DIR']),
+        pool,
+        sizes=app.config['AVATAR_SIZES'],
+        upload_dir=getattr(conf, 'AVATAR_UPLOAD_DIR', None),
+        workers=getattr(conf, 'AVATAR_WORKERS', 2),
+        on_done=lambda user_id, nickname, avatar: invalidate_avatar(nickname))
+
+app.jinja_env.filters["thumbnail"] = avatar_processor.thumbnail
+
+
+@app.before_first_request
+def start_avatar_processor():
+    avatar_processor.start()
+
+
 @app.teardown_appcontext
 def close_connection(exception):
-    """Set the flask 'g' value for _database, and return it."""
+    """Return the flask 'g' value for _database to the pool.
+
+    Any uncommitted work is rolled back by the pool. A connection that
+    saw a driver-level error is discarded rather than reused.
+    """
     db = getattr(g, '_database', None)
     if db is not None:
-        db.close()
+        pool.putconn(db, discard=isinstance(exception, pg8000.InterfaceError))
     g._database = None
 
 
@@ -89,17 +324,27 @@ def db_query(query, args=None, commit=False):
     """Perform a query returning the database cursor if success else None.
 
     Use db_select for SELECT queries.
+    The query may be the text of a query or a registered Statement.
     Wrap the query with a try/except, catch the error, and return
     False if the query fails.
     """
     db = get_db()
     cur = db.cursor()
+    start = time.time()
     try:
-        cur.execute(query, args)
+        if isinstance(query, statements.Statement):
+            query.execute(cur, db, args)
+        else:
+            cur.execute(query, args)
         if commit:
             db.commit()
     except pg8000.ProgrammingError as e:
+        note_query(query, time.time() - start)
         return None
+    seconds = time.time() - start
+    fp = note_query(query, seconds, max(cur.rowcount, 0))
+    if query_profiler.wants_explain(fp, 1000 * seconds):
+        query_profiler.explain_later(query, args, fp, 1000 * seconds)
     return cur
     
 
@@ -111,12 +356,17 @@ def db_select(query, args=None, columns=None):
 
     If there is an error with the query, return None.
 
+    The query may also be a registered Statement, in which case its
+    declared columns are the default.
+
     Keyword arguments
     args -- passed to pg8000.cursor.execute() for a secure
             parameterized query.
             We use the default format: SELECT * FROM TABLE WHERE col1 = '%s'
     """
-    cur = db_query(query, args=args) 
+    if columns is None:
+        columns = getattr(query, "columns", None)
+    cur = db_query(query, args=args)
     if cur is None:
         return None
     try:
@@ -128,14 +378,18 @@ def db_select(query, args=None, columns=None):
     cur.close()
     if len(results) == 0:
         return None
-    elif len(results[0]) > len(columns):
-        columns = list(columns) + ["col%d" % i for i in range(len(columns),len(results))]
-    elif len(results[0]) < len(columns):
-        columns = columns[0:len(results[0])]
-
+    columns = fit_columns(columns, len(results[0]))
     return [dict(zip(columns, result)) for result in results]
 
 
+def fit_columns(columns, n):
+    """Pad (with 'colK' names) or truncate the column names to length n."""
+    columns = list(columns or [])
+    if n > len(columns):
+        columns += ["col%d" % i for i in range(len(columns), n)]
+    return columns[:n]
+
+
 def db_select_one(query, args=None, columns=None):
     """Return the one-row result of a select query as a dictionary.
 
@@ -148,6 +402,313 @@ def db_select_one(query, args=None, columns=None):
     return rows[0]
 
 
+_cursor_names = itertools.count()
+
+
+def db_stream(query, args=None, columns=None, batch_size=500, transform=None):
+    """Yield the rows of a select query lazily, as records.
+
+    Rows are fetched batch_size at a time through a server-side cursor,
+    so neither this process nor the driver holds the whole result.
+    Each row is a records.Record (a named tuple in which NULL columns
+    read as missing, like the output of delete_nulls_arr) rather than a
+    dictionary. If there is an error with the query, nothing is yielded.
+
+    The generator uses the request's connection: consume it before the
+    request ends (with stream_with_context if rendering lazily).
+
+    Keyword arguments
+    args, columns -- as for db_select; query may be a Statement.
+    transform -- optional function applied to each row (a tuple) before
+            it is wrapped, returning a sequence of the same length.
+    """
+    if columns is None:
+        columns = getattr(query, "columns", None)
+    text = getattr(query, "text", query).strip().rstrip(';')
+    name = "stream_%d" % next(_cursor_names)
+    db = get_db()
+    cur = db.cursor()
+    try:
+        # DECLARE needs a transaction, which pg8000 always has open.
+        cur.execute("DECLARE %s NO SCROLL CURSOR FOR %s" % (name, text), args)
+        make_record = None
+        while True:
+            start = time.time()
+            cur.execute("FETCH FORWARD %d FROM %s" % (batch_size, name))
+            rows = cur.fetchall()
+            note_query(query, time.time() - start, len(rows))
+            if len(rows) == 0:
+                break
+            if make_record is None:
+                make_record = records.record_type(
+                        fit_columns(columns, len(rows[0])))
+            for row in rows:
+                yield make_record(transform(row) if transform else row)
+            if len(rows) < batch_size:
+                break
+        cur.execute("CLOSE %s" % name)
+    except pg8000.ProgrammingError as e:
+        db.rollback()
+    finally:
+        cur.close()
+
+
+PARALLEL_QUERIES = getattr(conf, 'PARALLEL_QUERIES', True)
+
+
+def is_cooperative():
+    """Return True when running under gevent with sockets patched.
+
+    pg8000 is pure Python, so once gevent has patched the socket
+    module (as the gevent gunicorn workers do) every query yields to
+    other requests while it waits on Postgres.
+    """
+    return gevent is not None and socket.socket is gevent.socket.socket
+
+
+def db_select_parallel(queries):
+    """Run several select queries concurrently, one greenlet each.
+
+    Takes the same as db_select_many, and returns the same or else None
+    if the pool cannot supply the connections without waiting. The
+    first query runs on the request's own connection, and each other on
+    one borrowed from the pool, all at once or not at all: a request
+    that holds a connection never waits for more, so concurrent
+    requests cannot hold the pool between them while each waits for
+    the rest. Needs is_cooperative(). Values arrive as the driver's
+    types, as from db_select.
+    """
+    borrowed = []
+    try:
+        for _ in queries[1:]:
+            borrowed.append(pool.getconn(timeout=0))
+    except (dbpool.PoolError, pg8000.Error):
+        for db in borrowed:
+            pool.putconn(db)
+        return None
+    connections = [get_db()] + borrowed
+    broken = set()
+    timings = []  # flask's g is not visible in the greenlets
+
+    def run(db, query, args, columns):
+        start = time.time()
+        try:
+            cur = db.cursor()
+            if isinstance(query, statements.Statement):
+                query.execute(cur, db, args)
+            else:
+                cur.execute(query, args)
+            rows = cur.fetchall()
+            cur.close()
+            timings.append((query, time.time() - start, len(rows)))
+        except pg8000.ProgrammingError as e:
+            timings.append((query, time.time() - start, 0))
+            db.rollback()
+            return None
+        except pg8000.InterfaceError as e:
+            broken.add(db)
+            raise
+        if len(rows) == 0:
+            return None
+        if columns is None:
+            columns = getattr(query, "columns", None)
+        names = fit_columns(columns, len(rows[0]))
+        return [dict(zip(names, row)) for row in rows]
+
+    jobs = [gevent.spawn(run, db, *q) for db, q in zip(connections, queries)]
+    gevent.joinall(jobs)
+    for db in borrowed:
+        pool.putconn(db, discard=db in broken)
+    if connections[0] in broken:
+        pool.putconn(connections[0], discard=True)
+        g._database = None
+    for query, seconds, rows in timings:
+        note_query(query, seconds, rows)
+    return [job.value for job in jobs]  # None if the job raised
+
+
+def db_select_many(queries):
+    """Run several select queries in a single round trip.
+
+    In the cooperative serving mode (with PARALLEL_QUERIES set), the
+    queries instead run concurrently on separate connections when the
+    pool has them free; see db_select_parallel.
+
+    Return a list with, for each query, what db_select would have
+    returned for it: an array of dictionaries, or None if there were no
+    rows. If the combined query fails, every entry is None.
+
+    Each query is wrapped as '(SELECT json_agg(q) FROM (<query>) AS q)'
+    so the results come back as one row of JSON arrays. Values therefore
+    arrive as JSON types, while db_select_parallel and db_select return
+    the driver's: select only text, integer and float8 columns (format
+    dates with to_char(), cast numeric to float8) so all three agree.
+
+    If every query is a registered Statement, the combined query is
+    itself registered, so it is profiled (and prepared) as one too.
+
+    Keyword arguments
+    queries -- a list of (query, args, columns) tuples, with the same
+               meaning as the arguments of db_select(). The query must
+               be a single SELECT; a trailing semicolon is allowed.
+    """
+    if PARALLEL_QUERIES and len(queries) > 1 and is_cooperative():
+        results = db_select_parallel(queries)
+        if results is not None:
+            return results
+    parts = []
+    all_args = []
+    for i, (query, args, columns) in enumerate(queries):
+        text = getattr(query, "text", query)
+        parts.append("(SELECT json_agg(q{i})::text FROM ({query}) AS q{i})"
+                     .format(i=i, query=text.strip().rstrip(';')))
+        all_args.extend(args or [])
+    query = "SELECT " + ",\n".join(parts)
+    if all(isinstance(q[0], statements.Statement) for q in queries):
+        name = "batch_" + hashlib.md5(
+                "|".join(q[0].name for q in queries)).hexdigest()[:16]
+        query = statement_registry.combined(name, query)
+    cur = db_query(query, args=all_args)
+    if cur is None:
+        return [None] * len(queries)
+    try:
+        row = cur.fetchone()
+    except pg8000.ProgrammingError as e:
+        get_db().rollback()
+        cur.close()
+        return [None] * len(queries)
+    cur.close()
+
+    results = []
+    for (query, args, columns), text in zip(queries, row):
+        if text is None:
+            results.append(None)
+            continue
+        # Keep each row's values in column order (and keep duplicate
+        # names) by decoding JSON objects into lists of pairs.
+        rows = json.loads(text, object_pairs_hook=list)
+        if columns is None:
+            columns = getattr(query, "columns", None)
+        names = fit_columns(columns, len(rows[0]))
+        results.append([dict(zip(names, (v for k, v in pairs)))
+                        for pairs in rows])
+    return results
+
+
+## ---------------------------------------------------- Cache parts ----- ##
+# Results of get_rest() are cached in-process, keyed by the path plus
+# the normalized query. Only paths listed in CACHE_TTL are cached, for
+# that many seconds. Writes through post_rest() invalidate the entries
+# they affect; other processes see the change when their entries expire.
+response_cache = cache.LRUCache(
+        max_entries=getattr(conf, 'CACHE_MAX_ENTRIES', 1000),
+        max_bytes=getattr(conf, 'CACHE_MAX_BYTES', 16 * 2**20))
+
+CACHE_TTL = getattr(conf, 'CACHE_TTL',
+                    {"apps": 60, "login": 300, "profile": 300,
+                     "recommendations": 300, "search": 60})
+
+
+def cache_key(path, query):
+    """Return a hashable key for path + query, or None if uncacheable."""
+    def normalize(value):
+        if isinstance(value, (list, tuple)):
+            return tuple(normalize(v) for v in value)
+        elif isinstance(value, (set, frozenset)):
+            return tuple(sorted(normalize(v) for v in value))
+        return value
+
+    key = (path, tuple(sorted((k, normalize(v)) for k, v in query.items())))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def cache_tags(path, query):
+    """Return the invalidation tags for a cached get_rest() result."""
+    if path == "profile":
+        return ["profile:%s" % query.get("nickname", "")]
+    elif path == "login":
+        return ["user:%s" % (query.get("nickname") or "").lower()]
+    return [path]
+
+
+def invalidate_apps():
+    """Drop cached app pages after reviews or recommendations change."""
+    response_cache.invalidate("apps")
+    response_cache.invalidate("search")
+
+
+def invalidate_avatar(nickname):
+    """Drop what shows a user's avatar, once a new one is installed."""
+    response_cache.invalidate("profile:%s" % nickname)
+    response_cache.invalidate("user:%s" % nickname)
+    invalidate_apps()
+    # Rendered reviews are keyed by the avatar's name, which may not
+    # have changed.
+    fragment_cache.clear()
+
+
+def invalidate_post(path, query):
+    """Drop the cached results that a post_rest() call makes stale."""
+    if path == "profile":
+        response_cache.invalidate("profile:%s" % query.get("nickname", ""))
+        # Avatars also appear next to reviews on the app pages.
+        invalidate_apps()
+    elif path == "login":
+        response_cache.invalidate(
+                "user:%s" % (query.get("nickname") or "").lower())
+    elif path == "review":
+        # The app pages and the reviewer's profile list the reviews.
+        response_cache.invalidate("profile:%s" % query.get("nickname", ""))
+        invalidate_apps()
+
+
+# Rendered macro output (an app card, a review) is cached separately,
+# keyed by what was rendered and its version, so each app card is
+# rendered once and reused in every tag section and request it appears
+# in. A changed summary row has a new version and so a new key; the old
+# entry just ages out.
+fragment_cache = cache.LRUCache(
+        max_entries=getattr(conf, 'FRAGMENT_CACHE_MAX_ENTRIES', 5000),
+        max_bytes=getattr(conf, 'FRAGMENT_CACHE_MAX_BYTES', 8 * 2**20))
+
+FRAGMENT_TTL = getattr(conf, 'FRAGMENT_TTL', 3600)
+
+
+def fragment_version(item):
+    """Return a digest of everything a macro could read from item."""
+    if hasattr(item, 'asdict'):
+        item = item.asdict()
+    return hashlib.md5(repr(sorted(item.items()))).hexdigest()
+
+
+def cached_fragment(macro, item, key, version=None):
+    """Call macro(item), or return its cached output.
+
+    Used from the templates as
+        {{ cached_fragment(macros.app_summary, app, key=app.app_id,
+                           version=app.version) }}
+    The key identifies the item; the version must change whenever the
+    item does. Without a version, a digest of the item is used.
+    """
+    if version is None:
+        version = fragment_version(item)
+    if isinstance(key, list):
+        key = tuple(key)
+    cache_key = (macro.name, key, version)
+    html = fragment_cache.get(cache_key)
+    if html is None:
+        html = macro(item)
+        fragment_cache.set(cache_key, unicode(html), ttl=FRAGMENT_TTL)
+        return html
+    return Markup(html)
+
+app.jinja_env.globals["cached_fragment"] = cached_fragment
+
+
 ## ---------------------------------------------------- Login parts ----- ##
 # This section will handle communication with Facebook to
 # confirm the identity of the individual logging in, once
@@ -161,10 +722,38 @@ def confirm_user_identity(userid, token=None):
     """
     return True
 
-def is_logged_in(userid):
+# Sessions are kept server-side in session_lookup (see sessions.py), and
+# the hot ones cached here, so a request does not read the table, nor
+# user_details, just to know who is logged in. The cookie is signed
+# with app.secret_key, which all workers must share (SECRET_KEY).
+session_store = sessions.SessionStore(
+        pool,
+        cache.LRUCache(
+            max_entries=getattr(conf, 'SESSION_CACHE_MAX_ENTRIES', 10000),
+            max_bytes=8 * 2**20),
+        ttl=getattr(conf, 'SESSION_CACHE_TTL', 300),
+        user_ttl=getattr(conf, 'SESSION_USER_CACHE_TTL', 30),
+        lifetime=getattr(conf, 'SESSION_LIFETIME', 30 * 86400))
+app.session_interface = sessions.ServerSessionInterface(session_store)
+
+
+@app.before_first_request
+def purge_sessions():
+    """Drop expired sessions (once per worker process)."""
+    session_store.purge()
+
+
+def is_logged_in(userid=None):
     """Confirm via the session_lookup table that this user is logged in.
+
+    The session was found in (the cache of) session_lookup, so this is
+    a check of its contents. Without userid, check for anyone.
     """
-    return True
+    user = session.get("user") or {}
+    if userid is None:
+        return "user_id" in user
+    return user.get("user_id") == userid
+
 
 ## -------------------------------------------- False RESTful parts ----- ##
 # This section will later be moved to a module devoted to serving
@@ -180,11 +769,281 @@ def delete_nulls_arr(a):
 def delete_nulls_dict(d):
     [d.pop(k) for k in d.keys() if d[k] is None]
 
-def get_apps(appid=None, tags=None, **kwargs):
+
+# The queries behind the handlers below. Those run on (nearly) every
+# request are named statements, with fixed text so that the driver
+# prepares each once per pooled connection.
+# Their columns are text, integers or float8, never date or numeric, so
+# that db_select_many() returns the same types whichever way it runs.
+# The summary columns are qualified (app_summaries AS s), since the
+# queries built on APP_SUMMARY_QUERY join it with tables that also have
+# an app_id.
+APP_SUMMARY_QUERY = """
+                SELECT s.app_id, s.app_name, s.icon, s.organization_name,
+                    s.objective, s.recommendations, s.recommenders,
+                    s.user_usability::float8, s.provider_usability::float8,
+                    s.user_effectiveness::float8,
+                    s.provider_effectiveness::float8,
+                    to_char(s.last_review_date, 'FMDD Mon YYYY'),
+                    s.categories, s.devices, s.platforms,
+                    (extract(epoch FROM s.refreshed_at) * 1000000)::bigint
+                FROM app_summaries AS s
+            """
+APP_SUMMARY_COLUMNS = ["app_id", "name", "icon", "organization",
+            "objective", "n_recc", "n_users",
+            "user_usability", "provider_usability",
+            "user_effectiveness", "provider_effectiveness",
+            "last_review_date", "categories", "devices", "platforms",
+            "version"]
+
+APP_SUMMARY_BY_ID = statement_registry.register("app_summary_by_id",
+        APP_SUMMARY_QUERY + " WHERE s.app_id = %s",
+        columns=APP_SUMMARY_COLUMNS)
+
+APP_SUMMARIES_BY_IDS = statement_registry.register("app_summaries_by_ids",
+        APP_SUMMARY_QUERY + " WHERE s.app_id = ANY(%s::integer[])",
+        columns=APP_SUMMARY_COLUMNS)
+
+# One page of reviews: (app_id, sort_date, review_id, page size).
+APP_REVIEWS = statement_registry.register("app_reviews", """
+                SELECT nickname, avatar, platform, user_role,
+                    usability, effectiveness, review, review_date,
+                    to_char(sort_date, 'YYYY-MM-DD'), review_id
+                FROM get_reviews_page(%s, %s, %s, %s)
+                """,
+        columns=[ "nickname", "avatar", "platform", "user_role",
+                    "usability", "effectiveness", "review", "review_date",
+                    "sort_date", "review_id"])
+
+REVIEWS_PAGE_SIZE = getattr(conf, 'REVIEWS_PAGE_SIZE', 20)
+APPS_PAGE_SIZE = getattr(conf, 'APPS_PAGE_SIZE', 50)
+
+
+def parse_review_cursor(cursor):
+    """Return (date, review_id) from a 'YYYY-MM-DD_<review_id>' cursor.
+
+    Return (None, None) -- the first page -- if it cannot be parsed.
+    """
+    try:
+        day, review_id = cursor.split("_")
+        return (datetime.datetime.strptime(day, "%Y-%m-%d").date(),
+                int(review_id))
+    except (AttributeError, ValueError):
+        return None, None
+
+
+TOP_TAGS = statement_registry.register("top_tags", """
+                SELECT category_name, app_id, app_counts FROM top_tags_view
+                """,
+        columns=["name", "app_id", "n_apps"])
+
+# Validators for conditional GETs of /apps/: they change whenever any
+# (or the one) stored summary is recomputed, added or deleted.
+APPS_VERSION = statement_registry.register("apps_version",
+        "SELECT max(refreshed_at), count(*) FROM app_summaries",
+        columns=["last_modified", "n_apps"])
+
+APP_VERSION = statement_registry.register("app_version",
+        "SELECT refreshed_at, 1 FROM app_summaries WHERE app_id = %s",
+        columns=["last_modified", "n_apps"])
+
+USER_BY_NICKNAME = statement_registry.register("user_by_nickname",
+        "SELECT nickname, user_id, avatar FROM user_details WHERE nickname=%s",
+        columns=["nickname", "user_id", "avatar"])
+
+_SUMMARY_LIST_INDEXES = [APP_SUMMARY_COLUMNS.index(key)
+                         for key in ('categories', 'devices', 'platforms')]
+
+
+def split_summary_lists(row):
+    """Split the pipe-joined lists in a raw (tuple) app summary row."""
+    row = list(row)
+    for i in _SUMMARY_LIST_INDEXES:
+        row[i] = row[i].split("|") if row[i] is not None else []
+    return row
+
+
+# Full-text search over app_summaries.document (see search_apps() in
+# create_functions.sql): (tsquery, candidates, limit).
+SEARCH_APPS = statement_registry.register("search_apps",
+        APP_SUMMARY_QUERY + """
+                JOIN search_apps(%s, %s, %s) AS found
+                  ON found.found_app_id = s.app_id
+                ORDER BY found.rank DESC, s.app_id
+                """,
+        columns=APP_SUMMARY_COLUMNS)
+
+SEARCH_NAMES = statement_registry.register("search_names", """
+                SELECT app_id, app_name FROM app_summaries
+                JOIN search_apps(%s, %s, %s) AS found
+                  ON found.found_app_id = app_summaries.app_id
+                ORDER BY found.rank DESC, app_id
+                """,
+        columns=["app_id", "name"])
+
+SEARCH_CANDIDATES = getattr(conf, 'SEARCH_CANDIDATES', 2000)
+SEARCH_PAGE_SIZE = getattr(conf, 'SEARCH_PAGE_SIZE', 20)
+
+
+def search_query(text):
+    """Return the tsquery text for what a user typed, or None.
+
+    Every word is matched as a prefix, so 'hear rat' finds 'heart rate'
+    while it is being typed. Anything but letters and digits is dropped,
+    which also keeps the user out of the tsquery syntax, and so are
+    single letters, which as prefixes would match nearly everything.
+    """
+    words = [w for w in re.findall(r"\w+", text.lower(), re.UNICODE)
+             if len(w) > 1]
+    if not words:
+        return None
+    return " & ".join("%s:*" % w for w in words[:8])
+
+
+# Precomputed recommendations (see recommender.py): an app's nearest
+# apps, and a user's suggestions, each best first: (id, limit).
+APP_NEIGHBORS = statement_registry.register("app_neighbors",
+        APP_SUMMARY_QUERY + """
+                JOIN app_neighbors AS n
+                  ON n.neighbor_id = s.app_id
+                WHERE n.app_id = %s AND n.rank <= %s
+                ORDER BY n.rank
+                """,
+        columns=APP_SUMMARY_COLUMNS)
+
+USER_SUGGESTIONS = statement_registry.register("user_suggestions",
+        APP_SUMMARY_QUERY + """
+                JOIN user_suggestions AS us
+                  ON us.app_id = s.app_id
+                JOIN user_details AS ud
+                  ON ud.user_id = us.user_id
+                WHERE ud.nickname = %s AND us.rank <= %s
+                ORDER BY us.rank
+                """,
+        columns=APP_SUMMARY_COLUMNS)
+
+RECOMMENDATIONS_PAGE_SIZE = getattr(conf, 'RECOMMENDATIONS_PAGE_SIZE', 20)
+
+
+PROFILE_DETAILS = statement_registry.register("profile_details", """
+                SELECT nickname, avatar, first_name, last_name,
+                       to_char(start_date, 'Month YYYY') AS start_date
+                FROM user_details
+                WHERE nickname = %s""",
+        columns=["nickname", "avatar",
+                 "first_name", "last_name", "start_date"])
+
+PROFILE_RECOMMENDED_BY = statement_registry.register("profile_recommended_by",
+                """SELECT
+                    app_name, icon,
+                    recipient_nickname AS name
+                   FROM recommendation_view
+                    WHERE recommender_nickname = %s""",
+        columns=["app", "icon", "name"])
+
+PROFILE_RECOMMENDED_TO = statement_registry.register("profile_recommended_to",
+                """SELECT
+                    app_name, icon,
+                    recommender_nickname AS name
+                   FROM recommendation_view
+                    WHERE recipient_nickname = %s""",
+        columns=["app", "icon", "name"])
+
+PROFILE_REVIEWS = statement_registry.register("profile_reviews",
+                """SELECT
+                app_name, icon,
+                to_char(ar.review_date, 'YYYY-MM-DD') AS review_date, review
+                FROM user_details AS ud
+                JOIN app_review AS ar
+                    ON ar.user_id = ud.user_id
+                JOIN app
+                    ON ar.app_id = app.app_id
+                WHERE ud.nickname = %s""",
+        columns=["app", "icon", "review_date", "review"])
+
+
+def snapshot_for(appid=None, tags=None, before=None, **kwargs):
+    """Return the catalog snapshot if it can answer get_apps(), else None.
+
+    It holds the first page of each app's reviews, and the apps and
+    tags there were when it was written; anything else is read live.
+    """
+    snap = catalog_snapshot.current() if catalog_snapshot is not None else None
+    if snap is None:
+        return None
+    if appid is not None:
+        if (before or not snap.has_app(int(appid)) or
+                snap.info.get("reviews_per_app", 0) <= REVIEWS_PAGE_SIZE):
+            return None
+    elif tags is not None:
+        if not all(snap.has_tag(t.lower()) for t in tags):
+            return None
+    return snap
+
+
+def get_apps_from_snapshot(snap, appid=None, tags=None, after=None, **kwargs):
+    """Return what get_apps() would, read from the catalog snapshot.
+
+    Call only with a snapshot that snapshot_for() returned for the
+    same arguments.
+    """
+    result = dict(error=None)
+    app_summaries = []
+    tag_summaries = None
+    if appid is not None:
+        app_summaries = [snap.app_summary(int(appid))]
+        app_summaries[0]["hasreviews"] = True
+        result["reviews"] = snap.reviews(int(appid))
+        if len(result["reviews"]) > REVIEWS_PAGE_SIZE:
+            del result["reviews"][REVIEWS_PAGE_SIZE:]
+            last = result["reviews"][-1]
+            result["next_reviews"] = "%s_%d" % (last["sort_date"],
+                                                last["review_id"])
+    elif tags is not None:
+        tags = [t.lower() for t in tags]
+        app_ids = sorted(set(itertools.chain.from_iterable(
+                snap.tag_app_ids(t) for t in tags)))
+        for app_id in app_ids[bisect.bisect_right(app_ids, int(after or 0)):]:
+            summary = snap.app_summary(app_id)
+            if summary is not None:
+                app_summaries.append(summary)
+                if len(app_summaries) == APPS_PAGE_SIZE:
+                    break
+        result["tags"] = tags
+        result["page_size"] = APPS_PAGE_SIZE
+
+    if len(app_summaries) == 0 or (appid is None and tags is None):
+        tag_summaries = {}
+        for row in snap.top_tags():
+            tag_summaries.setdefault(row['name'],
+                    { 'name': row['name'],
+                      'n_apps': row['n_apps'],
+                      'top_apps_set': set() })['top_apps_set'].add(row['app_id'])
+        tag_summaries = tag_summaries.values()
+        app_summaries = snap.app_summaries(set(itertools.chain.from_iterable(
+                entry['top_apps_set'] for entry in tag_summaries)))
+    for summary in app_summaries:
+        for key in ('categories', 'devices', 'platforms'):
+            summary[key] = summary[key].split("|") if key in summary else []
+
+    if tag_summaries is not None:
+        app_summaries = dict((row['app_id'], row) for row in app_summaries)
+        for entry in tag_summaries:
+            entry['top_apps'] = [app_summaries[appid] for appid in entry['top_apps_set']
+                                 if appid in app_summaries]
+        result["tag_summaries"] = tag_summaries
+    else:
+        result["app_summaries"] = app_summaries
+    return result
+
+
+def get_apps(appid=None, tags=None, stream=False,
+             before=None, after=None, from_snapshot=False, keep_nulls=False,
+             **kwargs):
     """
     Respond to a REST query at /apps.
 
-    If there is an appid, return all its reviews, plus the one app summary:
+    If there is an appid, return a page of its reviews, plus the one app summary:
          reviews: [{nickname:, avatar:, platform:, user_role:, usability:,
                     effectiveness:, review:, review_date:} ]
 
@@ -194,69 +1053,101 @@ def get_apps(appid=None, tags=None, **kwargs):
                          link_entries:[], n_recc:, n_users:,
                          provider_usability:, user_usability:,
                          provider_effectiveness:, user_effectiveness:,
-                         last_review_date: }]
+                         last_review_date:, version: }]
+    ('version' changes whenever the stored summary is recomputed.)
+
+    Both lists are paged by keyset rather than by offset:
+      - reviews: REVIEWS_PAGE_SIZE at a time, newest first; if there are
+        more, 'next_reviews' is the cursor to pass back as 'before'.
+      - app summaries for tags: APPS_PAGE_SIZE at a time in app_id order,
+        starting after the app_id given as 'after'. 'page_size' is
+        returned; a full page means there may be more.
+
+    With stream=True, the tag summaries are a generator of records
+    (see db_stream) rather than a list, to be rendered as they arrive.
 
     If there are no tags or appid, return summaries for all top-level tags,
     with the top three (in number of reviews) app summaries:
         tag_summaries: [{name:, n_apps:, top_apps:[app_summaries]}]
+
+    Summaries are read from the precomputed app_summaries table
+    (see summaries.py), not re-aggregated per request. With
+    from_snapshot=True they are read from the catalog snapshot instead,
+    if it has what was asked for (see snapshot_for()).
+
+    With keep_nulls=True the summaries keep their None values, for a
+    caller that makes its own pass over them anyway (the JSON API).
     """
+    if from_snapshot:
+        snap = snapshot_for(appid=appid, tags=tags, before=before)
+        if snap is not None:
+            return get_apps_from_snapshot(snap, appid=appid, tags=tags,
+                                          after=after)
     result = dict(error=None)
-    starter_query = """
-                SELECT app_id, app_name, icon, organization_name,
-                    objective, recommendations, recommenders,
-                    user_usability, provider_usability,
-                    user_effectiveness, provider_effectiveness,
-                    to_char(last_review_date, 'FMDD Mon YYYY'),
-                    categories, devices, platforms
-                FROM app_summaries
-            """
-    starter_columns = ["app_id", "name", "icon", "organization",
-            "objective", "n_recc", "n_users",
-            "user_usability", "provider_usability",
-            "user_effectiveness", "provider_effectiveness",
-            "last_review_date", "categories", "devices", "platforms"]
+    starter_query = APP_SUMMARY_QUERY
+    starter_columns = APP_SUMMARY_COLUMNS
     app_summaries = []
     tag_summaries = None
+    summary_refresher.ensure_fresh(get_db())
     if appid is not None:
-        app_summaries = db_select( starter_query +
-                " WHERE app_id = %s;",
-                args=[appid],
-                columns=starter_columns)
-        app_summaries[0]["hasreviews"] = True
-        result["reviews"] = db_select( """
-                SELECT nickname, avatar, platform, user_role,
-                    usability, effectiveness, review, review_date
-                FROM get_reviews(%s);
-                """,
-                args=[appid],
-                columns=[ "nickname", "avatar", "platform", "user_role",
-                    "usability", "effectiveness", "review", "review_date"])
+        app_summaries, result["reviews"] = db_select_many([
+                (APP_SUMMARY_BY_ID, [appid], None),
+                (APP_REVIEWS,
+                    [appid] + list(parse_review_cursor(before)) +
+                    [REVIEWS_PAGE_SIZE + 1],
+                    None)])
+        app_summaries = app_summaries or []
+        if len(app_summaries) > 0:
+            app_summaries[0]["hasreviews"] = True
+        result["reviews"] = result["reviews"] or []
+        if len(result["reviews"]) > REVIEWS_PAGE_SIZE:
+            del result["reviews"][REVIEWS_PAGE_SIZE:]
+            last = result["reviews"][-1]
+            result["next_reviews"] = "%s_%d" % (last["sort_date"],
+                                                last["review_id"])
         for review in result["reviews"]:
             pass
     elif tags is not None:
         # Show the apps for the requested tags only.
         tags = [t.lower() for t in tags]
         slots = ", ".join(["%s"] * len(tags))
-        app_summaries = db_select(
-                """WITH tag_ids AS (
-                   SELECT app_id AS tag_app_id
-                   FROM app_category_view
-                   WHERE category_name IN (%s) ) 
+        # Apps filed under the tags or any of their descendants:
+        # index lookups in tag, tag_closure and app_tag.
+        tag_query = ("""WITH tag_ids AS (
+                   SELECT DISTINCT at.app_id AS tag_app_id
+                   FROM tag
+                   JOIN tag_closure AS tc
+                     ON tc.ancestor_id = tag.category_id
+                   JOIN app_tag AS at
+                     ON at.category_id = tc.descendant_id
+                   WHERE lower(tag.category_name) IN (%s) )
                 """ % slots +
                 starter_query +
-                """ AS summ JOIN tag_ids ON
-                    summ.app_id = tag_ids.tag_app_id;
-                """,
-                args = tags,
-                columns=starter_columns)
+                """ JOIN tag_ids ON
+                    s.app_id = tag_ids.tag_app_id
+                WHERE s.app_id > %s
+                ORDER BY s.app_id
+                LIMIT %s
+                """)
+        tag_args = tags + [int(after or 0), APPS_PAGE_SIZE]
+        result["tags"] = tags
+        result["page_size"] = APPS_PAGE_SIZE
+        if stream:
+            rows = db_stream(tag_query, args=tag_args, columns=starter_columns,
+                             transform=split_summary_lists)
+            first = next(rows, None)
+            if first is not None:
+                result["app_summaries"] = itertools.chain([first], rows)
+                return result
+            app_summaries = []
+        else:
+            app_summaries = db_select(tag_query, args=tag_args,
+                                      columns=starter_columns) or []
 
     if len(app_summaries)==0 or (appid is None and tags is None):
         # Show the top few tags, with brief snapshots
         # of the apps per tag.
-        tag_rows = db_select("""
-                SELECT category_name, app_id, app_counts FROM top_tags_view;
-                """,
-                columns=["name", "app_id", "n_apps"])
+        tag_rows = db_select(TOP_TAGS) or []
         tag_summaries = {}
         app_ids = set()
         for row in tag_rows:
@@ -266,12 +1157,9 @@ def get_apps(appid=None, tags=None, **kwargs):
                       'top_apps_set': set() })['top_apps_set'].add(row['app_id'])
             app_ids.add(row['app_id']) 
         tag_summaries = [v for v in tag_summaries.values()]
-               
-        slots = ", ".join(["%s"] * len(app_ids)) 
-        app_summaries = db_select(
-                starter_query + " WHERE app_id IN (%s);" %slots,
-                args=app_ids,
-                columns=starter_columns)
+
+        app_summaries = db_select(APP_SUMMARIES_BY_IDS,
+                                  args=[sorted(app_ids)]) or []
     if app_summaries is not None:
         # The 'categories', 'devices', 'platforms' (and eventually the links
         # come back as pipe-joined strings rather than as lists.
@@ -280,7 +1168,8 @@ def get_apps(appid=None, tags=None, **kwargs):
             for summary in app_summaries:
                 for key in ('categories', 'devices', 'platforms'):
                     summary[key] = summary[key].split("|") if summary[key] is not None else []
-        delete_nulls_arr(app_summaries)
+        if not keep_nulls:
+            delete_nulls_arr(app_summaries)
 
     # Either we will present tag summaries or app summaries.
     # Put the correct variable in the result...
@@ -296,15 +1185,109 @@ def get_apps(appid=None, tags=None, **kwargs):
     return result
 
 
+def get_apps_version(appid=None, from_snapshot=False, **kwargs):
+    """Return {last_modified:, etag:} for the /apps/ page asked for.
+
+    This is much cheaper than get_apps(): an index lookup on
+    app_summaries. A new review or recommendation marks its app's
+    summary for recomputing, which bumps its refreshed_at, so the pages
+    change only when this does. (A changed avatar alone does not; the
+    Cache-Control max-age bounds how long that can go unseen.)
+
+    With from_snapshot=True, for pages get_apps() reads from the
+    catalog snapshot, the versions are those in the snapshot.
+    """
+    snap = snapshot_for(appid=appid, **kwargs) if from_snapshot else None
+    if snap is not None:
+        if appid is not None:
+            version, n_apps = snap.app_summary(int(appid)).get("version"), 1
+        else:
+            version, n_apps = snap.info.get("last_version"), len(snap)
+        row = dict(n_apps=n_apps, last_modified=None if version is None else
+                   datetime.datetime(1970, 1, 1) +
+                   datetime.timedelta(microseconds=version))
+    else:
+        summary_refresher.ensure_fresh(get_db())
+        if appid is not None:
+            row = db_select_one(APP_VERSION, args=[appid])
+        else:
+            row = db_select_one(APPS_VERSION)
+    if not row or row.get("last_modified") is None:
+        return dict(last_modified=None, etag=None)
+    last_modified = row["last_modified"]
+    if last_modified.tzinfo is not None:
+        last_modified = (last_modified.replace(tzinfo=None) -
+                         last_modified.utcoffset())
+    return dict(last_modified=last_modified,
+                etag="%s-%d" % (last_modified.strftime("%Y%m%d%H%M%S%f"),
+                                row["n_apps"]))
+
+
+def get_search(q="", typeahead=False, **kwargs):
+    """
+    Respond to a REST query at /search.
+
+    Return the apps best matching the text q (by name, organization,
+    tags, objective and review text, blended with their
+    recommendations and ratings), best first:
+        query: q,
+        app_summaries: [{... as for get_apps ...}]
+    or, for typeahead, only their names:
+        query: q,
+        suggestions: [{app_id:, name:}]
+    """
+    result = dict(error=None, query=q)
+    tsquery = search_query(q or "")
+    if tsquery is None:
+        result["suggestions" if typeahead else "app_summaries"] = []
+        return result
+    summary_refresher.ensure_fresh(get_db())
+    if typeahead:
+        result["suggestions"] = db_select(SEARCH_NAMES,
+                args=[tsquery, SEARCH_CANDIDATES, 10]) or []
+        return result
+    app_summaries = db_select(SEARCH_APPS,
+            args=[tsquery, SEARCH_CANDIDATES, SEARCH_PAGE_SIZE]) or []
+    for summary in app_summaries:
+        for key in ('categories', 'devices', 'platforms'):
+            summary[key] = summary[key].split("|") if summary[key] is not None else []
+    delete_nulls_arr(app_summaries)
+    result["app_summaries"] = app_summaries
+    return result
+
+
+def get_recommendations(nickname=None, appid=None, **kwargs):
+    """
+    Respond to a REST query at /recommendations.
+
+    Return the apps most used by the people who used app 'appid', or
+    else the apps suggested for the user 'nickname', best first:
+        app_summaries: [{... as for get_apps ...}]
+    Both are precomputed by recommender.py; this is one index lookup.
+    """
+    result = dict(error=None)
+    if appid is not None:
+        query, args = APP_NEIGHBORS, [int(appid), RECOMMENDATIONS_PAGE_SIZE]
+    elif nickname:
+        query, args = USER_SUGGESTIONS, [nickname, RECOMMENDATIONS_PAGE_SIZE]
+    else:
+        result["error"] = "No app or user given."
+        return result
+    app_summaries = db_select(query, args=args) or []
+    for summary in app_summaries:
+        for key in ('categories', 'devices', 'platforms'):
+            summary[key] = summary[key].split("|") if summary[key] is not None else []
+    delete_nulls_arr(app_summaries)
+    result["app_summaries"] = app_summaries
+    return result
+
+
 def get_login(nickname=None, **kwargs):
     result = {}
     if nickname is None:
         result["error"]["nickname"] = "No user name given."
     else:
-        result = db_select_one(
-                "SELECT nickname, user_id, avatar FROM user_details WHERE nickname=%s;",
-                args=[nickname.lower()],
-                columns=["nickname", "user_id", "avatar"])
+        result = db_select_one(USER_BY_NICKNAME, args=[nickname.lower()])
         if len(result) == 0: 
             result = {"error":"Username not found."}
     return result
@@ -317,44 +1300,18 @@ def get_profile(nickname="", **kwargs):
         avatar="default.png" )
 
     if nickname != "" and nickname is not None:
-        update = db_select_one("""
-                SELECT nickname, avatar, first_name, last_name,
-                       to_char(start_date, 'Month YYYY') AS start_date
-                FROM user_details
-                WHERE nickname = %s;""",
-                args=[nickname],
-                columns=["nickname", "avatar",
-                    "first_name", "last_name", "start_date"])
-
-        update['recommended_by_list'] = db_select(
-                """SELECT
-                    app_name, icon,
-                    recipient_nickname AS name
-                   FROM recommendation_view
-                    WHERE recommender_nickname = %s;""",
-                args=[nickname],
-                columns=["app", "icon", "name"])    
-
-        update['recommended_to_list'] = db_select(
-                """SELECT
-                    app_name, icon,
-                    recommender_nickname AS name
-                   FROM recommendation_view
-                    WHERE recipient_nickname = %s;""",
-                args=[nickname],
-                columns=["app", "icon", "name"])
-
-        update['review_list'] = db_select(
-                """SELECT
-                app_name, icon, review_date, review
-                FROM user_details AS ud
-                JOIN app_review AS ar
-                    ON ar.user_id = ud.user_id
-                JOIN app
-                    ON ar.app_id = app.app_id
-                WHERE ud.nickname = %s;""",
-                args=[nickname],
-                columns=["app", "icon", "review_date", "review"])
+        # All four sections in one round trip.
+        (details, recommended_by, recommended_to,
+         reviews) = db_select_many([
+                (PROFILE_DETAILS, [nickname], None),
+                (PROFILE_RECOMMENDED_BY, [nickname], None),
+                (PROFILE_RECOMMENDED_TO, [nickname], None),
+                (PROFILE_REVIEWS, [nickname], None)])
+
+        update = details[0] if details else {}
+        update['recommended_by_list'] = recommended_by
+        update['recommended_to_list'] = recommended_to
+        update['review_list'] = reviews
 
         delete_nulls_dict(update)
     result.update(update)
@@ -365,16 +1322,24 @@ def get_rest(path, query={}):
     """To be replaced by a query to a RESTful API later."""
     apis = {
         "apps": get_apps,
+        "apps_version": get_apps_version,
         "login": get_login,
-        "profile": get_profile}
+        "profile": get_profile,
+        "recommendations": get_recommendations,
+        "search": get_search}
     if path in apis:
-        print "(Get) Query:", query
-        result = apis[path](**query)
-        if isinstance(result, dict):
-            delete_nulls_dict(result)
-        print "(Get) Result:", result
-        import sys
-        sys.stdout.flush()
+        key = cache_key(path, query) if path in CACHE_TTL else None
+        result = response_cache.get(key) if key is not None else None
+        log.debug("at=get_rest", extra=dict(fields=dict(
+                path=path, args=",".join(sorted(query)),
+                cached=result is not None)))
+        if result is None:
+            result = apis[path](**query)
+            if isinstance(result, dict):
+                delete_nulls_dict(result)
+                if key is not None and "error" not in result:
+                    response_cache.set(key, result, ttl=CACHE_TTL[path],
+                                       tags=cache_tags(path, query))
         return result
     else:
         return None
@@ -388,12 +1353,7 @@ def post_login(nickname=None, **kwargs):
         db_query("INSERT INTO user_details (nickname) VALUES (%s)",
                  args=[nickname.lower()],
                  commit=True)
-        result = db_select_one("""
-                SELECT nickname, user_id, avatar
-                FROM user_details WHERE nickname=%s;
-                """,
-                args=[nickname.lower()],
-                columns=["nickname", "user_id", "avatar"])
+        result = db_select_one(USER_BY_NICKNAME, args=[nickname.lower()])
         if len(result) == 0:
             result = {"error": "Odd, we just inserted the name."}
     return result
@@ -402,37 +1362,43 @@ def post_login(nickname=None, **kwargs):
 def post_profile(nickname=None, **kwargs):
     """Update the user's profile.
 
-    kwargs should contain first_name, last_name, image.
-    Image is right now (Dec 2014) a werkzeug.datastructures.FileStorage
-    object but should be converted for send/receive via RESTful API
+    kwargs should contain first_name, last_name, avatar.
+    Avatar is right now (Dec 2014) a werkzeug.datastructures.FileStorage
+    object but should be converted for send/receive via RESTful API.
+    It is resized in the background, so the new avatar shows up a
+    moment after this returns (with avatar_pending=True).
     """
     if nickname != None:
-        result = db_select_one(
-                "SELECT user_id FROM user_details WHERE nickname = %s;",
-                args=[nickname],
-                columns=["user_id"])
-        if result is not None:
+        # The (cached) user row, as for logging in.
+        result = get_rest("login", query=dict(nickname=nickname))
+        if "user_id" in result:
             user_id = result["user_id"]
-            if "avatar" in kwargs:
-                avatar = "avatar_%d.jpg" % user_id
-                kwargs['avatar'].save(os.path.join(
-                    app.config['STATIC_DIR'],
-                    app.config['AVATAR_DIR'],
-                    avatar))
-                kwargs['avatar'] = avatar
-
-            QUERY = "UPDATE user_details SET {QUERY_TEXT} WHERE user_id=%d;" % user_id
-            query_keys = ('first_name', 'last_name', 'avatar')
-            query_text = ", ".join(("{k}=%s".format(k=k) for k in query_keys
-                                    if k in kwargs))
-            query_data =  [kwargs[k] for k in query_keys if k in kwargs]
-    
-            cur = db_query(QUERY.format(QUERY_TEXT=query_text),
-                     args=query_data,
-                     commit=True)
-
-            if cur is not None:
-                result = {"success" : True}
+            result = {"success": True}
+            upload = kwargs.pop('avatar', None)
+            if upload is not None and upload.filename:
+                # Only stash the upload here; a background worker
+                # resizes it and then sets user_details.avatar.
+                try:
+                    path = avatars.save_upload(upload,
+                        avatar_processor.upload_dir,
+                        app.config['AVATAR_MAX_BYTES'])
+                except avatars.AvatarTooLarge as e:
+                    return {"error": str(e)}
+                avatar_processor.submit(user_id, path)
+                result["avatar_pending"] = True
+
+            query_keys = ('first_name', 'last_name')
+            if any(k in kwargs for k in query_keys):
+                QUERY = "UPDATE user_details SET {QUERY_TEXT} WHERE user_id=%d;" % user_id
+                query_text = ", ".join(("{k}=%s".format(k=k) for k in query_keys
+                                        if k in kwargs))
+                query_data =  [kwargs[k] for k in query_keys if k in kwargs]
+
+                cur = db_query(QUERY.format(QUERY_TEXT=query_text),
+                         args=query_data,
+                         commit=True)
+                if cur is None:
+                    result = {"error": "Could not update the profile."}
         else:
             result = {"error": "Username not found."}
     else:      
@@ -440,24 +1406,206 @@ def post_profile(nickname=None, **kwargs):
     return result
             
 
+# Reviews are inserted in one statement per batch, and added to their
+# apps' running totals (app_review_rollup) in the same transaction.
+# The reviewer's role is 'health provider' if they have that role.
+POST_REVIEWS = """
+    INSERT INTO app_review (app_id, user_id, user_role, usability,
+                            effectiveness, review, platform_id)
+    SELECT r.app_id, %s,
+           (SELECT CASE WHEN EXISTS (
+                       SELECT 1 FROM user_role
+                       WHERE user_id = %s AND role_code = 'health provider')
+                   THEN 'health provider' ELSE 'user' END)::role,
+           r.usability::evaluation, r.effectiveness::evaluation,
+           r.review, p.platform_id
+    FROM (VALUES {rows}) AS r (app_id, usability, effectiveness,
+                               review, platform)
+    LEFT JOIN platform AS p
+      ON p.platform = r.platform
+    RETURNING review_id;
+    """
+POST_REVIEW_ROW = "(%s::int, %s::text, %s::text, %s::varchar(512), %s::text)"
+
+EVALUATIONS = ("bad", "ok", "good")
+
+
+def post_review(nickname=None, reviews=None, **kwargs):
+    """Add reviews by the user 'nickname'.
+
+    reviews is a list of dict(appid=, usability=, effectiveness=,
+    review=, platform=), with usability and effectiveness each 'bad',
+    'ok' or 'good'; without it, kwargs is the one review. The whole
+    batch is saved, and counted in the apps' ratings and summaries, or
+    none of it.
+    """
+    if nickname is None:
+        return {"error": "Username not given."}
+    if reviews is None:
+        reviews = [kwargs]
+    if len(reviews) == 0:
+        return {"error": "No review given."}
+    user = get_rest("login", query=dict(nickname=nickname))
+    if "user_id" not in user:
+        return {"error": "Username not found."}
+
+    args = [user["user_id"], user["user_id"]]
+    appids = set()
+    for review in reviews:
+        try:
+            appid = int(review.get("appid"))
+        except (TypeError, ValueError):
+            return {"error": "No app given."}
+        if (review.get("usability") not in EVALUATIONS or
+                review.get("effectiveness") not in EVALUATIONS):
+            return {"error": "Please rate both usability and effectiveness."}
+        appids.add(appid)
+        args += [appid, review["usability"], review["effectiveness"],
+                 (review.get("review") or "").strip()[:512] or None,
+                 review.get("platform") or None]
+
+    query = POST_REVIEWS.format(rows=", ".join([POST_REVIEW_ROW] * len(reviews)))
+    cur = db_query(query, args=args)
+    if cur is not None:
+        review_ids = [row[0] for row in cur.fetchall()]
+        cur.close()
+        cur = db_query("SELECT add_to_review_rollup(%s::integer[]);",
+                       args=[review_ids])
+    if cur is not None:
+        cur.close()
+        # Recompute the apps' summaries before committing, so the page
+        # the author is sent back to (whose ETag is their refreshed_at)
+        # shows the review, rather than a 304 until the next refresh.
+        cur = db_query("SELECT refresh_app_summaries(%s::integer[]);",
+                       args=[sorted(appids)])
+    if cur is None:
+        get_db().rollback()
+        return {"error": "Could not save the review. "
+                         "(Each app can be reviewed only once.)"}
+    cur.close()
+    get_db().commit()
+    return {"success": True, "n_reviews": len(review_ids),
+            "appids": sorted(appids)}
+
+
 def post_rest(path, query={}):
     """To be replaced by a query to a RESTful API later."""
     apis = {
         "login": post_login,
-        "profile": post_profile}
+        "profile": post_profile,
+        "review": post_review}
     if path in apis:
-        print "(Post) Query:", query
         result = apis[path](**query)
         delete_nulls_dict(result)
-        print "(Post) Result:", result
-        import sys
-        sys.stdout.flush()
+        if "error" not in result:
+            invalidate_post(path, query)
+        log.debug("at=post_rest", extra=dict(fields=dict(
+                path=path, args=",".join(sorted(query)),
+                error="error" in result)))
         return result
     else:
         return None
     
 
 ## ------------------------------------------------------ Web parts ----- ##
+# Static files are fingerprinted at startup (see assets.py):
+# url_for('static', filename='style.css') gives /static/style.<hash>.css,
+# which never changes content, so it is cached for a year. Files not in
+# the manifest (avatars) are served as before.
+STATIC_MAX_AGE = 365 * 24 * 3600
+asset_manifest = assets.build(app.config["STATIC_DIR"])
+
+
+@app.url_defaults
+def hashed_static_url(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = asset_manifest.url_name(values['filename'])
+
+
+def send_static_asset(filename):
+    """Serve a static file, precompressed and immutable if fingerprinted."""
+    original = asset_manifest.original.get(filename)
+    if original is None:
+        return app.send_static_file(filename)
+    path, encoding = asset_manifest.variant(original,
+                                            request.accept_encodings)
+    response = send_from_directory(app.static_folder, path,
+            mimetype=mimetypes.guess_type(original)[0],
+            cache_timeout=STATIC_MAX_AGE)
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Cache-Control"] = (
+            "public, max-age=%d, immutable" % STATIC_MAX_AGE)
+    response.vary.add("Accept-Encoding")
+    return response
+
+app.view_functions['static'] = send_static_asset
+
+
+def stream_template(template_name, **context):
+    """Like render_template, but yield the page in pieces as it renders."""
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(5)
+    return stream
+
+
+# Anonymous pages may be kept by a shared (reverse proxy) cache for
+# PUBLIC_MAX_AGE seconds; browsers always revalidate, getting a 304 if
+# nothing changed. Pages for a logged-in user show their name, so are
+# cached privately only.
+PUBLIC_MAX_AGE = getattr(conf, 'PUBLIC_MAX_AGE', 30)
+
+
+def page_etag(version):
+    """Return the ETag of the page being requested, for this version.
+
+    The page also depends on the query string and on who is logged in.
+    """
+    user = session.get("user") or {}
+    return hashlib.md5("%s|%s|%s|%s" % (
+            version, request.full_path,
+            user.get("nickname", ""), user.get("avatar", ""))).hexdigest()
+
+
+def not_modified(etag, last_modified):
+    """Return True if the client's copy (from its request headers) is current."""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since and last_modified is not None:
+        return request.if_modified_since >= last_modified.replace(microsecond=0)
+    return False
+
+
+def set_validators(response, etag, last_modified):
+    """Add ETag, Last-Modified and Cache-Control headers to response."""
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if "user" in session:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = 0
+        response.cache_control.s_maxage = PUBLIC_MAX_AGE
+        response.vary.add("Cookie")
+    return response
+
+
+@app.route("/debug/queries/")
+def debug_queries():
+    """Profiling totals for this process (only with PROFILE_DEBUG set)."""
+    if not PROFILE_DEBUG:
+        abort(404)
+    return jsonify(queries=query_profiler.stats(),
+                   endpoints=request_logger.endpoints.stats(),
+                   pool=pool.stats(),
+                   statements=statement_registry.stats(),
+                   cache=response_cache.stats())
+
+
 @app.route("/")
 def index():
     """The main page is at /apps, so redirect."""
@@ -483,10 +1631,16 @@ def apps(appid=None):
     kwargs = {}
     if appid is not None:
         kwargs['appid'] = int(appid)
-    elif 'tags' in request.form:
-        tags = [t.lower() for t in tag.strip().split()]
-        response = {}
-        response["title"] = "App"
+        if 'before' in request.values:
+            kwargs['before'] = request.values['before']
+    elif 'tags' in request.values:
+        kwargs['tags'] = [t.lower() for t in request.values['tags'].strip().split()]
+        # Any number of apps may match: render them as they stream in.
+        kwargs['stream'] = True
+        if 'after' in request.values:
+            kwargs['after'] = int(request.values['after'])
+    if catalog_snapshot is not None and 'user' not in session:
+        kwargs['from_snapshot'] = True
 
     if 'review' in request.form:
         logged_in = is_logged_in()
@@ -495,6 +1649,14 @@ def apps(appid=None):
         else:
             return redirect(url_for('login'))
     else:
+        # Check first whether the client already has this page.
+        version = get_rest("apps_version", query=kwargs)
+        conditional = request.method == 'GET' and version.get("etag") is not None
+        if conditional:
+            etag = page_etag(version["etag"])
+            if not_modified(etag, version.get("last_modified")):
+                return set_validators(Response(status=304), etag,
+                                      version.get("last_modified"))
         # Show summaries of the topics, in descending order
         # of most populated
         # response = get_rest("apps", appid=xxx)
@@ -502,29 +1664,79 @@ def apps(appid=None):
         response = get_rest("apps", query=kwargs)
         
     response["error"] = error
+    if not isinstance(response.get("app_summaries", []), list):
+        page = Response(stream_with_context(
+            stream_template("apps.html", **response)))
+    else:
+        page = make_response(render_template("apps.html", **response))
+    if conditional:
+        set_validators(page, etag, version.get("last_modified"))
+    return page
+
+
+@app.route("/recommendations/")
+def recommendations():
+    """Show the apps used by people who used app 'appid', or else the
+    apps suggested for the logged-in user.
+    """
+    if 'appid' in request.args:
+        query = dict(appid=int(request.args['appid']))
+        heading = "People who used this also used"
+    elif 'user' in session:
+        query = dict(nickname=session['user']['nickname'])
+        heading = "Apps for you"
+    else:
+        return redirect(url_for('login'))
+    response = get_rest("recommendations", query=query)
+    return render_template("apps.html", heading=heading, **response)
+
+
+@app.route("/search/")
+def search():
+    """Show the apps matching the search text 'q'.
+
+    With format=json, return just the top few names, for typeahead.
+    """
+    q = request.args.get('q', '').strip()
+    if request.args.get('format') == 'json':
+        return jsonify(**get_rest("search", query=dict(q=q, typeahead=True)))
+    response = get_rest("search", query=dict(q=q))
     return render_template("apps.html", **response)
 
 
 @app.route("/apps/review/", methods=['GET', 'POST'])
 @app.route("/apps/<appid>/review/", methods=['GET', 'POST'])
 def write(appid=None):
-    """Show summary of apps by topic or individual apps depending on request.
+    """Show the review form for an app, and save the review.
 
-    At the top level show tag category summaries.
-    At the app level show reviews in descending date order.
-    Otherwise show  individual app summaries within the topic.
+        post items:
+           usability, effectiveness (each bad, ok or good),
+           review, platform
+
+    Without an app, send the user to pick one first.
     """
-    error = None
+    if appid is None:
+        return redirect(url_for('apps'))
+    if not is_logged_in():
+        return redirect(url_for('login'))
+    result = {}
     if request.method == 'POST':
-        pass
-    else:
-        pass
-    if 'tags' in request.form:
-        pass
-    else:
-       pass 
+        query = dict(nickname=session["user"]["nickname"], appid=int(appid))
+        for f in ("usability", "effectiveness", "review", "platform"):
+            if f in request.form:
+                query[f] = request.form[f]
+        result = post_rest("review", query=query)
+        if "error" not in result:
+            flash('Thank you for your review!')
+            return redirect(url_for('apps', appid=appid))
+
+    response = get_rest("apps", query=dict(appid=int(appid)))
+    app_summaries = response.get("app_summaries") or []
+    if not app_summaries:
+        abort(404)
     return render_template("write.html", title="Write a review",
-                error=error)
+                           app=app_summaries[0], **result)
+
 
 @app.route("/profile/", methods=['GET', 'POST'])
 def profile():
@@ -548,7 +1760,6 @@ def profile():
 
     if request.method == 'GET':
         # GET -- If not logged in, ask user to log in else show the profile.
-        print "Profile GET..."
         if 'user' not in session:
             result["error"] = "Oup! Please log in to see your profile."
         else:
@@ -559,7 +1770,6 @@ def profile():
         # POST -- If not logged in, show an error message asking
         #         the user to log in.
         #         Otherwise, get the changes and update them.
-        print "Profile POST..."
         if "user" not in session:
             result["error"] = "Oup! Please log in to change your profile."
         else:
@@ -576,8 +1786,9 @@ def profile():
     update = get_rest("profile", query=query)
     if update is not None:
         result.update(update)
-        if 'user' in session:
-            session['user']['avatar'] = result['avatar']
+        if 'user' in session and session['user'].get('avatar') != result['avatar']:
+            # Assign, rather than change in place, so the session is saved.
+            session['user'] = dict(session['user'], avatar=result['avatar'])
     return render_template("profile.html", **result)
 
 
@@ -594,34 +1805,39 @@ def providers():
     return render_template("providers.html", **result)
 
 
+def log_in(nickname, create=False):
+    """Log in as nickname, first creating the user if create is set.
+
+    Return the user row, with "created" if it was new, or an error.
+    """
+    query = dict(nickname=nickname)
+    result = get_rest("login", query=query)
+    if create:
+        if "error" not in result:
+            # The nickname is in use already
+            return {"error": "Sorry, cannot create username -- already in use."}
+        # Then the nickname is available for use. Create it.
+        result = post_rest("login", query=query)
+        result["created"] = "true"
+    if "user_id" in result:
+        # A new session id, so one fixed before the login is useless.
+        session.regenerate()
+        session['user'] = result
+    return result
+
+
 @app.route("/login/", methods=['GET', 'POST'])
 def login():
     result = {}
     if request.method == 'POST':
-        query = {}
         if 'nickname' in request.form:
-            query['nickname'] = request.form['nickname']
-            result = get_rest("login", query=query)
-            if "create" in request.form:
-                if "error" not in result:
-                    # The nickname is in use already
-                    result = {
-                        "error":
-                        "Sorry, cannot create username -- already in use."}
-                else:
-                    # Then the nickname is available for use. Create it.
-                    result = post_rest("login", query=query)
-                    result["created"] = "true"
-            else:  # login
-                # is there  an error?
-                print "Result for 'login':", result
+            result = log_in(request.form['nickname'],
+                            create="create" in request.form)
         else:
            result["error"] = "No user id entered."
 
-        print "RESULT:", result
         if "user_id" in result:
             flash('Login successful')
-            session['user'] = result
             
         return jsonify(**result)
 
@@ -637,8 +1853,281 @@ def logout():
     return 'Logged out'
 
 
-# app.secret_key is used by flask.session to encrypt the cookies
-app.secret_key = os.urandom(24)
+# app.secret_key is used by flask.session to sign the cookies. It must
+# be the same in every worker and dyno, or a cookie from one is refused
+# by the others.
+app.secret_key = getattr(conf, 'SECRET_KEY', None)
+if not app.secret_key:
+    log.warning("at=setup SECRET_KEY is not set: sessions last only as "
+                "long as this process and work in it alone")
+    app.secret_key = os.urandom(24)
+
+
+## ------------------------------------------------- JSON API parts ----- ##
+# The get_rest() results as JSON, for clients that would otherwise have
+# to read the pages:
+#
+#   GET  /api/v1/apps/                    top tags, with their top apps
+#   GET  /api/v1/apps/?tags=..&after=..   app summaries for the tags
+#   GET  /api/v1/apps/?ids=1,2,3          app summaries by id
+#   GET  /api/v1/apps/<appid>?before=..   one app and a page of its reviews
+#   GET  /api/v1/profile/                 the logged-in user's profile
+#   POST /api/v1/login/                   nickname (and create) -> the user
+#   POST /api/v1/batch/                   several of the GETs at once
+#
+# fields=name,icon,... keeps only those fields of each app summary (or
+# of the profile); for one app, reviews are sent only if 'reviews' is
+# among them. App summaries are read with get_apps(keep_nulls=True), not
+# through get_rest(), and pass once through api.project(), which drops
+# their None values and the other fields together. The encoded bodies
+# (see api.py) are cached in response_cache beside the get_rest()
+# results, with the same tags, so the same writes drop them.
+API_MAX_BATCH = getattr(conf, 'API_MAX_BATCH', 20)
+API_MAX_IDS = getattr(conf, 'API_MAX_IDS', 100)
+API_GZIP_MIN_BYTES = getattr(conf, 'API_GZIP_MIN_BYTES', 1024)
+API_GZIP_LEVEL = getattr(conf, 'API_GZIP_LEVEL', 6)
+
+
+def api_body(status, value=None, text=None):
+    """Return the api.Body of value (or of its JSON text)."""
+    return api.make_body(status, value, text, min_bytes=API_GZIP_MIN_BYTES,
+                         level=API_GZIP_LEVEL)
+
+
+def cached_api_body(path, query, fields, build):
+    """Return the cached Body for path + query + fields, or build() it.
+
+    Cached like get_rest(path, query): for CACHE_TTL[path] seconds,
+    tagged with cache_tags(path, query). Errors are not cached.
+    """
+    key = (cache_key("api:" + path, dict(query, fields=fields))
+           if path in CACHE_TTL else None)
+    body = response_cache.get(key) if key is not None else None
+    if body is None:
+        body = build()
+        if key is not None and body.status == 200:
+            response_cache.set(key, body, ttl=CACHE_TTL[path],
+                               tags=cache_tags(path, query))
+    return body
+
+
+def api_app_summaries(appids, fields=None):
+    """Return the Body of the app summaries of appids, in that order.
+
+    Each summary is encoded and cached on its own, so any list of ids
+    is put together from the ones already encoded plus one query for
+    the rest. Unknown ids are left out.
+    """
+    cached = "apps" in CACHE_TTL
+    texts = {}
+    missing = []
+    for appid in appids:
+        text = response_cache.get(cache_key("api:app_summary", dict(
+                appid=appid, fields=fields))) if cached else None
+        if text is None:
+            missing.append(appid)
+        else:
+            texts[appid] = text
+    if missing:
+        summary_refresher.ensure_fresh(get_db())
+        for summary in db_select(APP_SUMMARIES_BY_IDS, args=[missing]) or []:
+            for key in ('categories', 'devices', 'platforms'):
+                summary[key] = summary[key].split("|") if summary[key] is not None else []
+            text = api.dumps(api.project(summary, fields))
+            texts[summary["app_id"]] = text
+            if cached:
+                response_cache.set(cache_key("api:app_summary", dict(
+                        appid=summary["app_id"], fields=fields)), text,
+                        ttl=CACHE_TTL["apps"], tags=["apps"])
+    return api_body(200, text='{"app_summaries":%s}' % api.join_list(
+            texts[appid] for appid in appids if appid in texts))
+
+
+def api_apps(params, appid=None):
+    """GET /api/v1/apps/[<appid>]: what /apps/ shows, or the apps in ids."""
+    fields = api.parse_fields(params.get("fields"))
+    query = {}
+    try:
+        if appid is not None:
+            query["appid"] = appid
+            if params.get("before"):
+                query["before"] = params["before"]
+        elif params.get("ids"):
+            return api_app_summaries(api.parse_ids(params["ids"], API_MAX_IDS),
+                                     fields)
+        elif params.get("tags"):
+            query["tags"] = [t.lower() for t in params["tags"].split()]
+            if params.get("after"):
+                query["after"] = int(params["after"])
+    except ValueError as e:
+        return api_body(400, dict(error=str(e)))
+    if catalog_snapshot is not None and "user" not in session:
+        query["from_snapshot"] = True
+
+    def build():
+        result = get_apps(keep_nulls=True, **query)
+        summaries = result.get("app_summaries") or []
+        if appid is not None:
+            if not summaries:
+                return api_body(404, dict(error="App not found."))
+            summaries[0].pop("hasreviews", None)
+            value = dict(app_summary=api.project(summaries[0], fields))
+            if fields is None or "reviews" in fields:
+                value["reviews"] = api.prune(result.get("reviews", []))
+                if "next_reviews" in result:
+                    value["next_reviews"] = result["next_reviews"]
+        elif "tag_summaries" in result:
+            value = dict(tag_summaries=[
+                    dict(name=entry["name"], n_apps=entry["n_apps"],
+                         top_apps=[api.project(row, fields)
+                                   for row in entry["top_apps"]])
+                    for entry in result["tag_summaries"]])
+        else:
+            value = dict(app_summaries=[api.project(row, fields)
+                                        for row in summaries],
+                         tags=result.get("tags", []),
+                         page_size=result.get("page_size"))
+        return api_body(200, value)
+    return cached_api_body("apps", query, fields, build)
+
+
+def api_profile(params):
+    """GET /api/v1/profile/: the logged-in user's profile."""
+    if "user" not in session:
+        return api_body(401, dict(error="Please log in to see your profile."))
+    fields = api.parse_fields(params.get("fields"))
+    query = dict(nickname=session["user"]["nickname"])
+    return cached_api_body("profile", query, fields, lambda: api_body(
+            200, api.prune(get_rest("profile", query=query), fields)))
+
+
+# The GET resources, by endpoint, for the batch requests.
+API_RESOURCES = {
+    "api_apps_view": api_apps,
+    "api_profile_view": api_profile}
+
+
+def api_response(body):
+    """Return the response for an api.Body, gzipped if the client takes it."""
+    if (request.method == 'GET' and body.status == 200 and
+            request.if_none_match.contains(body.etag)):
+        response = Response(status=304)
+    elif body.gzipped is not None and "gzip" in request.accept_encodings:
+        response = Response(body.gzipped, status=body.status,
+                            mimetype="application/json")
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = Response(body.text, status=body.status,
+                            mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    if request.method == 'GET' and body.status == 200:
+        set_validators(response, body.etag, None)
+    return response
+
+
+@app.route("/api/v1/apps/")
+@app.route("/api/v1/apps/<int:appid>")
+def api_apps_view(appid=None):
+    return api_response(api_apps(request.args, appid=appid))
+
+
+@app.route("/api/v1/profile/")
+def api_profile_view():
+    return api_response(api_profile(request.args))
+
+
+@app.route("/api/v1/login/", methods=['POST'])
+def api_login():
+    """Log in, or with create set sign up: nickname=, create= as JSON
+    or as a form. Return the user, or an error.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = request.form
+    nickname = data.get("nickname")
+    if not nickname:
+        return api_response(api_body(400, dict(error="No user id entered.")))
+    create = bool(data.get("create"))
+    result = log_in(nickname, create=create)
+    if "user_id" in result:
+        status = 200
+    else:
+        status = 409 if create else 404
+    return api_response(api_body(status, api.prune(result)))
+
+
+@app.route("/api/v1/batch/", methods=['POST'])
+def api_batch():
+    """Answer several GETs in one request.
+
+    POST {"requests": ["/api/v1/apps/?ids=1,2,3", "/api/v1/profile/"]}
+    returns [{"status": 200, "body": {...}}, ...], in the same order.
+    """
+    data = request.get_json(silent=True)
+    urls = data.get("requests") if isinstance(data, dict) else None
+    if (not isinstance(urls, list) or
+            not all(isinstance(url, basestring) for url in urls)):
+        return api_response(api_body(400, dict(
+                error='Expected {"requests": [url, ...]}.')))
+    if len(urls) > API_MAX_BATCH:
+        return api_response(api_body(400, dict(
+                error="At most %d requests at a time." % API_MAX_BATCH)))
+    adapter = app.create_url_adapter(request)
+    bodies = []
+    for url in urls:
+        path, _, query_string = url.partition("?")
+        try:
+            endpoint, view_args = adapter.match(path, method='GET')
+        except HTTPException:
+            endpoint = None
+        if endpoint not in API_RESOURCES:
+            bodies.append(api_body(404, dict(error="No such resource: %s" % path)))
+        else:
+            bodies.append(API_RESOURCES[endpoint](url_decode(query_string),
+                                                  **view_args))
+    return api_response(api_body(200, text=api.batch_text(bodies)))
+
+
+## -------------------------------------------------- Startup parts ----- ##
+# Under gunicorn with gunicorn_sync.py (or gunicorn_async.py), the app
+# is imported once, in the master, which also compiles every template
+# before forking; the workers start with them loaded and share those
+# pages of memory. Each worker then calls warm_up() before it accepts
+# any request, so the first users do not pay for it, but waits for it
+# at most WARM_UP_SECONDS (well under gunicorn's timeout).
+WARM_UP_PAGES = getattr(conf, 'WARM_UP_PAGES', ["/apps/"])
+WARM_UP_SECONDS = getattr(conf, 'WARM_UP_SECONDS', 5)
+
+
+def compile_templates():
+    """Load every template, compiling those not in the bytecode cache.
+
+    Return how many there are.
+    """
+    names = app.jinja_env.list_templates(extensions=["html"])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def warm_up():
+    """Get this process ready for traffic.
+
+    Open the pool's first connections and request WARM_UP_PAGES, which
+    starts the background threads, has the driver prepare the named
+    statements and fills the caches those pages use. A failure (say, the database is
+    down) is logged rather than raised: the worker then starts cold, as
+    it would have without this. Return the seconds taken.
+    """
+    start = time.time()
+    try:
+        pool.prefill()
+        client = app.test_client()
+        for url in WARM_UP_PAGES:
+            client.get(url).get_data()
+    except Exception:
+        log.exception("at=warm_up_failed")
+    return time.time() - start
 
 
 
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# assets.py
+"""
+Fingerprint and precompress the files under static/.
+
+Each file gets a name with a hash of its contents in it,
+
+    style.css -> style.3b9f0c21de.css
+
+so its URL changes whenever it does and can be cached "forever". Text
+files (CSS, JavaScript, ...) also get gzip and, if the 'brotli' module
+is installed, brotli variants written next to them (style.css.gz,
+style.css.br), so they are compressed once rather than per request.
+
+appcurator.py builds the manifest at startup and rewrites
+url_for('static', filename=...) to the hashed names. To precompress
+ahead of time (e.g. while building the slug):
+
+    python assets.py
+
+Avatars are left out: they are replaced in place by avatars.py.
+"""
+import gzip
+import hashlib
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE = (".css", ".js", ".svg", ".html", ".txt", ".json")
+ENCODINGS = ["br", "gzip"]  # in order of preference
+SUFFIX = {"br": ".br", "gzip": ".gz"}
+
+
+class Manifest(object):
+    """The hashed name of every static file, and the way back."""
+
+    def __init__(self, static_dir):
+        self.static_dir = static_dir
+        self.hashed = {}    # 'style.css' -> 'style.3b9f0c21de.css'
+        self.original = {}  # and back
+
+    def add(self, filename, digest):
+        root, ext = os.path.splitext(filename)
+        name = "%s.%s%s" % (root, digest[:10], ext)
+        self.hashed[filename] = name
+        self.original[name] = filename
+
+    def url_name(self, filename):
+        """Return the name to put in URLs for filename."""
+        return self.hashed.get(filename, filename)
+
+    def variant(self, filename, accepted):
+        """Return (path relative to static_dir, encoding) to send.
+
+        accepted holds the encodings the client accepts. The encoding
+        returned is None unless an up-to-date precompressed file exists
+        and the client accepts it.
+        """
+        path = os.path.join(self.static_dir, filename)
+        for encoding in ENCODINGS:
+            if encoding not in accepted:
+                continue
+            compressed = path + SUFFIX[encoding]
+            if (os.path.exists(compressed) and
+                    os.path.getmtime(compressed) >= os.path.getmtime(path)):
+                return filename + SUFFIX[encoding], encoding
+        return filename, None
+
+
+def file_digest(path):
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(65536), ""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def compress(path):
+    """Write path.gz (and path.br) if missing or older than path."""
+    mtime = os.path.getmtime(path)
+    with open(path, "rb") as f:
+        data = f.read()
+    encodings = ["gzip"] if brotli is None else ["gzip", "br"]
+    for encoding in encodings:
+        target = path + SUFFIX[encoding]
+        if os.path.exists(target) and os.path.getmtime(target) >= mtime:
+            continue
+        # Write aside and rename, so that a concurrent request (or
+        # another worker doing the same) never sees a partial file.
+        tmp = "%s.%d.tmp" % (target, os.getpid())
+        if encoding == "gzip":
+            out = gzip.GzipFile(tmp, "wb", 9)
+            out.write(data)
+            out.close()
+        else:
+            with open(tmp, "wb") as out:
+                out.write(brotli.compress(data))
+        os.rename(tmp, target)
+
+
+def build(static_dir, exclude=("images/avatars",), precompress=True):
+    """Return the Manifest of static_dir, precompressing text files."""
+    manifest = Manifest(static_dir)
+    for dirpath, dirnames, filenames in os.walk(static_dir):
+        relative_dir = os.path.relpath(dirpath, static_dir)
+        if relative_dir == ".":
+            relative_dir = ""
+        dirnames[:] = [d for d in dirnames if not d.startswith(".") and
+                       os.path.join(relative_dir, d) not in exclude]
+        for name in filenames:
+            if name.startswith(".") or name.endswith((".gz", ".br", ".tmp")):
+                continue
+            path = os.path.join(dirpath, name)
+            filename = os.path.join(relative_dir, name).replace(os.sep, "/")
+            manifest.add(filename, file_digest(path))
+            if precompress and name.endswith(COMPRESSIBLE):
+                compress(path)
+    return manifest
+
+
+if __name__ == "__main__":
+    static_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                              "static")
+    manifest = build(static_dir)
+    for filename in sorted(manifest.hashed):
+        print "%-40s %s" % (filename, manifest.hashed[filename])
+    if brotli is None:
+        print "(brotli is not installed: only gzip variants were written.)"
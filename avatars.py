@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# avatars.py
+"""
+Process uploaded avatars off the request path.
+
+The request only copies the upload into a temporary file in a private
+directory, not the served one (save_upload(), which enforces a size
+limit) and queues it:
+
+    processor = AvatarProcessor(avatar_dir, pool, sizes=(48, 128, 256))
+    processor.start()
+    tmp = save_upload(request.files["image"], processor.upload_dir,
+                      max_bytes)
+    processor.submit(user_id, tmp)
+
+A worker thread then writes one square JPEG per size,
+
+    avatar_<user_id>_48.jpg, avatar_<user_id>_128.jpg, avatar_<user_id>_256.jpg
+
+each first to a temporary name and then moved over the old file with
+os.rename(), so a page never sees a half-written image. Last, it sets
+user_details.avatar to the largest of them. thumbnail() maps that name
+to the nearest of the other sizes for the templates.
+
+Resizing needs PIL (or Pillow). Without it the upload is copied into
+place unchanged, under every size's name, if it is a JPEG, PNG or GIF.
+"""
+import imghdr
+import logging
+import os
+import Queue
+import re
+import tempfile
+import threading
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+log = logging.getLogger("appcurator.avatars")
+
+
+class AvatarTooLarge(ValueError):
+    """The upload is bigger than the allowed maximum."""
+
+
+def save_upload(upload, upload_dir, max_bytes, chunk_size=64 * 1024):
+    """Copy a FileStorage upload into a temporary file in upload_dir.
+
+    Return the path of the file. Raise AvatarTooLarge (and remove the
+    partial copy) once more than max_bytes have been read.
+    """
+    fd, path = tempfile.mkstemp(prefix="upload_", dir=upload_dir)
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = upload.stream.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise AvatarTooLarge(
+                            "Avatar images may be at most %d kB." %
+                            (max_bytes // 1024))
+                out.write(chunk)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+
+def avatar_name(user_id, size):
+    return "avatar_%d_%d.jpg" % (user_id, size)
+
+
+_SIZED = re.compile(r'^avatar_(\d+)_\d+\.jpg$')
+
+
+def thumbnail(avatar, size, sizes=(48, 128, 256)):
+    """Return the file name of the avatar in the one of sizes nearest
+    to size (the larger, between two).
+
+    Avatars not made by an AvatarProcessor (e.g. from before it, or the
+    sample data) have no other sizes; their own name is returned.
+    """
+    match = _SIZED.match(avatar or "")
+    if match is None:
+        return avatar
+    size = min(sizes, key=lambda s: (abs(s - size), -s))
+    return avatar_name(int(match.group(1)), size)
+
+
+class AvatarProcessor(object):
+    """A pool of threads that resize uploads and install them.
+
+    Keyword arguments
+    avatar_dir -- where the avatars are served from.
+    pool -- a dbpool.ConnectionPool, for updating user_details.
+    sizes -- edge lengths, in pixels, of the square images made.
+    upload_dir -- where uploads wait to be processed; by default a new
+               private temporary directory. Never the served avatar_dir.
+    workers -- number of threads.
+    on_done -- called with (user_id, nickname, avatar) after an avatar
+               is installed.
+    """
+    def __init__(self, avatar_dir, pool, sizes=(48, 128, 256), upload_dir=None,
+                 workers=2, on_done=None):
+        self.avatar_dir = avatar_dir
+        self.pool = pool
+        self.sizes = sorted(sizes)
+        self.upload_dir = (upload_dir or
+                           tempfile.mkdtemp(prefix="avatar_uploads_"))
+        self.workers = workers
+        self.on_done = on_done
+        self.processed = 0
+        self.failed = 0
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the worker threads (once per process)."""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run,
+                                          name="AvatarProcessor-%d" % i)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, user_id, path):
+        """Queue the uploaded file at path as user_id's new avatar."""
+        self._queue.put((user_id, path))
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def thumbnail(self, avatar, size):
+        """thumbnail(), for the sizes made here (a template filter)."""
+        return thumbnail(avatar, size, self.sizes)
+
+    def process(self, user_id, path):
+        """Install the upload at path as user_id's avatar.
+
+        Return (nickname, avatar). The upload is removed afterwards,
+        whether or not this succeeds.
+        """
+        try:
+            if Image is not None:
+                image = Image.open(path)
+                image.load()
+                if image.mode != "RGB":
+                    image = image.convert("RGB")
+            elif imghdr.what(path) not in ("jpeg", "png", "gif"):
+                raise ValueError("The upload is not a JPEG, PNG or GIF image.")
+            for size in self.sizes:
+                tmp = os.path.join(self.avatar_dir,
+                                   ".%s.tmp" % avatar_name(user_id, size))
+                if Image is not None:
+                    ImageOps.fit(image, (size, size), Image.ANTIALIAS).save(
+                            tmp, "JPEG", quality=85, optimize=True)
+                else:
+                    with open(path, "rb") as src:
+                        with open(tmp, "wb") as dst:
+                            dst.write(src.read())
+                os.rename(tmp, os.path.join(self.avatar_dir,
+                                            avatar_name(user_id, size)))
+        finally:
+            os.remove(path)
+
+        avatar = avatar_name(user_id, self.sizes[-1])
+        db = self.pool.getconn()
+        try:
+            cur = db.cursor()
+            cur.execute("""UPDATE user_details SET avatar = %s
+                           WHERE user_id = %s RETURNING nickname;""",
+                        [avatar, user_id])
+            rows = cur.fetchall()
+            db.commit()
+            cur.close()
+        finally:
+            self.pool.putconn(db)
+        return (rows[0][0] if rows else None), avatar
+
+    def _run(self):
+        while True:
+            user_id, path = self._queue.get()
+            try:
+                nickname, avatar = self.process(user_id, path)
+                self.processed += 1
+                if self.on_done is not None:
+                    self.on_done(user_id, nickname, avatar)
+            except Exception:
+                # A bad image must not take the worker down with it.
+                self.failed += 1
+                log.exception("at=avatar_failed user_id=%s", user_id)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# benchmarks/coldstart.py
+"""
+Measure how long gunicorn takes to serve its first pages, and how much
+memory its workers use, started as before (each worker imports the app
+and compiles the templates on its first requests) and with
+gunicorn_sync.py (the app preloaded in the master, templates compiled
+there, workers warmed up before they accept):
+
+    python benchmarks/coldstart.py --workers 4
+
+For each mode the template bytecode cache (the default
+TEMPLATE_CACHE_DIR, .jinja_cache/) is emptied first, so both
+start from nothing; the preload mode is then started once more with the
+cache left as it was, as after a restart. Printed per mode:
+
+    ready s      from starting gunicorn to the first answer to /apps/
+    first ms     the slowest first request to each of --pages
+    RSS / PSS MB per worker (mean) after --requests more requests, and
+    USS MB       PSS counts shared pages divided among their users and
+                 USS only the worker's own; the difference from RSS is
+                 what preloading shares.
+
+Needs Linux (/proc) and the database configured as for the app.
+"""
+import argparse
+import os
+import shutil
+import time
+import urllib2
+
+from loadtest import ROOT, run, serve
+
+
+def first_answer(url, seconds=120):
+    """Wait for url to answer; return the seconds it took."""
+    start = time.time()
+    while time.time() - start < seconds:
+        try:
+            urllib2.urlopen(url, timeout=30).read()
+            return time.time() - start
+        except Exception:
+            time.sleep(0.05)
+    raise RuntimeError("Server did not come up at %s" % url)
+
+
+def fetch_ms(url):
+    start = time.time()
+    urllib2.urlopen(url, timeout=30).read()
+    return 1000 * (time.time() - start)
+
+
+def children(pid):
+    """Return the ids of the processes whose parent is pid."""
+    found = []
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            try:
+                with open("/proc/%s/stat" % name) as f:
+                    # pid (comm) state ppid ...; comm may contain spaces.
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                        found.append(int(name))
+            except (IOError, IndexError, ValueError):
+                pass
+    return found
+
+
+def memory(pid):
+    """Return (RSS, PSS, USS) of process pid, in MB."""
+    totals = dict(Rss=0, Pss=0, Private_Clean=0, Private_Dirty=0)
+    with open("/proc/%d/smaps" % pid) as f:
+        for line in f:
+            key, _, rest = line.partition(":")
+            if key in totals:
+                totals[key] += int(rest.split()[0])  # kB
+    return (totals["Rss"] / 1024.0, totals["Pss"] / 1024.0,
+            (totals["Private_Clean"] + totals["Private_Dirty"]) / 1024.0)
+
+
+def measure(args, extra, clear):
+    if clear:
+        shutil.rmtree(os.path.join(ROOT, ".jinja_cache"), ignore_errors=True)
+    base = "http://127.0.0.1:%d" % args.port
+    server = serve(extra + ["--workers", str(args.workers)], args.port)
+    try:
+        ready = first_answer(base + "/apps/")
+        first = max(fetch_ms(base + page) for page in args.pages.split(","))
+        for page in args.pages.split(","):
+            run(base + page, args.workers, args.requests)
+        usage = [memory(pid) for pid in children(server.pid)]
+        master = memory(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+    mean = [sum(u[i] for u in usage) / max(len(usage), 1) for i in range(3)]
+    return ready, first, mean, master
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--requests", type=int, default=200,
+            help="requests per page before memory is measured")
+    parser.add_argument("--pages", default="/apps/,/about/,/login/,/search/?q=heart")
+    parser.add_argument("--port", type=int, default=8766)
+    args = parser.parse_args()
+
+    modes = [("lazy", [], True),
+             ("preload", ["-c", "gunicorn_sync.py"], True),
+             ("restart", ["-c", "gunicorn_sync.py"], False)]
+    print "%-8s %8s %9s %8s %8s %8s %10s" % (
+            "mode", "ready s", "first ms", "RSS MB", "PSS MB", "USS MB",
+            "master MB")
+    for label, extra, clear in modes:
+        ready, first, (rss, pss, uss), master = measure(args, extra, clear)
+        print "%-8s %8.2f %9.1f %8.1f %8.1f %8.1f %10.1f" % (
+                label, ready, first, rss, pss, uss, master[0])
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# benchmarks/generate.py
+"""
+Fill the schema with a synthetic catalog at a chosen scale.
+
+Users, apps, reviews and recommendations go through the staging loaders
+(with bulkload.bulk_load, i.e. COPY), exactly as real data would; tags,
+organizations, platforms and devices are inserted directly. Everything
+is named 'gen_...', so it can be told apart from real rows. The same
+--seed gives the same data.
+
+    python benchmarks/generate.py --scale small
+    python benchmarks/generate.py --apps 100000 --users 200000 \\
+        --reviews 5000000 --recommendations 2000000 --tags 20000 --fanout 3
+
+Load into an empty development database (after sql/create_*.sql); the
+generator does not check for earlier 'gen_' rows.
+"""
+import argparse
+import csv
+import os
+import random
+import sys
+import time
+
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from appcurator import conf
+import bulkload
+
+
+SCALES = {
+    "tiny": dict(apps=200, users=500, reviews=2000, recommendations=1000,
+                 tags=50, fanout=3),
+    "small": dict(apps=5000, users=20000, reviews=100000,
+                  recommendations=50000, tags=500, fanout=4),
+    "medium": dict(apps=20000, users=100000, reviews=1000000,
+                   recommendations=500000, tags=5000, fanout=4),
+    "large": dict(apps=100000, users=500000, reviews=5000000,
+                  recommendations=2000000, tags=20000, fanout=3),
+    }
+
+ORGANIZATIONS = 50
+PLATFORMS = ["iOS", "Android", "Tablet", "Phone", "Web", "Watch"]
+DEVICES = ["Fitbit", "Nike+FuelBand", "Jawbone", "Garmin", "Withings"]
+ROLES = ["user"] * 8 + ["health provider"] * 2
+EVALUATIONS = ["bad", "ok", "good"]
+WORDS = ("track log plan heart sleep walk run swim calm breathe eat "
+         "water step pulse mood stretch focus recover train share").split()
+
+
+def csv_lines(header, rows):
+    """Yield the lines of a CSV file (with header) for bulk_load."""
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(header)
+    yield buf.getvalue()
+    for row in rows:
+        buf.seek(0)
+        buf.truncate()
+        writer.writerow(row)
+        yield buf.getvalue()
+
+
+def pg_array(values):
+    return "{%s}" % ",".join('"%s"' % v for v in values)
+
+
+def sentence(rng, n):
+    return " ".join(rng.choice(WORDS) for i in range(n)).capitalize() + "."
+
+
+def popular(rng, n):
+    """Return an index below n, skewed towards small indexes (Zipf-like)."""
+    return min(int(n * rng.random() ** 3), n - 1)
+
+
+def load_lookups(cur, n_tags, fanout):
+    """Organizations, platforms, devices and the tag tree."""
+    cur.execute("""INSERT INTO organization_details (organization_name)
+                   SELECT 'gen_org_' || i FROM generate_series(1, %s) AS i;""",
+                [ORGANIZATIONS])
+    for name in PLATFORMS:
+        cur.execute("""INSERT INTO platform (platform) SELECT %s
+                       WHERE NOT EXISTS (SELECT 1 FROM platform
+                                         WHERE platform = %s);""", [name, name])
+    for name in DEVICES:
+        cur.execute("""INSERT INTO device (device) SELECT %s
+                       WHERE NOT EXISTS (SELECT 1 FROM device
+                                         WHERE device = %s);""", [name, name])
+    # Parents first, so the closure trigger finds each parent's rows.
+    # Tag i (from 1) has parent (i - 1) / fanout, or none for the first
+    # 'fanout' tags: a tree about log(n_tags, fanout) levels deep.
+    cur.execute("SELECT COALESCE(max(category_id), 0) FROM tag;")
+    base = cur.fetchone()[0]
+    cur.execute("""
+        INSERT INTO tag (category_id, parent_category_id, category_name)
+        SELECT %s + i,
+               CASE WHEN (i - 1) / %s = 0 THEN NULL
+                    ELSE %s + (i - 1) / %s END,
+               'gen_tag_' || i
+        FROM generate_series(1, %s) AS i
+        ORDER BY i;""", [base, fanout, base, fanout, n_tags])
+    cur.execute("""SELECT setval(pg_get_serial_sequence('tag', 'category_id'),
+                                 max(category_id)) FROM tag;""")
+
+
+def users(rng, n):
+    for i in range(n):
+        role = rng.choice(ROLES)
+        yield ["Gen", "User%d" % i, "gen_user_%d" % i, "default.png",
+               pg_array([role]),
+               "gen_org_%d" % (i % ORGANIZATIONS + 1)
+                   if role == "health provider" else "",
+               "", "", ""]
+
+
+def apps(rng, n, n_tags):
+    for i in range(n):
+        tags = set("gen_tag_%d" % (popular(rng, n_tags) + 1)
+                   for j in range(rng.randint(1, 4)))
+        yield ["gen_app_%d" % i, pg_array(sorted(tags)),
+               "gen_org_%d" % (i % ORGANIZATIONS + 1), "default.png",
+               sentence(rng, rng.randint(4, 20)),
+               pg_array(rng.sample(PLATFORMS, rng.randint(1, 3))),
+               pg_array(rng.sample(DEVICES, rng.randint(0, 2)))]
+
+
+def reviews(rng, n, n_apps, n_users):
+    # (user, app) pairs must be unique. User i % n_users reviews app
+    # (i // n_users) steps along a stride, which is coprime to n_apps,
+    # starting from a popular app: distinct for up to n_apps rounds.
+    stride = 104729
+    while n_apps % stride == 0:
+        stride += 2
+    starts = [popular(rng, n_apps) for u in range(min(n_users, n))]
+    for i in range(min(n, n_apps * n_users)):
+        u = i % n_users
+        app = (starts[u] + (i // n_users) * stride) % n_apps
+        yield ["gen_app_%d" % app, "gen_user_%d" % u, rng.choice(ROLES),
+               rng.choice(EVALUATIONS), rng.choice(EVALUATIONS),
+               sentence(rng, rng.randint(5, 40)), rng.choice(PLATFORMS)]
+
+
+def recommendations(rng, n, n_apps, n_users):
+    # A dense core: most recommendations come from a few active users.
+    for i in range(n):
+        yield ["gen_app_%d" % popular(rng, n_apps),
+               "gen_user_%d" % popular(rng, n_users),
+               "gen_user_%d" % rng.randrange(n_users)]
+
+
+def load(db, loader, rows, chunk_size):
+    lines = csv_lines(bulkload.LOADERS[loader][1], rows)
+    n, seconds = bulkload.bulk_load(db, loader, lines, chunk_size=chunk_size)
+    print "%-20s %10d rows %8.1f s %10.0f rows/s" % (
+            loader, n, seconds, n / max(seconds, 1e-9))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small",
+            help="preset sizes (each overridden by the options below)")
+    for name in ("apps", "users", "reviews", "recommendations",
+                 "tags", "fanout"):
+        parser.add_argument("--" + name, type=int)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--chunk-size", type=int, default=20000)
+    parser.add_argument("--review-days", type=int, default=1000,
+            help="spread review dates over this many past days (0 = today)")
+    args = parser.parse_args()
+    sizes = dict(SCALES[args.scale])
+    for name in sizes:
+        if getattr(args, name) is not None:
+            sizes[name] = getattr(args, name)
+
+    rng = random.Random(args.seed)
+    db = conf.connect_db()
+    try:
+        start = time.time()
+        cur = db.cursor()
+        load_lookups(cur, sizes["tags"], sizes["fanout"])
+        db.commit()
+        load(db, "user_details", users(rng, sizes["users"]), args.chunk_size)
+        load(db, "app_view", apps(rng, sizes["apps"], sizes["tags"]),
+             args.chunk_size)
+        load(db, "app_review",
+             reviews(rng, sizes["reviews"], sizes["apps"], sizes["users"]),
+             args.chunk_size)
+        load(db, "app_recommendation",
+             recommendations(rng, sizes["recommendations"],
+                             sizes["apps"], sizes["users"]),
+             args.chunk_size)
+        if args.review_days > 0:
+            cur.execute("""UPDATE app_review
+                           SET review_date = current_date -
+                               (review_id * 7919 %% %s)
+                           WHERE review_date = current_date;""",
+                        [args.review_days])
+            # The running review totals still hold today's date.
+            cur.execute("SELECT reconcile_review_rollup();")
+        cur.execute("SELECT refresh_app_summaries(TRUE);")
+        db.commit()
+        db.autocommit = True
+        cur.execute("VACUUM ANALYZE;")
+        print "Generated %s in %.1f s." % (
+                ", ".join("%s=%d" % kv for kv in sorted(sizes.items())),
+                time.time() - start)
+    finally:
+        db.close()
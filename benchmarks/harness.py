@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# benchmarks/harness.py
+"""
+Time the pages and get_rest() paths in-process, through Flask's test
+client, against whatever data the configured database holds (see
+benchmarks/generate.py for a synthetic catalog).
+
+    python benchmarks/harness.py --requests 200
+    python benchmarks/harness.py --cold --only apps_tags,rest_profile
+    python benchmarks/harness.py --compare benchmarks/results/<earlier>.json
+
+Each scenario runs 'warmup' untimed and then 'requests' timed calls,
+cycling through sample app ids, tags and nicknames taken from the
+database. With --threads N, N clients run at once. With --cold, the
+in-process caches are emptied before every call, so the database work
+is measured rather than the caches.
+
+The api_* scenarios fetch the same data as JSON (/api/v1/...) for
+comparison with the pages; every request accepts gzip, and the median
+response size in bytes, as sent, is reported with the timings.
+
+With --snapshot FILE, the catalog is first exported to FILE (see
+snapshot.py) and the anonymous pages are read from it; the database
+queries per request ('q/req') show what that saves.
+
+p50/p95/p99 latency, throughput and size are printed and saved as JSON in
+benchmarks/results/, named by time and git commit; --compare prints the
+change against an earlier file.
+"""
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import appcurator
+import snapshot
+from appcurator import app
+
+
+ACCEPT_GZIP = {"Accept-Encoding": "gzip"}
+
+# What an app list needs: no objective, no reviews.
+LIST_FIELDS = "app_id,name,icon,organization,n_recc,n_users,version"
+
+
+def percentile(values, p):
+    """Return the p-th percentile (0-100) of a sorted list."""
+    if not values:
+        return float('nan')
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+def samples(n=50):
+    """Return app ids, tag names and nicknames to cycle through."""
+    with app.test_request_context():
+        def column(query):
+            return [row.values()[0] for row in
+                    appcurator.db_select(query, args=[n]) or []]
+        return dict(
+            appids=column("""SELECT app_id FROM app_summaries
+                             ORDER BY recommendations DESC LIMIT %s"""),
+            tags=column("""SELECT category_name FROM tag
+                           ORDER BY category_id LIMIT %s"""),
+            nicknames=column("""SELECT nickname FROM user_details
+                                ORDER BY user_id LIMIT %s"""))
+
+
+def scenarios(s):
+    """Return {name: function(client, i)} for every benchmarked call."""
+    def check(response, url):
+        data = response.get_data()  # consume streamed pages
+        if response.status_code >= 400:
+            raise RuntimeError("%s -> %d" % (url, response.status_code))
+        return len(data)
+
+    def page(url):
+        def run(client, i):
+            return check(client.get(url(i), headers=ACCEPT_GZIP), url(i))
+        return run
+
+    def batch(urls):
+        def run(client, i):
+            return check(client.post("/api/v1/batch/", headers=ACCEPT_GZIP,
+                                     content_type="application/json",
+                                     data=json.dumps(dict(requests=urls(i)))),
+                         "/api/v1/batch/")
+        return run
+
+    def rest(path, query):
+        def run(client, i):
+            with app.test_request_context():
+                appcurator.get_rest(path, query=query(i))
+        return run
+
+    def pick(values, i):
+        return values[i % len(values)]
+
+    def some(values, i, n=10):
+        return [pick(values, i + k) for k in range(n)]
+
+    def logged_in(url):
+        def run(client, j):
+            with client.session_transaction() as session:
+                session["user"] = dict(nickname=pick(s["nicknames"], j),
+                                       avatar="default.png")
+            return page(lambda k: url)(client, j)
+        return run
+
+    return {
+        "index": page(lambda i: "/apps/"),
+        "apps_tags": page(lambda i: "/apps/?tags=%s" % pick(s["tags"], i)),
+        "apps_appid": page(lambda i: "/apps/%d" % pick(s["appids"], i)),
+        "profile": logged_in("/profile/"),
+        "api_apps": page(lambda i: "/api/v1/apps/"),
+        "api_apps_tags": page(lambda i: "/api/v1/apps/?tags=%s&fields=%s" % (
+                pick(s["tags"], i), LIST_FIELDS)),
+        "api_apps_appid": page(lambda i: "/api/v1/apps/%d" %
+                pick(s["appids"], i)),
+        # Ten apps: one request, where the pages take ten.
+        "api_apps_ids": page(lambda i: "/api/v1/apps/?ids=%s&fields=%s" % (
+                ",".join(str(a) for a in some(s["appids"], i)), LIST_FIELDS)),
+        "api_batch": batch(lambda i: ["/api/v1/apps/%d?fields=%s" % (
+                a, LIST_FIELDS + ",reviews") for a in some(s["appids"], i)]),
+        "api_profile": logged_in("/api/v1/profile/"),
+        "rest_apps": rest("apps", lambda i: {}),
+        "rest_apps_appid": rest("apps",
+                lambda i: dict(appid=pick(s["appids"], i))),
+        "rest_apps_tags": rest("apps",
+                lambda i: dict(tags=[pick(s["tags"], i).lower()])),
+        "rest_profile": rest("profile",
+                lambda i: dict(nickname=pick(s["nicknames"], i))),
+        "rest_login": rest("login",
+                lambda i: dict(nickname=pick(s["nicknames"], i))),
+        }
+
+
+def clear_caches():
+    appcurator.response_cache.clear()
+    appcurator.fragment_cache.clear()
+
+
+def queries_run():
+    """Return the number of queries this process has sent so far."""
+    return sum(entry["count"] for entry in appcurator.query_profiler.stats())
+
+
+def measure(run, requests, threads, warmup, cold):
+    """Return a dictionary of latency percentiles (ms) and throughput."""
+    client = app.test_client()
+    for i in range(warmup):
+        run(client, i)
+    queries = queries_run()
+    latencies = []
+    sizes = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker():
+        client = app.test_client()
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            if cold:
+                clear_caches()
+            start = time.time()
+            try:
+                size = run(client, i)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                continue
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                if size is not None:
+                    sizes.append(size)
+
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    wall = time.time() - start
+    queries = queries_run() - queries
+    latencies.sort()
+    sizes.sort()
+    return dict(requests=len(latencies), errors=errors[0],
+                throughput=len(latencies) / wall,
+                p50=1000 * percentile(latencies, 50),
+                p95=1000 * percentile(latencies, 95),
+                p99=1000 * percentile(latencies, 99),
+                max=1000 * latencies[-1] if latencies else float('nan'),
+                bytes=percentile(sizes, 50),
+                queries=float(queries) / max(len(latencies), 1))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def report(results, previous=None):
+    print "%-18s %7s %5s %9s %9s %9s %9s %9s %6s" % (
+            "scenario", "ok", "err", "req/s", "p50 ms", "p95 ms", "p99 ms",
+            "bytes", "q/req")
+    for name in sorted(results):
+        r = results[name]
+        line = "%-18s %7d %5d %9.1f %9.1f %9.1f %9.1f %9.0f %6.2f" % (
+                name, r["requests"], r["errors"], r["throughput"],
+                r["p50"], r["p95"], r["p99"], r.get("bytes", float('nan')),
+                r.get("queries", float('nan')))
+        old = (previous or {}).get(name)
+        if old:
+            line += "   p95 %+6.1f%%  req/s %+6.1f%%" % (
+                    100.0 * (r["p95"] - old["p95"]) / max(old["p95"], 1e-9),
+                    100.0 * (r["throughput"] - old["throughput"]) /
+                    max(old["throughput"], 1e-9))
+        print line
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--cold", action="store_true",
+            help="empty the in-process caches before every call")
+    parser.add_argument("--only", help="comma-separated scenario names")
+    parser.add_argument("--label", default="",
+            help="added to the results file name")
+    parser.add_argument("--compare", help="earlier results file")
+    parser.add_argument("--no-save", action="store_true")
+    parser.add_argument("--snapshot",
+            help="export the catalog to this file and serve from it")
+    args = parser.parse_args()
+
+    # The background threads would add noise to the timings.
+    appcurator.summary_refresher.interval = 0
+    appcurator.request_logger.sample_rate = 0.0
+
+    if args.snapshot:
+        db = appcurator.conf.connect_db()
+        try:
+            snapshot.export(db, args.snapshot, appcurator.APP_SUMMARY_QUERY,
+                            appcurator.APP_SUMMARY_COLUMNS,
+                            appcurator.APP_REVIEWS.columns,
+                            appcurator.REVIEWS_PAGE_SIZE + 1)
+        finally:
+            db.close()
+        appcurator.catalog_snapshot = snapshot.SnapshotReader(
+                args.snapshot, on_change=appcurator.invalidate_apps)
+
+    all_scenarios = scenarios(samples())
+    names = args.only.split(",") if args.only else sorted(all_scenarios)
+    results = {}
+    for name in names:
+        results[name] = measure(all_scenarios[name], args.requests,
+                                args.threads, args.warmup, args.cold)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["results"]
+    report(results, previous)
+
+    if not args.no_save:
+        commit = git_commit()
+        directory = os.path.join(ROOT, "benchmarks", "results")
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(directory, "%s-%s%s.json" % (
+                stamp, commit, "-" + args.label if args.label else ""))
+        with open(path, "w") as f:
+            json.dump(dict(commit=commit, time=stamp, args=vars(args),
+                           pool=appcurator.pool.stats(),
+                           results=results), f, indent=2, sort_keys=True)
+        print "Saved", os.path.relpath(path, ROOT)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# benchmarks/loadtest.py
+"""
+Send concurrent GET requests to a running server and report throughput
+and latency percentiles:
+
+    python benchmarks/loadtest.py http://localhost:8000/apps/1 \\
+        --concurrency 50 --requests 2000
+
+With --compare, start gunicorn with sync workers and then with the
+gevent settings in gunicorn_async.py, run the same load against each
+and print both results (needs the database configured as for the app):
+
+    python benchmarks/loadtest.py /apps/1 --compare --concurrency 100
+"""
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, p):
+    """Return the p-th percentile (0-100) of a sorted list."""
+    if not values:
+        return float('nan')
+    i = int(round(p / 100.0 * (len(values) - 1)))
+    return values[i]
+
+
+def run(url, concurrency, n_requests, timeout=30):
+    """Issue n_requests GETs to url from concurrency threads.
+
+    Return a dictionary of the results.
+    """
+    remaining = [n_requests]
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            start = time.time()
+            try:
+                urllib2.urlopen(url, timeout=timeout).read()
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                continue
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.time() - start
+    latencies.sort()
+    return dict(requests=len(latencies), errors=errors[0], seconds=wall,
+                rps=len(latencies) / wall,
+                p50=percentile(latencies, 50), p95=percentile(latencies, 95),
+                p99=percentile(latencies, 99))
+
+
+def report(label, result):
+    print "%-8s %6d ok %5d err %8.1f req/s   p50 %7.1f ms  p95 %7.1f ms  p99 %7.1f ms" % (
+            label, result['requests'], result['errors'], result['rps'],
+            1000 * result['p50'], 1000 * result['p95'], 1000 * result['p99'])
+
+
+def wait_until_up(url, seconds=30):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        try:
+            urllib2.urlopen(url, timeout=2).read()
+            return
+        except Exception:
+            time.sleep(0.5)
+    raise RuntimeError("Server did not come up at %s" % url)
+
+
+def serve(args, port):
+    """Start gunicorn with the extra args; return the process."""
+    env = dict(os.environ, PORT=str(port))
+    command = ["gunicorn", "--bind", "127.0.0.1:%d" % port] + args + [
+               "appcurator:app"]
+    return subprocess.Popen(command, cwd=ROOT, env=env)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("url", help="full URL, or a path with --compare")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--compare", action="store_true",
+            help="start sync and gevent gunicorn in turn and load each")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    if not args.compare:
+        report("server", run(args.url, args.concurrency, args.requests))
+        sys.exit(0)
+
+    url = "http://127.0.0.1:%d%s" % (args.port, args.url)
+    modes = [("sync", ["--workers", str(args.workers)]),
+             ("gevent", ["-c", "gunicorn_async.py",
+                         "--workers", str(args.workers)])]
+    for label, extra in modes:
+        server = serve(extra, args.port)
+        try:
+            wait_until_up(url)
+            run(url, args.concurrency, args.concurrency)  # warm up
+            report(label, run(url, args.concurrency, args.requests))
+        finally:
+            server.terminate()
+            server.wait()
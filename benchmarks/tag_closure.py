@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# benchmarks/tag_closure.py
+"""
+Compare filtering apps by tag through tag_closure with the old
+recursive app_category_view (WITH RECURSIVE over 'tag', then DISTINCT
+over 'app_tag').
+
+Everything happens inside one transaction that is rolled back, so it is
+safe to run against a development database that has the schema loaded:
+
+    python benchmarks/tag_closure.py --tags 10000 --app-tags 100000
+
+The synthetic tag tree has 'fanout' top-level tags and every other tag
+has 'fanout' children, so 10000 tags at fanout 4 are about 7 levels deep.
+
+Note that the old view only filed an app under its tags' direct parents,
+while tag_closure files it under every ancestor, so the counts can
+differ for tags more than one level above an app's own tags.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from appcurator import conf
+
+
+RECURSIVE_QUERY = """
+    WITH RECURSIVE q AS (
+        SELECT parent_category_id, category_id
+          FROM tag
+          WHERE parent_category_id IS NULL
+        UNION
+        SELECT t.parent_category_id, t.category_id
+          FROM tag t
+          JOIN q ON q.category_id = t.parent_category_id
+    ), intermediate AS (
+        SELECT DISTINCT app_id, category_id
+          FROM app_tag
+        UNION
+        SELECT DISTINCT app_id, q.parent_category_id AS category_id
+          FROM app_tag AS at
+          JOIN q ON at.category_id = q.category_id
+    ), acv AS (
+        SELECT DISTINCT app_id, category_name
+          FROM intermediate
+          JOIN tag ON intermediate.category_id = tag.category_id
+    )
+    SELECT count(DISTINCT app_id) FROM acv
+    WHERE lower(category_name) IN ({slots});
+    """
+
+CLOSURE_QUERY = """
+    SELECT count(DISTINCT at.app_id)
+    FROM tag
+    JOIN tag_closure AS tc
+      ON tc.ancestor_id = tag.category_id
+    JOIN app_tag AS at
+      ON at.category_id = tc.descendant_id
+    WHERE lower(tag.category_name) IN ({slots});
+    """
+
+
+def load(cur, n_tags, fanout, n_apps, n_app_tags):
+    """Fill the (already created) schema with a synthetic catalog."""
+    cur.execute("""INSERT INTO organization_details (organization_name)
+                   VALUES ('Benchmark Org') RETURNING organization_id;""")
+    org_id = cur.fetchone()[0]
+
+    cur.execute("SELECT COALESCE(max(category_id), 0) FROM tag;")
+    tag_base = cur.fetchone()[0]
+    # Rows are inserted parents-first, so the per-row closure trigger
+    # always finds the parent's closure rows already in place.
+    cur.execute("""
+        INSERT INTO tag (category_id, parent_category_id, category_name)
+        SELECT %s + i,
+               CASE WHEN (i - 1) / %s = 0 THEN NULL
+                    ELSE %s + (i - 1) / %s END,
+               'bench_tag_' || i
+        FROM generate_series(1, %s) AS i
+        ORDER BY i;""", [tag_base, fanout, tag_base, fanout, n_tags])
+    cur.execute("""SELECT setval(pg_get_serial_sequence('tag', 'category_id'),
+                                 max(category_id)) FROM tag;""")
+
+    cur.execute("SELECT COALESCE(max(app_id), 0) FROM app;")
+    app_base = cur.fetchone()[0]
+    cur.execute("""
+        INSERT INTO app (app_name, organization_id, objective)
+        SELECT 'bench_app_' || i, %s, 'Benchmark app.'
+        FROM generate_series(1, %s) AS i;""", [org_id, n_apps])
+    cur.execute("""
+        INSERT INTO app_tag (app_id, category_id)
+        SELECT %s + 1 + floor(random() * %s)::int,
+               %s + 1 + floor(random() * %s)::int
+        FROM generate_series(1, %s);""",
+        [app_base, n_apps, tag_base, n_tags, n_app_tags])
+    for table in ("tag", "tag_closure", "app", "app_tag"):
+        cur.execute("ANALYZE %s;" % table)
+
+
+def time_query(cur, query, args, repeat):
+    """Return (count, list of elapsed seconds) for repeat runs of query."""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        cur.execute(query, args)
+        count = cur.fetchone()[0]
+        times.append(time.time() - start)
+    return count, times
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tags", type=int, default=10000)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--apps", type=int, default=20000)
+    parser.add_argument("--app-tags", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    db = conf.connect_db()
+    cur = db.cursor()
+    try:
+        start = time.time()
+        load(cur, args.tags, args.fanout, args.apps, args.app_tags)
+        print "Loaded %d tags, %d apps, %d app_tag rows in %.1f s." % (
+                args.tags, args.apps, args.app_tags, time.time() - start)
+
+        # A top-level tag, a tag in the middle and a leaf.
+        cases = [["bench_tag_1"],
+                 ["bench_tag_%d" % (args.fanout + 1)],
+                 ["bench_tag_%d" % args.tags],
+                 ["bench_tag_%d" % i for i in range(1, args.fanout + 1)]]
+        print "%-40s %10s %10s %12s %12s" % (
+                "tags", "recursive", "closure", "recursive ms", "closure ms")
+        for tags in cases:
+            slots = ", ".join(["%s"] * len(tags))
+            n_old, old = time_query(cur, RECURSIVE_QUERY.format(slots=slots),
+                                    tags, args.repeat)
+            n_new, new = time_query(cur, CLOSURE_QUERY.format(slots=slots),
+                                    tags, args.repeat)
+            label = ",".join(tags)
+            if len(label) > 40:
+                label = label[:37] + "..."
+            print "%-40s %10d %10d %12.1f %12.1f" % (
+                    label, n_old, n_new,
+                    1000 * sorted(old)[len(old) // 2],
+                    1000 * sorted(new)[len(new) // 2])
+    finally:
+        db.rollback()
+        db.close()
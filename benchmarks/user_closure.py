@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# benchmarks/user_closure.py
+"""
+Compare the authorization lookups through user_closure with the old
+recursive walks over user_hierarchy (WITH RECURSIVE, as
+get_authorized_users() and is_authorized_for() used to be written).
+
+Everything happens inside one transaction that is rolled back, so it is
+safe to run against a development database that has the schema loaded:
+
+    python benchmarks/user_closure.py --depth 200 --users 20000 --fanout 8
+
+Two synthetic hierarchies are built: a 'deep' chain of --depth users,
+each acting for the one before, and a 'wide' tree of --users users in
+which everyone has --fanout subordinates. The time to insert them
+(i.e. the closure trigger's cost) is printed too.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from appcurator import conf
+
+
+RECURSIVE_DESCENDANTS = """
+    WITH RECURSIVE q AS (
+        SELECT parent_id, sub_id FROM user_hierarchy WHERE parent_id = %s
+      UNION
+        SELECT uh.parent_id, uh.sub_id
+          FROM user_hierarchy uh
+          JOIN q ON q.sub_id = uh.parent_id
+    )
+    SELECT count(DISTINCT sub_id) FROM q;
+    """
+
+RECURSIVE_MAY_ACT_FOR = """
+    WITH RECURSIVE q AS (
+        SELECT parent_id, sub_id FROM user_hierarchy WHERE sub_id = %s
+      UNION
+        SELECT uh.parent_id, uh.sub_id
+          FROM user_hierarchy uh
+          JOIN q ON q.parent_id = uh.sub_id
+    )
+    SELECT count(1) FROM q WHERE parent_id = %s;
+    """
+
+CLOSURE_DESCENDANTS = """
+    SELECT count(1) FROM get_authorized_users(%s);
+    """
+
+CLOSURE_MAY_ACT_FOR = """
+    SELECT may_act_for(%s, %s)::int;
+    """
+
+
+def add_users(cur, prefix, n):
+    """Insert n users named prefix_1 ... prefix_n; return the first id."""
+    cur.execute("""
+        INSERT INTO user_details (first_name, last_name, nickname)
+        SELECT 'Bench', 'User', %s || i
+        FROM generate_series(1, %s) AS i
+        RETURNING user_id;""", [prefix, n])
+    return min(row[0] for row in cur.fetchall())
+
+
+def load(cur, depth, n_users, fanout):
+    """Build the deep and the wide hierarchy; return their first ids."""
+    deep = add_users(cur, "bench_deep_", depth)
+    wide = add_users(cur, "bench_wide_", n_users)
+    # Parents first, one row at a time, as the site would add them.
+    for name, rows in (
+            ("deep", [(deep + i - 1, deep + i) for i in range(1, depth)]),
+            ("wide", [(wide + (i - 1) // fanout, wide + i)
+                      for i in range(1, n_users)])):
+        start = time.time()
+        for parent_id, sub_id in rows:
+            cur.execute("""INSERT INTO user_hierarchy (parent_id, sub_id)
+                           VALUES (%s, %s);""", [parent_id, sub_id])
+        seconds = time.time() - start
+        print "Inserted %d %s edges in %.1f s (%.2f ms each)." % (
+                len(rows), name, seconds, 1000 * seconds / max(len(rows), 1))
+    for table in ("user_details", "user_hierarchy", "user_closure"):
+        cur.execute("ANALYZE %s;" % table)
+    return deep, wide
+
+
+def time_query(cur, query, args, repeat):
+    """Return (count, median elapsed ms) for repeat runs of query."""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        cur.execute(query, args)
+        count = cur.fetchone()[0]
+        times.append(time.time() - start)
+    return count, 1000 * sorted(times)[len(times) // 2]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--depth", type=int, default=200)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--fanout", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    db = conf.connect_db()
+    cur = db.cursor()
+    try:
+        deep, wide = load(cur, args.depth, args.users, args.fanout)
+        deep_leaf = deep + args.depth - 1
+        wide_leaf = wide + args.users - 1
+
+        cases = [
+            ("deep: all below the top", "descendants", [deep]),
+            ("deep: leaf for the top", "may_act_for", [deep_leaf, deep]),
+            ("deep: top for the leaf", "may_act_for", [deep, deep_leaf]),
+            ("wide: all below the root", "descendants", [wide]),
+            ("wide: all below a child", "descendants", [wide + 1]),
+            ("wide: leaf for the root", "may_act_for", [wide_leaf, wide]),
+            ("wide: leaf for a sibling", "may_act_for",
+             [wide_leaf, wide_leaf - 1]),
+            ]
+        queries = {
+            "descendants": (RECURSIVE_DESCENDANTS, CLOSURE_DESCENDANTS),
+            "may_act_for": (RECURSIVE_MAY_ACT_FOR, CLOSURE_MAY_ACT_FOR),
+            }
+        print "%-28s %10s %10s %12s %12s" % (
+                "case", "recursive", "closure", "recursive ms", "closure ms")
+        for label, kind, ids in cases:
+            old_query, new_query = queries[kind]
+            n_old, old_ms = time_query(cur, old_query, ids, args.repeat)
+            n_new, new_ms = time_query(cur, new_query, ids, args.repeat)
+            print "%-28s %10d %10d %12.2f %12.2f" % (
+                    label, n_old, n_new, old_ms, new_ms)
+    finally:
+        db.rollback()
+        db.close()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# bulkload.py
+"""
+Stream a CSV file into one of the staging loader tables.
+
+The file is read and sent in chunks with COPY ... FROM STDIN, one
+transaction per chunk. Each COPY fires the loader's statement-level
+trigger once (see create_tables.sql), which moves the chunk into the
+real tables with a handful of set-based statements.
+
+    python bulkload.py app_view sql/minimal_app_view.csv
+    python bulkload.py user_details sql/minimal_user_details.csv \\
+        --chunk-size 10000
+
+The CSV must have a header row. By default its columns are taken to be
+in the order of the matching file in sql/ (or of the INSERT in
+insert_minimal_dataset.sql); use --columns to give another order.
+"""
+import argparse
+import csv
+import sys
+import time
+
+from cStringIO import StringIO
+
+
+# loader name -> (staging table, default column order)
+LOADERS = {
+    "app_view": ("staging.app_view_loader",
+        ["app_name", "tags", "organization_name", "icon", "objective",
+         "platforms", "devices"]),
+    "app_review": ("staging.app_review_loader",
+        ["app_name", "user_nickname", "user_role", "usability",
+         "effectiveness", "review", "platform"]),
+    "app_recommendation": ("staging.app_recommendation_loader",
+        ["app_name", "recommender_nickname", "recipient_nickname"]),
+    "user_details": ("staging.user_details_loader",
+        ["first_name", "last_name", "nickname", "avatar", "roles",
+         "organization_name", "is_organization_admin",
+         "authorized_professionals", "authorized_subs"]),
+    }
+
+
+def chunks(reader, chunk_size):
+    """Yield (csv text, row count) for successive chunks of a csv.reader."""
+    buf = StringIO()
+    writer = csv.writer(buf)
+    n = 0
+    for row in reader:
+        writer.writerow(row)
+        n += 1
+        if n == chunk_size:
+            yield buf.getvalue(), n
+            buf = StringIO()
+            writer = csv.writer(buf)
+            n = 0
+    if n > 0:
+        yield buf.getvalue(), n
+
+
+def bulk_load(db, loader, infile, columns=None, chunk_size=5000, out=None):
+    """Copy the CSV rows of infile into the staging table for loader.
+
+    Commit after each chunk and, if out is given, write a progress line
+    to it. Return (rows, seconds).
+    """
+    table, default_columns = LOADERS[loader]
+    columns = columns or default_columns
+    copy = "COPY %s (%s) FROM STDIN WITH (FORMAT csv, NULL '')" % (
+            table, ", ".join(columns))
+
+    reader = csv.reader(infile)
+    next(reader)  # header
+    total = 0
+    start = time.time()
+    cur = db.cursor()
+    try:
+        for text, n in chunks(reader, chunk_size):
+            chunk_start = time.time()
+            cur.execute(copy, stream=StringIO(text))
+            db.commit()
+            total += n
+            if out is not None:
+                elapsed = time.time() - chunk_start
+                out.write("%10d rows  %10.0f rows/s (chunk)  %10.0f rows/s (total)\n"
+                          % (total, n / max(elapsed, 1e-9),
+                             total / max(time.time() - start, 1e-9)))
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
+    return total, time.time() - start
+
+
+if __name__ == "__main__":
+    from appcurator import conf
+
+    parser = argparse.ArgumentParser(
+            description="Stream a CSV file into a staging loader table.")
+    parser.add_argument("loader", choices=sorted(LOADERS))
+    parser.add_argument("csvfile", help="CSV file with a header row ('-' for stdin)")
+    parser.add_argument("--chunk-size", type=int, default=5000,
+            help="rows per COPY / transaction (default 5000)")
+    parser.add_argument("--columns",
+            help="comma-separated staging columns, in the file's order")
+    args = parser.parse_args()
+
+    columns = args.columns.split(",") if args.columns else None
+    infile = sys.stdin if args.csvfile == "-" else open(args.csvfile, "rb")
+    db = conf.connect_db()
+    try:
+        rows, seconds = bulk_load(db, args.loader, infile, columns=columns,
+                                  chunk_size=args.chunk_size, out=sys.stdout)
+    finally:
+        db.close()
+        infile.close()
+    print "Loaded %d rows in %.2f s (%.0f rows/s)." % (
+            rows, seconds, rows / max(seconds, 1e-9))
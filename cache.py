@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# cache.py
+"""
+An in-process least-recently-used cache with per-entry expiry.
+
+Values are stored pickled, so every get() returns a fresh copy that
+the caller may modify, and the size of each entry is known. The cache
+is bounded both by number of entries and by total bytes; the least
+recently used entries are dropped first.
+
+Entries can carry tags, and invalidate(tag) drops every entry with
+that tag -- e.g. everything derived from one user's profile:
+
+    c = LRUCache(max_entries=1000, max_bytes=16 * 2**20)
+    c.set(key, value, ttl=60, tags=["profile:tanya"])
+    c.get(key)                 # a copy of value, or None
+    c.invalidate("profile:tanya")
+"""
+import cPickle as pickle
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Thread-safe LRU cache bounded by entry count and by bytes."""
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 2**20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires, tags, data)
+        self._tags = {}                # tag -> set of keys
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        """Return a copy of the cached value, or default if absent/expired."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._forget(key, entry)
+                self.misses += 1
+                return default
+            self._entries[key] = entry  # move to most-recently-used
+            self.hits += 1
+            data = entry[2]
+        return pickle.loads(data)
+
+    def set(self, key, value, ttl=60, tags=()):
+        """Cache value for ttl seconds. Return False if it cannot be cached.
+
+        Values that cannot be pickled (e.g. generators, open files) or
+        that are larger than max_bytes are not cached.
+        """
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError):
+            return False
+        if len(data) > self.max_bytes:
+            return False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._forget(key, old)
+            tags = frozenset(tags)
+            self._entries[key] = (time.time() + ttl, tags, data)
+            self._bytes += len(data)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while (len(self._entries) > self.max_entries
+                   or self._bytes > self.max_bytes):
+                oldest, entry = self._entries.popitem(last=False)
+                self._forget(oldest, entry)
+                self.evictions += 1
+        return True
+
+    def delete(self, key):
+        """Drop the entry for key, if any."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._forget(key, entry)
+
+    def invalidate(self, tag):
+        """Drop every entry carrying the tag."""
+        with self._lock:
+            for key in self._tags.pop(tag, ()):
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._forget(key, entry)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Return a dictionary of counters and current sizes."""
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        evictions=self.evictions,
+                        invalidations=self.invalidations,
+                        entries=len(self._entries), bytes=self._bytes,
+                        max_entries=self.max_entries,
+                        max_bytes=self.max_bytes)
+
+    def _forget(self, key, entry):
+        """Account for an entry already popped from _entries.
+
+        Call with the lock held.
+        """
+        self._bytes -= len(entry[2])
+        for tag in entry[1]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# dbpool.py
+"""
+A small process-wide pool of database connections.
+
+Opening a pg8000 connection costs a TCP + SSL + authentication
+handshake with Postgres, which is far more than most of our queries
+take. The pool keeps connections open between requests instead:
+
+    pool = ConnectionPool(conf.connect_db, minconn=1, maxconn=10)
+    db = pool.getconn()
+    try:
+        ...
+    finally:
+        pool.putconn(db)
+
+The pool only uses 'threading' primitives, so it is safe to share
+between threads, and between greenlets when gevent has monkey-patched
+the standard library.
+"""
+import os
+import threading
+import time
+
+from collections import deque
+
+
+class PoolError(Exception):
+    """Raised when no connection could be checked out of the pool."""
+    pass
+
+
+class ConnectionPool(object):
+    """Bounded pool of connections made by the 'connect' callable.
+
+    Keyword arguments
+    minconn -- idle connections are never evicted below this number.
+    maxconn -- at most this many connections are open at once; any
+               further getconn() call waits for a connection to be
+               returned.
+    timeout -- seconds to wait for a free connection before raising
+               PoolError.
+    max_idle -- seconds a connection may sit unused before it is closed.
+    ping_after -- connections idle for longer than this many seconds
+               are checked with 'SELECT 1' on checkout (0 = always).
+    """
+    def __init__(self, connect, minconn=1, maxconn=10, timeout=30,
+                 max_idle=300, ping_after=10):
+        if maxconn < 1 or minconn > maxconn:
+            raise ValueError("Need 0 <= minconn <= maxconn and maxconn >= 1.")
+        self.connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.ping_after = ping_after
+        self._cond = threading.Condition(threading.Lock())
+        self._reset()
+
+    def _reset(self):
+        """Forget every connection (used at startup and after a fork)."""
+        self._pid = os.getpid()
+        self._idle = deque()  # (connection, time returned), newest on the right
+        self._in_use = 0
+        self._closed = False
+        self._stats = dict(created=0, closed=0, checkouts=0, returns=0,
+                           waits=0, wait_time=0.0, timeouts=0,
+                           failed_checks=0, failed_rollbacks=0, evicted=0)
+
+    def _check_pid(self):
+        # Connections inherited from a parent process (e.g. a gunicorn
+        # master using --preload) share its sockets; never reuse them.
+        if self._pid != os.getpid():
+            self._reset()
+
+    ## ------------------------------------------------------------------ ##
+    def getconn(self, timeout=None):
+        """Check a healthy connection out of the pool.
+
+        Wait at most timeout seconds (default: the pool's timeout; 0 not
+        to wait at all) for one to be free before raising PoolError.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        with self._cond:
+            self._check_pid()
+            if self._closed:
+                raise PoolError("The connection pool is closed.")
+            self._evict_idle()
+            start = time.time()
+            waited = False
+            while not self._idle and self._in_use >= self.maxconn:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolError("Timed out waiting for a connection.")
+                waited = True
+                self._cond.wait(remaining)
+            if waited:
+                self._stats["waits"] += 1
+                self._stats["wait_time"] += time.time() - start
+            if self._idle:
+                conn, returned = self._idle.pop()
+            else:
+                conn, returned = None, None
+            self._in_use += 1
+            self._stats["checkouts"] += 1
+
+        # Connect or ping outside the lock so other callers are not blocked.
+        try:
+            if conn is not None and not self._is_healthy(conn, returned):
+                conn = None
+            if conn is None:
+                conn = self.connect()
+                with self._cond:
+                    self._stats["created"] += 1
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """Return a connection to the pool, rolling back any open transaction.
+
+        Pass discard=True if the connection is known to be broken.
+        """
+        if not discard:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+                with self._cond:
+                    self._stats["failed_rollbacks"] += 1
+        with self._cond:
+            if self._pid != os.getpid():
+                # Checked out before a fork; belongs to the parent.
+                return
+            self._in_use -= 1
+            self._stats["returns"] += 1
+            if discard or self._closed or len(self._idle) >= self.maxconn:
+                self._close(conn)
+            else:
+                self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def prefill(self):
+        """Open connections until there are minconn, e.g. before serving."""
+        conns = []
+        try:
+            while len(conns) < self.minconn:
+                conns.append(self.getconn())
+        finally:
+            for conn in conns:
+                self.putconn(conn)
+        return len(conns)
+
+    def closeall(self):
+        """Close every idle connection and refuse further checkouts."""
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._close(self._idle.popleft()[0])
+            self._cond.notify_all()
+
+    def stats(self):
+        """Return a dictionary of pool counters and current sizes."""
+        with self._cond:
+            self._check_pid()
+            result = dict(self._stats)
+            result.update(in_use=self._in_use, idle=len(self._idle),
+                          minconn=self.minconn, maxconn=self.maxconn)
+        return result
+
+    ## ------------------------------------------------------------------ ##
+    def _evict_idle(self):
+        """Close the oldest idle connections unused for max_idle seconds.
+
+        Call with the lock held.
+        """
+        cutoff = time.time() - self.max_idle
+        while (self._idle and len(self._idle) + self._in_use > self.minconn
+               and self._idle[0][1] < cutoff):
+            self._close(self._idle.popleft()[0])
+            self._stats["evicted"] += 1
+
+    def _is_healthy(self, conn, returned):
+        if time.time() - returned < self.ping_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1;")
+            cur.fetchall()
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            with self._cond:
+                self._stats["failed_checks"] += 1
+                self._close(conn)
+            return False
+
+    def _close(self, conn):
+        self._stats["closed"] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# gunicorn_async.py
+"""
+Gunicorn settings for the cooperative (gevent) serving mode:
+
+    gunicorn -c gunicorn_async.py appcurator:app
+
+Each worker serves up to WORKER_CONNECTIONS requests at once as
+greenlets. pg8000 is pure Python, so with the standard library
+patched its socket reads yield to other requests instead of blocking
+the worker; independent queries within one request also run
+concurrently (see db_select_parallel in appcurator.py).
+
+Database concurrency per worker is still capped by the connection pool
+(POOL_MAX_CONNECTIONS); requests beyond that wait for a connection, and
+a request's queries run one after another when the pool has no spare
+connections for them.
+
+The app is preloaded and the workers warmed up as in gunicorn_sync.py.
+"""
+# Patch before anything (in particular the pool's locks) is imported.
+from gevent import monkey
+monkey.patch_all()
+
+import os
+
+from gunicorn_sync import on_exit, post_worker_init, preload_app, when_ready
+
+bind = "0.0.0.0:%s" % os.environ.get("PORT", "8000")
+worker_class = "gevent"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_connections = int(os.environ.get("WORKER_CONNECTIONS", 200))
+timeout = 30
+errorlog = "-"
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# gunicorn_sync.py
+"""
+Gunicorn settings for the default (sync) serving mode:
+
+    gunicorn -c gunicorn_sync.py appcurator:app
+
+The app is imported once, in the master (preload_app), and every
+template is compiled there, or loaded from the bytecode cache in
+TEMPLATE_CACHE_DIR, before any worker is forked. The workers inherit
+all of that rather than each doing it on its first request, and share
+the memory it takes until they write to it. Each worker then opens its
+connections and fills its caches (appcurator.warm_up()) before it
+accepts a request, for up to WARM_UP_SECONDS: a slow or unreachable
+database must not keep it from its first heartbeat, or the master would
+kill it after 'timeout' seconds and start another in a loop. Whatever
+is left of the warm-up goes on in the background.
+
+With SNAPSHOT_PATH set, the master also starts snapshot.py to rewrite
+the catalog snapshot every SNAPSHOT_EVERY seconds, one exporter for all
+the workers on the machine, which read it (see snapshot_for() in
+appcurator.py).
+
+gunicorn_async.py uses the same hooks for the gevent mode.
+"""
+import os
+import subprocess
+import sys
+import threading
+import time
+
+bind = "0.0.0.0:%s" % os.environ.get("PORT", "8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+timeout = 30
+errorlog = "-"
+preload_app = True
+
+started = time.time()
+exporter = None
+
+
+def when_ready(server):
+    """In the master, once the app is imported: compile the templates
+    and start the snapshot exporter."""
+    global exporter
+    import appcurator
+    start = time.time()
+    n = appcurator.compile_templates()
+    server.log.info("at=startup templates=%d compile_ms=%d import_ms=%d",
+                    n, 1000 * (time.time() - start),
+                    1000 * (start - started))
+    if appcurator.SNAPSHOT_PATH and appcurator.SNAPSHOT_EVERY > 0:
+        exporter = subprocess.Popen(
+                [sys.executable, "snapshot.py", appcurator.SNAPSHOT_PATH,
+                 "--every", str(appcurator.SNAPSHOT_EVERY)],
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def post_worker_init(worker):
+    """In each new worker, before it accepts: warm it up, waiting for
+    that at most WARM_UP_SECONDS."""
+    import appcurator
+    start = time.time()
+    thread = threading.Thread(target=appcurator.warm_up, name="WarmUp")
+    thread.daemon = True
+    thread.start()
+    thread.join(appcurator.WARM_UP_SECONDS)
+    worker.log.info("at=worker_ready pid=%d warm_up_ms=%d finished=%s",
+                    os.getpid(), 1000 * (time.time() - start),
+                    not thread.is_alive())
+
+
+def on_exit(server):
+    if exporter is not None:
+        exporter.terminate()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# profiler.py
+"""
+Per-statement query profiling.
+
+Every query run through appcurator's db helpers is recorded under its
+fingerprint -- the statement name for registered statements, else the
+query text with literals and placeholder lists squashed:
+
+    SELECT ... WHERE app_id IN (%s, %s, %s)  ->  SELECT ... WHERE app_id IN (?)
+
+QueryProfiler keeps, per fingerprint, a latency histogram and row
+counts, and the latest EXPLAIN (ANALYZE, BUFFERS) output of runs slower
+than explain_ms. Those EXPLAINs are sampled (one per fingerprint every
+explain_every seconds) and run by a background thread on a connection of
+its own, so a slow request is not made slower by running its query
+twice. RequestProfile is the timeline of one request.
+"""
+import logging
+import Queue
+import re
+import threading
+import time
+
+log = logging.getLogger("appcurator.profiler")
+
+
+# Upper bounds (ms) of the histogram buckets; the last one is open.
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_LISTS = re.compile(r"\(\s*(?:\?|%s)(?:\s*,\s*(?:\?|%s))*\s*\)")
+_SPACE = re.compile(r"\s+")
+_CALLS = re.compile(r"\b([a-z_][a-z0-9_]*)\s*\(")
+
+# Words that may stand before a parenthesis in a read-only query: SQL
+# keywords, and built-in functions without side effects. Any other call
+# (e.g. one of the functions in create_functions.sql) might write.
+_READ_ONLY_CALLS = frozenset("""
+    select from where join on and or not in any all exists values as
+    over filter using with lateral by then else when case is like ilike
+    between limit offset distinct union except intersect having cast
+    count sum avg min max array_agg json_agg string_agg bool_or bool_and
+    coalesce nullif greatest least lower upper length substr trim
+    to_char to_date extract date_trunc abs ceil floor round ln exp sqrt
+    to_tsquery plainto_tsquery to_tsvector ts_rank ts_rank_cd
+    array_length unnest
+    """.split())
+
+
+def fingerprint(query):
+    """Return the fingerprint of a query (text or registered Statement)."""
+    name = getattr(query, "name", None)
+    if name is not None:
+        return name
+    text = _SPACE.sub(" ", query).strip().rstrip(";").rstrip()
+    text = _LITERALS.sub("?", text)
+    return _LISTS.sub("(?)", text)
+
+
+def is_read_only(text):
+    """Return True if the query can be EXPLAIN ANALYZEd without side effects.
+
+    It must be a SELECT (or WITH) that neither writes nor locks, and
+    calls no function but the built-ins in _READ_ONLY_CALLS.
+    """
+    text = text.lower()
+    words = set(re.findall(r"[a-z]+", text))
+    return (text.lstrip().startswith(("select", "with")) and
+            not words & set(["insert", "update", "delete", "share"]) and
+            set(_CALLS.findall(text)) <= _READ_ONLY_CALLS)
+
+
+class Histogram(object):
+    """Counts of durations in BUCKETS, with their total and maximum."""
+    __slots__ = ("counts", "total", "max", "rows")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+
+    def add(self, ms, rows):
+        i = 0
+        while i < len(BUCKETS) and ms > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        self.rows += rows
+
+    def asdict(self):
+        n = sum(self.counts)
+        labels = ["<=%d" % b for b in BUCKETS] + [">%d" % BUCKETS[-1]]
+        return dict(count=n, mean_ms=self.total / n if n else 0.0,
+                    max_ms=self.max, rows=self.rows,
+                    histogram_ms=[(label, c) for label, c
+                                  in zip(labels, self.counts) if c])
+
+
+class QueryProfiler(object):
+    """Aggregate query timings per fingerprint, for the whole process.
+
+    Keyword arguments
+    explain_ms -- runs slower than this get an EXPLAIN captured (0 = never).
+    explain_every -- seconds between EXPLAINs of the same fingerprint.
+    max_fingerprints -- beyond this many, new ones are lumped as 'other'.
+    max_pending -- EXPLAINs waiting for the thread; more are dropped.
+    """
+    def __init__(self, explain_ms=500, explain_every=300,
+                 max_fingerprints=1000, max_pending=16):
+        self.explain_ms = explain_ms
+        self.explain_every = explain_every
+        self.max_fingerprints = max_fingerprints
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._plans = {}      # fingerprint -> (time, ms, plan text)
+        self._explained = {}  # fingerprint -> time of last EXPLAIN
+        self._pending = Queue.Queue(max_pending)
+        self._thread = None
+
+    def record(self, fp, ms, rows=0):
+        with self._lock:
+            h = self._histograms.get(fp)
+            if h is None:
+                if len(self._histograms) >= self.max_fingerprints:
+                    fp = "other"
+                h = self._histograms.setdefault(fp, Histogram())
+            h.add(ms, rows)
+
+    def wants_explain(self, fp, ms):
+        """Return True (and note the time) if this run should be EXPLAINed."""
+        if not self.explain_ms or ms < self.explain_ms:
+            return False
+        now = time.time()
+        with self._lock:
+            if now - self._explained.get(fp, 0) < self.explain_every:
+                return False
+            self._explained[fp] = now
+        return True
+
+    def start(self, pool):
+        """Start the thread that runs the EXPLAINs (once per process),
+        with connections from pool (a dbpool.ConnectionPool)."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, args=(pool,),
+                                            name="QueryProfiler")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def explain_later(self, query, args, fp, ms):
+        """Queue an EXPLAIN (ANALYZE, BUFFERS) of query, to keep its plan.
+
+        Only read-only queries are explained, and nothing waits: if the
+        thread is behind, the EXPLAIN is dropped.
+        """
+        text = getattr(query, "text", query)
+        if not is_read_only(text):
+            return
+        try:
+            self._pending.put_nowait((text, args, fp, ms))
+        except Queue.Full:
+            pass
+
+    def explain(self, db, text, args):
+        """Return the EXPLAIN (ANALYZE, BUFFERS) plan of the query text,
+        run on db in a transaction that is rolled back."""
+        cur = db.cursor()
+        try:
+            cur.execute("EXPLAIN (ANALYZE, BUFFERS) " +
+                        text.strip().rstrip(";"), args)
+            return "\n".join(row[0] for row in cur.fetchall())
+        finally:
+            cur.close()
+            db.rollback()
+
+    def _run(self, pool):
+        while True:
+            text, args, fp, ms = self._pending.get()
+            try:
+                # Never wait on the pool: requests need it more.
+                db = pool.getconn(timeout=0)
+            except Exception:
+                continue
+            try:
+                plan = self.explain(db, text, args)
+            except Exception:
+                log.debug("at=explain_failed fingerprint=%s", fp,
+                          exc_info=True)
+                continue
+            finally:
+                pool.putconn(db)  # rolls back; discards it if that fails
+            with self._lock:
+                self._plans[fp] = (time.time(), ms, plan)
+
+    def stats(self):
+        """Return [{fingerprint:, count:, mean_ms:, ...}], most total time first."""
+        with self._lock:
+            result = []
+            for fp, h in self._histograms.items():
+                entry = h.asdict()
+                entry["fingerprint"] = fp
+                if fp in self._plans:
+                    when, ms, plan = self._plans[fp]
+                    entry["slow_plan"] = dict(at=when, ms=ms, plan=plan)
+                result.append(entry)
+        result.sort(key=lambda e: e["count"] * e["mean_ms"], reverse=True)
+        return result
+
+
+class RequestProfile(object):
+    """The queries of one request, in order, and its pool waiting time."""
+    __slots__ = ("start", "queries", "pool_wait")
+
+    def __init__(self):
+        self.start = time.time()
+        self.queries = []
+        self.pool_wait = 0.0
+
+    def add(self, fp, ms, rows, end=None):
+        end = end or time.time()
+        self.queries.append((fp, 1000 * (end - self.start) - ms, ms, rows))
+
+    def asdict(self):
+        return dict(pool_wait_ms=1000 * self.pool_wait,
+                    queries=[dict(fingerprint=fp, at_ms=at, ms=ms, rows=rows)
+                             for fp, at, ms, rows in self.queries])
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# recommender.py
+"""
+Compute "people who used this also used" recommendations, offline.
+
+Every review and every recommendation is a signal that a user used
+(or vouches for) an app. They are read with one COPY into a sparse
+users x apps matrix X, weighted as
+
+    review           RATING[usability] + RATING[effectiveness]
+    recommended it   1.0 (for the recommender)
+    was recommended  0.5 (for the recipient)
+
+The similarity of two apps is the cosine of their columns of X, and
+app_neighbors gets, for each app, the top_k apps with the most similar
+sets of users. A user's suggestions are then X[user] times the matrix
+of those neighbours -- apps like the ones they used, weighted by how
+much they liked those -- less the apps they used already. All of it is
+sparse matrix products, a block of rows at a time, and the results go
+back with COPY.
+
+Triggers queue the users whose reviews or recommendations changed in
+recommender_dirty. An ordinary run recomputes only the apps those users
+used and those users' suggestions; everyone else's catch up at the
+next --full run (e.g. nightly).
+
+    python recommender.py            # just the queued changes
+    python recommender.py --full     # everything
+    python recommender.py --every 600
+
+Needs NumPy and SciPy; the web app itself only reads the tables.
+"""
+import time
+
+from cStringIO import StringIO
+
+import numpy as np
+import pg8000
+import scipy.sparse as sp
+
+
+RATING = {"bad": 0.0, "ok": 0.5, "good": 1.0}
+
+SIGNALS_QUERY = """
+    SELECT user_id, app_id, sum(weight)
+    FROM (
+        SELECT user_id, app_id,
+               CASE usability WHEN 'good' THEN {good} WHEN 'ok' THEN {ok}
+                    ELSE {bad} END +
+               CASE effectiveness WHEN 'good' THEN {good} WHEN 'ok' THEN {ok}
+                    ELSE {bad} END AS weight
+          FROM app_review
+        UNION ALL
+        SELECT recommender_id, app_id, 1.0 FROM app_recommendation
+        UNION ALL
+        SELECT recipient_id, app_id, 0.5 FROM app_recommendation
+    ) AS signals
+    GROUP BY user_id, app_id
+    HAVING sum(weight) > 0
+    """.format(**RATING)
+
+
+def copy_out(cur, query, columns):
+    """Return the result of query as a float array with 'columns' columns."""
+    buf = StringIO()
+    cur.execute("COPY (%s) TO STDOUT" % query.strip(), stream=buf)
+    # Tabs and newlines are both whitespace to fromstring(sep=" ").
+    return np.fromstring(buf.getvalue(), sep=" ").reshape(-1, columns)
+
+
+def copy_in(cur, table, columns, lines):
+    """COPY the tab-separated lines into table."""
+    cur.execute("COPY %s (%s) FROM STDIN" % (table, ", ".join(columns)),
+                stream=StringIO("".join(lines)))
+
+
+def index_of(ids, known):
+    """Return the positions in the sorted array 'known' of the ids in it."""
+    ids = np.unique(np.asarray(ids, dtype=np.int64))
+    if len(known) == 0 or len(ids) == 0:
+        return np.zeros(0, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(known, ids), len(known) - 1)
+    return positions[known[positions] == ids]
+
+
+class Signals(object):
+    """The users x apps matrix X, with the ids of its rows and columns."""
+
+    def __init__(self, triples):
+        self.user_ids, rows = np.unique(triples[:, 0].astype(np.int64),
+                                        return_inverse=True)
+        self.app_ids, cols = np.unique(triples[:, 1].astype(np.int64),
+                                       return_inverse=True)
+        self.X = sp.csr_matrix(
+                (triples[:, 2].astype(np.float32), (rows, cols)),
+                shape=(len(self.user_ids), len(self.app_ids)))
+
+
+def top_k(scores, k, exclude):
+    """Yield (row, columns, values) of the k best entries of each row.
+
+    scores and exclude are CSR matrices of the same shape; the columns
+    set in a row of exclude are skipped in that row of scores, as are
+    entries that are not positive.
+    """
+    for row in xrange(scores.shape[0]):
+        start, end = scores.indptr[row], scores.indptr[row + 1]
+        columns = scores.indices[start:end]
+        values = scores.data[start:end]
+        skip = exclude.indices[exclude.indptr[row]:exclude.indptr[row + 1]]
+        keep = (values > 0) & ~np.in1d(columns, skip)
+        columns, values = columns[keep], values[keep]
+        if len(values) > k:
+            best = np.argpartition(-values, k)[:k]
+            columns, values = columns[best], values[best]
+        order = np.argsort(-values, kind="mergesort")
+        yield row, columns[order], values[order]
+
+
+def neighbor_lines(signals, app_cols, k, block):
+    """Yield, per block of apps, the app_neighbors lines of those apps."""
+    X = signals.X
+    norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=0)).ravel())
+    norms[norms == 0] = 1
+    Xn = X.dot(sp.diags(1 / norms, 0)).tocsr()   # unit-length columns
+    XnT = Xn.T.tocsr()
+    for start in range(0, len(app_cols), block):
+        cols = app_cols[start:start + block]
+        similarity = XnT[cols].dot(Xn).tocsr()    # cosines, |cols| x apps
+        itself = sp.csr_matrix((np.ones(len(cols)), (np.arange(len(cols)), cols)),
+                               shape=similarity.shape)
+        lines = []
+        for row, neighbors, scores in top_k(similarity, k, itself):
+            app_id = signals.app_ids[cols[row]]
+            for rank, (n, score) in enumerate(zip(neighbors, scores)):
+                lines.append("%d\t%d\t%d\t%.6g\n" % (
+                        app_id, rank + 1, signals.app_ids[n], score))
+        yield lines
+
+
+def neighbor_matrix(cur, signals):
+    """Return app_neighbors as an apps x apps CSR matrix in X's columns."""
+    triples = copy_out(cur, "SELECT app_id, neighbor_id, score "
+                            "FROM app_neighbors", 3)
+    n = len(signals.app_ids)
+    if n == 0 or len(triples) == 0:
+        return sp.csr_matrix((n, n), dtype=np.float32)
+    ids = triples[:, :2].astype(np.int64)
+    positions = np.minimum(np.searchsorted(signals.app_ids, ids), n - 1)
+    found = (signals.app_ids[positions] == ids).all(axis=1)
+    return sp.csr_matrix(
+            (triples[found, 2].astype(np.float32),
+             (positions[found, 0], positions[found, 1])), shape=(n, n))
+
+
+def suggestion_lines(signals, user_rows, neighbors, k, block):
+    """Yield, per block of users, the user_suggestions lines of those users."""
+    for start in range(0, len(user_rows), block):
+        rows = user_rows[start:start + block]
+        used = signals.X[rows]
+        scores = used.dot(neighbors).tocsr()
+        lines = []
+        for row, apps, values in top_k(scores, k, used):
+            user_id = signals.user_ids[rows[row]]
+            for rank, (a, score) in enumerate(zip(apps, values)):
+                lines.append("%d\t%d\t%d\t%.6g\n" % (
+                        user_id, rank + 1, signals.app_ids[a], score))
+        yield lines
+
+
+def update(db, full=False, k=20, block=500):
+    """Recompute the recommendations on the connection 'db' and commit.
+
+    Return (apps, users) recomputed, or None if another run was already
+    going on.
+    """
+    cur = db.cursor()
+    try:
+        cur.execute("SELECT pg_try_advisory_xact_lock(hashtext('recommender'));")
+        if not cur.fetchone()[0]:
+            db.rollback()
+            return None
+        cur.execute("DELETE FROM recommender_dirty RETURNING user_id;")
+        dirty = [row[0] for row in cur.fetchall()]
+        if not full and not dirty:
+            db.commit()
+            return 0, 0
+
+        signals = Signals(copy_out(cur, SIGNALS_QUERY, 3))
+        if full:
+            app_cols = np.arange(len(signals.app_ids))
+            user_rows = np.arange(len(signals.user_ids))
+            cur.execute("DELETE FROM app_neighbors;")
+            cur.execute("DELETE FROM user_suggestions;")
+        else:
+            user_rows = index_of(dirty, signals.user_ids)
+            app_cols = np.unique(signals.X[user_rows].indices)
+            cur.execute("DELETE FROM app_neighbors WHERE app_id = ANY(%s);",
+                        [[int(i) for i in signals.app_ids[app_cols]]])
+            cur.execute("DELETE FROM user_suggestions WHERE user_id = ANY(%s);",
+                        [sorted(set(dirty))])
+
+        for lines in neighbor_lines(signals, app_cols, k, block):
+            copy_in(cur, "app_neighbors",
+                    ["app_id", "rank", "neighbor_id", "score"], lines)
+        neighbors = neighbor_matrix(cur, signals)
+        for lines in suggestion_lines(signals, user_rows, neighbors, k, block):
+            copy_in(cur, "user_suggestions",
+                    ["user_id", "rank", "app_id", "score"], lines)
+        if full:
+            cur.execute("ANALYZE app_neighbors;")
+            cur.execute("ANALYZE user_suggestions;")
+        db.commit()
+    except pg8000.Error:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
+    return len(app_cols), len(user_rows)
+
+
+if __name__ == "__main__":
+    import argparse
+    from appcurator import conf
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--full", action="store_true",
+            help="recompute everything, not only the queued users")
+    parser.add_argument("--top-k", type=int, default=20,
+            help="neighbours kept per app and suggestions per user")
+    parser.add_argument("--block", type=int, default=500,
+            help="rows per sparse matrix product")
+    parser.add_argument("--every", type=int, default=0,
+            help="run again every this many seconds (0 = once)")
+    args = parser.parse_args()
+
+    full = args.full
+    while True:
+        db = conf.connect_db()
+        try:
+            start = time.time()
+            n = update(db, full=full, k=args.top_k, block=args.block)
+        except pg8000.Error as e:
+            if args.every <= 0:
+                raise
+            print "Failed (%s); trying again in %d s." % (e, args.every)
+            n = ()
+        finally:
+            db.close()
+        if n is None:
+            print "Another run is going on; try again shortly."
+        elif n:
+            print "Recomputed %d apps and %d users in %.1f s." % (
+                    n[0], n[1], time.time() - start)
+        if args.every <= 0:
+            break
+        full = False
+        time.sleep(args.every)
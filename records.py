@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# records.py
+"""
+Compact, read-only rows for streamed query results.
+
+A record is a tuple with named fields, so it costs one small object per
+row instead of a dictionary. It reads like the dictionaries returned by
+db_select after delete_nulls_arr():
+
+    Row = record_type(["name", "icon"])
+    row = Row(("Kick Perfect", None))
+    row.name, row["name"], row.get("icon")   # 'Kick Perfect' x2, None
+    row.icon, row["icon"]                     # AttributeError, KeyError
+
+A NULL column raises AttributeError/KeyError just like a deleted
+dictionary key, so '{% if app.icon is defined %}' works in templates.
+"""
+
+
+class Record(tuple):
+    """Base class of the types made by record_type()."""
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            value = tuple.__getitem__(self, self._index[key])
+            if value is None:
+                raise KeyError(key)
+            return value
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        i = self._index.get(key)
+        if i is None:
+            return default
+        value = tuple.__getitem__(self, i)
+        return default if value is None else value
+
+    def keys(self):
+        return [k for k, v in zip(self._fields, self) if v is not None]
+
+    def asdict(self):
+        """Return the non-NULL fields as a dictionary."""
+        return dict((k, v) for k, v in zip(self._fields, self) if v is not None)
+
+    def __repr__(self):
+        return "Record(%s)" % ", ".join(
+                "%s=%r" % kv for kv in zip(self._fields, self))
+
+
+def _field(i, name):
+    def get(self):
+        value = tuple.__getitem__(self, i)
+        if value is None:
+            raise AttributeError(name)
+        return value
+    return property(get)
+
+
+_types = {}
+
+
+def record_type(columns):
+    """Return the Record subclass for these column names (made once)."""
+    key = tuple(columns)
+    cls = _types.get(key)
+    if cls is None:
+        namespace = dict(__slots__=(), _fields=key,
+                         _index=dict((c, i) for i, c in enumerate(key)))
+        for i, name in enumerate(key):
+            namespace[name] = _field(i, name)
+        cls = _types[key] = type("Record", (Record,), namespace)
+    return cls
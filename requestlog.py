@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# requestlog.py
+"""
+Request logging that stays off the request path.
+
+Log records are put on a bounded in-memory queue (QueueHandler) and
+written out by one background thread (QueueListener), so a request
+never waits on stdout or the log drain. When the queue is full, records
+are dropped and counted rather than blocking.
+
+Each request gets a RequestStats in which the database helpers count
+queries, rows and time spent. At the end of the request one line is
+logged for it, in key=value form:
+
+    at=request method=GET endpoint=apps status=200 ms=12.4 queries=2 rows=21 db_ms=7.9
+
+To keep the volume down, only a sample_rate fraction of requests is
+logged, plus every slow (slower than slow_ms) or failed one. Per-endpoint
+totals are kept for all requests regardless (EndpointStats).
+
+Python 2 has no logging.handlers.QueueHandler, hence the two classes
+below (after the ones in Python 3).
+"""
+import logging
+import os
+import Queue
+import random
+import sys
+import threading
+import time
+
+
+class QueueHandler(logging.Handler):
+    """Put records on a queue without ever blocking."""
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Format now, in the caller's thread: args may change later.
+        record.msg = self.format(record)
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """Hand the records on a queue to handlers, from a daemon thread."""
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self._pid = None
+
+    def start(self):
+        """Start the thread, unless this process already has it.
+
+        Threads do not survive fork(), so a worker forked from a process
+        that already started one (gunicorn --preload) starts its own.
+        """
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        thread = threading.Thread(target=self._run, name="QueueListener")
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Format 'fields' given as extra= as key=value pairs after the message."""
+
+    def format(self, record):
+        text = logging.Formatter.format(self, record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            text = " ".join([text] + ["%s=%s" % (k, _value(fields[k]))
+                                      for k in sorted(fields)])
+        return text
+
+
+def _value(v):
+    if isinstance(v, float):
+        return "%.1f" % v
+    v = "%s" % v
+    if " " in v or '"' in v:
+        return '"%s"' % v.replace('"', '\\"')
+    return v
+
+
+class RequestStats(object):
+    """Counters for one request, filled in by the database helpers."""
+    __slots__ = ("start", "queries", "rows", "db_seconds")
+
+    def __init__(self):
+        self.start = time.time()
+        self.queries = 0
+        self.rows = 0
+        self.db_seconds = 0.0
+
+    def query(self, seconds, rows=0):
+        self.queries += 1
+        self.db_seconds += seconds
+        self.rows += rows
+
+
+class EndpointStats(object):
+    """Totals per endpoint across every request of this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}  # endpoint -> [requests, seconds, max, queries, rows]
+
+    def add(self, endpoint, seconds, stats):
+        with self._lock:
+            t = self._totals.setdefault(endpoint, [0, 0.0, 0.0, 0, 0])
+            t[0] += 1
+            t[1] += seconds
+            t[2] = max(t[2], seconds)
+            t[3] += stats.queries
+            t[4] += stats.rows
+
+    def stats(self):
+        """Return {endpoint: {requests:, mean_ms:, max_ms:, queries:, rows:}}."""
+        with self._lock:
+            return dict((endpoint, dict(requests=n,
+                                        mean_ms=1000 * total / n,
+                                        max_ms=1000 * longest,
+                                        queries=queries, rows=rows))
+                        for endpoint, (n, total, longest, queries, rows)
+                        in self._totals.items())
+
+
+class RequestLogger(object):
+    """Decides which requests to log, and logs them.
+
+    Keyword arguments
+    logger -- the logging.Logger to write to.
+    sample_rate -- fraction (0 to 1) of ordinary requests to log.
+    slow_ms -- requests slower than this are always logged.
+    """
+    def __init__(self, logger, sample_rate=1.0, slow_ms=500):
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.endpoints = EndpointStats()
+
+    def finish(self, method, endpoint, status, stats):
+        """Record a finished request, logging it if sampled."""
+        seconds = time.time() - stats.start
+        self.endpoints.add(endpoint, seconds, stats)
+        ms = 1000 * seconds
+        if status >= 500:
+            level = logging.ERROR
+        elif ms > self.slow_ms:
+            level = logging.WARNING
+        elif random.random() < self.sample_rate:
+            level = logging.INFO
+        else:
+            return
+        self.logger.log(level, "at=request", extra=dict(fields=dict(
+                method=method, endpoint=endpoint, status=status, ms=ms,
+                queries=stats.queries, rows=stats.rows,
+                db_ms=1000 * stats.db_seconds)))
+
+
+def setup(name, level="INFO", queue_size=10000, stream=None):
+    """Send the logs of logger 'name' (and its children) through a queue.
+
+    Return the QueueListener, which must be start()ed in each process;
+    until then records wait on the queue.
+    """
+    queue = Queue.Queue(queue_size)
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter("%(message)s"))
+    handler = QueueHandler(queue)
+    handler.setFormatter(KeyValueFormatter(
+            "level=%(levelname)s logger=%(name)s %(message)s"))
+    logger = logging.getLogger(name)
+    logger.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+    logger.addHandler(handler)
+    logger.propagate = False
+    return QueueListener(queue, output)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# sessions.py
+"""
+Server-side sessions, stored in session_lookup.
+
+The cookie holds only a random session id and a version number, signed
+with the app's secret key:
+
+    session=<session id>.<version>.<signature>
+
+The session's contents (for us, session['user']) live in
+session_lookup.data as JSON. Each process keeps the sessions it has
+seen in an LRUCache, so most requests read no table at all:
+
+    store = SessionStore(pool, cache.LRUCache(max_entries=10000))
+    app.session_interface = ServerSessionInterface(store)
+
+Every change to a session bumps its version and sends a new cookie, so
+a cached copy is used only if it is at least as new as the version the
+browser holds; whichever worker the next request lands on, it never
+sees older data than the browser has been sent. A session deleted
+elsewhere (at logout) can still be found in another worker's cache,
+for up to user_ttl seconds if someone is logged in to it, though its
+cookie is gone from the browser; requests that may change something
+(any but GET, HEAD and OPTIONS) always read the table, so they never
+act on such a session.
+
+Logging in moves the session to a new id (ServerSession.regenerate()),
+so an id planted in a browser before the login is worth nothing after.
+
+session_lookup.last_seen is updated at most every touch_every seconds;
+sessions not seen for 'lifetime' seconds are expired (see purge()).
+"""
+import base64
+import json
+import os
+import time
+
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """A session whose contents are kept in session_lookup."""
+
+    def __init__(self, initial=None, sid=None, version=0, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.version = version
+        self.new = new
+        self.modified = False
+        self.replaced = None
+
+    def regenerate(self):
+        """Move the contents to a new session id (call at login); the
+        old session is deleted when this one is saved."""
+        if not self.new and self.replaced is None:
+            self.replaced = self.sid
+        self.sid = new_session_id()
+        self.version = 0
+        self.modified = True
+
+
+class SessionStore(object):
+    """session_lookup rows, with the hot ones cached in-process.
+
+    Keyword arguments
+    pool -- a dbpool.ConnectionPool.
+    cache -- a cache.LRUCache for session contents.
+    ttl -- seconds a session stays cached without being used.
+    user_ttl -- the same, for a session with someone logged in to it.
+    lifetime -- seconds of inactivity after which a session expires.
+    touch_every -- seconds between updates of last_seen.
+    """
+    def __init__(self, pool, cache, ttl=300, user_ttl=30,
+                 lifetime=30 * 86400, touch_every=300):
+        self.pool = pool
+        self.cache = cache
+        self.ttl = ttl
+        self.user_ttl = user_ttl
+        self.lifetime = lifetime
+        self.touch_every = touch_every
+
+    def _execute(self, query, args, fetch=False):
+        db = self.pool.getconn()
+        try:
+            cur = db.cursor()
+            cur.execute(query, args)
+            rows = cur.fetchall() if fetch else cur.rowcount
+            db.commit()
+            cur.close()
+            return rows
+        finally:
+            self.pool.putconn(db)
+
+    def _cache(self, sid, entry):
+        ttl = self.user_ttl if entry["data"].get("user") else self.ttl
+        self.cache.set(sid, entry, ttl=ttl)
+
+    def load(self, sid, version, verify=False):
+        """Return (version, contents) of session sid, or None.
+
+        version is the one in the cookie; any copy at least that new
+        will do, since the browser cannot know of anything newer. With
+        verify set, the table is read even so, to be sure the session
+        has not been deleted (or changed) by another process.
+        """
+        entry = self.cache.get(sid)
+        if verify or entry is None or entry["version"] < version:
+            rows = self._execute("""
+                SELECT version, data, extract(epoch FROM last_seen)
+                FROM session_lookup
+                WHERE session_id = %s
+                  AND last_seen > now() - %s * interval '1 second';""",
+                [sid, self.lifetime], fetch=True)
+            if not rows or rows[0][0] < version:
+                return None
+            entry = dict(version=rows[0][0], data=json.loads(rows[0][1]),
+                         last_seen=float(rows[0][2]))
+        if time.time() - entry["last_seen"] > self.touch_every:
+            self._execute("""UPDATE session_lookup SET last_seen = now()
+                             WHERE session_id = %s;""", [sid])
+            entry["last_seen"] = time.time()
+        self._cache(sid, entry)
+        return entry["version"], entry["data"]
+
+    def save(self, sid, data, user_id=None):
+        """Store data as the new contents of session sid.
+
+        Return the session's new version. Versions are counted in the
+        table, so two workers saving the same session both move it on.
+        """
+        text = json.dumps(data)
+        rows = self._execute("""
+            UPDATE session_lookup
+            SET version = version + 1, data = %s, user_id = %s,
+                last_seen = now()
+            WHERE session_id = %s
+            RETURNING version;""", [text, user_id, sid], fetch=True)
+        if rows:
+            version = rows[0][0]
+        else:
+            version = 1
+            self._execute("""
+                INSERT INTO session_lookup
+                  (session_id, version, data, user_id, session_start, last_seen)
+                VALUES (%s, %s, %s, %s, now(), now());""",
+                [sid, version, text, user_id])
+        self._cache(sid, dict(version=version, data=data,
+                              last_seen=time.time()))
+        return version
+
+    def delete(self, sid):
+        self.cache.delete(sid)
+        self._execute("DELETE FROM session_lookup WHERE session_id = %s;",
+                      [sid])
+
+    def purge(self):
+        """Delete the expired sessions; return how many there were."""
+        return self._execute("""
+            DELETE FROM session_lookup
+            WHERE last_seen < now() - %s * interval '1 second';""",
+            [self.lifetime])
+
+
+class ServerSessionInterface(SessionInterface):
+    """Flask session interface over a SessionStore."""
+    salt = "appcurator-session"
+    safe_methods = frozenset(["GET", "HEAD", "OPTIONS"])
+
+    def __init__(self, store):
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt=self.salt)
+
+    def open_session(self, app, request):
+        if not app.secret_key:
+            return None
+        cookie = request.cookies.get(app.session_cookie_name)
+        if cookie:
+            try:
+                sid, version = self._signer(app).unsign(cookie).rsplit(".", 1)
+                found = self.store.load(
+                        sid, int(version),
+                        verify=request.method not in self.safe_methods)
+            except (BadSignature, ValueError):
+                found = None
+            if found is not None:
+                return ServerSession(found[1], sid=sid, version=found[0])
+        return ServerSession(sid=new_session_id(), new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.replaced is not None:
+            self.store.delete(session.replaced)
+            session.replaced = None
+        if not session:
+            if not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+        user_id = (session.get("user") or {}).get("user_id")
+        session.version = self.store.save(session.sid, dict(session), user_id)
+        cookie = self._signer(app).sign(
+                "%s.%d" % (session.sid, session.version))
+        response.set_cookie(app.session_cookie_name, cookie,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app))
+
+
+def new_session_id():
+    """Return a random, URL-safe session id (256 bits)."""
+    return base64.urlsafe_b64encode(os.urandom(32)).rstrip("=")
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# snapshot.py
+"""
+A read-only, memory-mapped snapshot of the catalog, so the anonymous
+/apps/ pages can be served without the database.
+
+The exporter writes, in one REPEATABLE READ transaction,
+
+    summaries   app_summaries, by app_id
+    reviews     the first page of each app's reviews (get_reviews_page)
+    top_tags    top_tags_view
+    tags        every tag, with the ids of the apps filed under it or
+                under any tag below it (as /apps/?tags=... finds them)
+
+to one file, column by column: integers and floats as packed arrays,
+text as one UTF-8 blob plus an array of offsets. Nothing is parsed when
+the file is opened except a small JSON directory at its head; a row is
+read by unpacking its few values straight from the mapping, and an app
+is found by bisecting the sorted app_id column. The pages are the
+operating system's, so every worker on the machine shares one copy.
+
+    python snapshot.py /tmp/appcurator.snapshot            # once
+    python snapshot.py /tmp/appcurator.snapshot --every 300
+
+The file is replaced atomically (written aside, then renamed), and
+SnapshotReader picks up the new one within check_every seconds:
+
+    reader = SnapshotReader("/tmp/appcurator.snapshot")
+    snap = reader.current()          # a Snapshot, or None
+    snap.app_summary(42)             # {'app_id': 42, 'name': ...} or None
+
+As with delete_nulls_dict(), NULL values are left out of the rows.
+"""
+import bisect
+import datetime
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+import pg8000
+
+
+log = logging.getLogger("appcurator.snapshot")
+
+MAGIC = "APPSNAP1"
+INT_NULL = -2**63
+
+TOP_TAGS_QUERY = """
+    SELECT category_name, app_id, app_counts FROM top_tags_view
+    """
+
+TAG_APPS_QUERY = """
+    SELECT lower(tag.category_name),
+           array_agg(DISTINCT at.app_id ORDER BY at.app_id)
+    FROM tag
+    JOIN tag_closure AS tc
+      ON tc.ancestor_id = tag.category_id
+    JOIN app_tag AS at
+      ON at.category_id = tc.descendant_id
+    GROUP BY lower(tag.category_name)
+    """
+
+
+## ----------------------------------------------------------- Writing ----- ##
+def _pad(n):
+    return "\0" * (-n % 8)
+
+
+def _encode_column(values):
+    """Return (kind, [packed parts]) for a column of values.
+
+    The kind is taken from the first value that is not None: integers
+    ('int'), floats and Decimals ('float'), or else text ('text'; dates
+    are written as YYYY-MM-DD).
+    """
+    sample = next((v for v in values if v is not None), "")
+    n = len(values)
+    if isinstance(sample, (int, long)) and not isinstance(sample, bool):
+        return "int", [struct.pack("<%dq" % n, *[
+                INT_NULL if v is None else v for v in values])]
+    if not isinstance(sample, (basestring, datetime.date)):
+        return "float", [struct.pack("<%dd" % n, *[
+                float("nan") if v is None else float(v) for v in values])]
+    texts = []
+    for v in values:
+        if isinstance(v, datetime.date):
+            v = v.isoformat()
+        texts.append(v.encode("utf-8") if isinstance(v, unicode) else v)
+    offsets = [0]
+    for t in texts:
+        offsets.append(offsets[-1] + len(t or ""))
+    nulls = "".join("\1" if t is None else "\0" for t in texts)
+    return "text", [struct.pack("<%dI" % (n + 1), *offsets), nulls,
+                    "".join(t for t in texts if t)]
+
+
+def write(path, tables, info=None):
+    """Write tables to path, atomically.
+
+    tables is {name: (columns, rows)}, rows being tuples in the order
+    of columns; info is a dictionary kept in the directory as it is.
+    """
+    directory = dict(info or {}, tables={})
+    parts = []
+    offset = 0
+    for name, (columns, rows) in tables.items():
+        table = directory["tables"][name] = dict(n=len(rows), columns=[])
+        for i, column in enumerate(columns):
+            kind, packed = _encode_column([row[i] for row in rows])
+            spec = dict(name=column, kind=kind, offsets=[])
+            for part in packed:
+                spec["offsets"].append(offset)
+                parts += [part, _pad(len(part))]
+                offset += len(part) + len(_pad(len(part)))
+            table["columns"].append(spec)
+    head = json.dumps(directory)
+    head += " " * (-(len(MAGIC) + 4 + len(head)) % 8)
+
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", len(head)) + head)
+        for part in parts:
+            f.write(part)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+    return len(MAGIC) + 4 + len(head) + offset
+
+
+def export(db, path, summary_query, summary_columns, review_columns,
+           reviews_per_app):
+    """Write the catalog, as read on the connection db, to path.
+
+    summary_query and summary_columns are those of the app summaries
+    (APP_SUMMARY_QUERY in appcurator.py); review_columns those of
+    get_reviews_page(). Each app gets reviews_per_app reviews.
+    Return the number of bytes written.
+    """
+    cur = db.cursor()
+    try:
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY;")
+        cur.execute(summary_query + " ORDER BY app_id;")
+        summaries = [tuple(row) for row in cur.fetchall()]
+        cur.execute("""
+            SELECT s.app_id, %s
+            FROM app_summaries AS s,
+                 LATERAL get_reviews_page(s.app_id, NULL::date,
+                                          NULL::integer, %%s) AS r
+            ORDER BY s.app_id, r.sort_date DESC, r.review_id DESC;""" %
+            ", ".join("r.%s" % c for c in review_columns), [reviews_per_app])
+        reviews = [tuple(row) for row in cur.fetchall()]
+        cur.execute(TOP_TAGS_QUERY)
+        top_tags = [tuple(row) for row in cur.fetchall()]
+        cur.execute(TAG_APPS_QUERY)
+        tag_apps = sorted((row[0], row[1]) for row in cur.fetchall())
+        db.commit()
+    except pg8000.Error:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
+
+    # Each app's reviews are rows [start, end) of the reviews table,
+    # and each tag's apps rows [start, end) of tag_apps.
+    app_index = summary_columns.index("app_id")
+    version_index = summary_columns.index("version")
+    ranges = {}
+    for i, row in enumerate(reviews):
+        start, end = ranges.get(row[0], (i, i))
+        ranges[row[0]] = (start, i + 1)
+    summaries = [row + ranges.get(row[app_index], (0, 0)) for row in summaries]
+    tag_rows, tag_app_ids = [], []
+    for name, app_ids in tag_apps:
+        tag_rows.append((name, len(tag_app_ids), len(tag_app_ids) + len(app_ids)))
+        tag_app_ids += [(app_id,) for app_id in app_ids]
+
+    return write(path, dict(
+            summaries=(summary_columns + ["_reviews_start", "_reviews_end"],
+                       summaries),
+            reviews=(review_columns, [row[1:] for row in reviews]),
+            top_tags=(["name", "app_id", "n_apps"], top_tags),
+            tags=(["name", "_start", "_end"], tag_rows),
+            tag_apps=(["app_id"], tag_app_ids)),
+        info=dict(created=time.time(), reviews_per_app=reviews_per_app,
+                  last_version=max([row[version_index] for row in summaries
+                                    if row[version_index] is not None] or [0])))
+
+
+## ----------------------------------------------------------- Reading ----- ##
+class Column(object):
+    """One column of a mapped snapshot, indexable like a list."""
+
+    def __init__(self, buf, base, spec, n):
+        self.buf = buf
+        self.n = n
+        self.kind = spec["kind"]
+        self.offsets = [base + o for o in spec["offsets"]]
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        if self.kind == "int":
+            value = struct.unpack_from("<q", self.buf, self.offsets[0] + 8 * i)[0]
+            return None if value == INT_NULL else value
+        elif self.kind == "float":
+            value = struct.unpack_from("<d", self.buf, self.offsets[0] + 8 * i)[0]
+            return None if value != value else value
+        if self.buf[self.offsets[1] + i] == "\1":
+            return None
+        start, end = struct.unpack_from("<II", self.buf, self.offsets[0] + 4 * i)
+        return self.buf[self.offsets[2] + start:self.offsets[2] + end].decode("utf-8")
+
+
+class Table(object):
+    """The columns of one table of a mapped snapshot."""
+
+    def __init__(self, buf, base, spec):
+        self.n = spec["n"]
+        self.columns = [(str(c["name"]), Column(buf, base, c, self.n))
+                        for c in spec["columns"]]
+        self.column = dict(self.columns)
+
+    def __len__(self):
+        return self.n
+
+    def row(self, i):
+        """Return row i as a dictionary, without None values or the
+        (underscored) internal columns."""
+        row = {}
+        for name, column in self.columns:
+            if not name.startswith("_"):
+                value = column[i]
+                if value is not None:
+                    row[name] = value
+        return row
+
+
+class Snapshot(object):
+    """A snapshot file, mapped into memory."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.stat = os.fstat(f.fileno())
+        if self.buf[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a snapshot" % path)
+        size = struct.unpack_from("<I", self.buf, len(MAGIC))[0]
+        base = len(MAGIC) + 4 + size
+        self.info = json.loads(self.buf[len(MAGIC) + 4:base])
+        self.tables = dict((name, Table(self.buf, base, spec))
+                           for name, spec in self.info["tables"].items())
+
+    def _find(self, table, column, key):
+        """Return the row of table whose (sorted) column is key, or None."""
+        values = self.tables[table].column[column]
+        i = bisect.bisect_left(values, key)
+        if i < len(values) and values[i] == key:
+            return i
+        return None
+
+    def __len__(self):
+        """Return the number of apps."""
+        return len(self.tables["summaries"])
+
+    def has_app(self, app_id):
+        return self._find("summaries", "app_id", app_id) is not None
+
+    def has_tag(self, tag):
+        return self._find("tags", "name", tag) is not None
+
+    def app_summary(self, app_id):
+        """Return the summary of app app_id, or None if it is not here."""
+        i = self._find("summaries", "app_id", app_id)
+        return self.tables["summaries"].row(i) if i is not None else None
+
+    def app_summaries(self, app_ids):
+        """Return the summaries of those of app_ids that are here."""
+        return filter(None, [self.app_summary(app_id) for app_id in app_ids])
+
+    def reviews(self, app_id):
+        """Return the first reviews of app app_id (see reviews_per_app),
+        or None if it is not here."""
+        i = self._find("summaries", "app_id", app_id)
+        if i is None:
+            return None
+        summaries = self.tables["summaries"].column
+        reviews = self.tables["reviews"]
+        return [reviews.row(j) for j in xrange(
+                summaries["_reviews_start"][i], summaries["_reviews_end"][i])]
+
+    def top_tags(self):
+        table = self.tables["top_tags"]
+        return [table.row(i) for i in xrange(len(table))]
+
+    def tag_app_ids(self, tag):
+        """Return the sorted ids of the apps under tag (lower case),
+        or None if there is no such tag."""
+        i = self._find("tags", "name", tag)
+        if i is None:
+            return None
+        tags = self.tables["tags"].column
+        app_ids = self.tables["tag_apps"].column["app_id"]
+        return [app_ids[j] for j in xrange(tags["_start"][i], tags["_end"][i])]
+
+
+class SnapshotReader(object):
+    """The latest snapshot at path, reopened when the file is replaced.
+
+    Keyword arguments
+    check_every -- seconds between checks for a new file.
+    on_change -- called with no arguments after a new file is opened.
+    """
+    def __init__(self, path, check_every=5, on_change=None):
+        self.path = path
+        self.check_every = check_every
+        self.on_change = on_change
+        self.loads = 0
+        self._snapshot = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def current(self):
+        """Return the latest Snapshot, or None if there is none."""
+        if time.time() - self._checked >= self.check_every:
+            if self._lock.acquire(False):
+                try:
+                    self._check()
+                finally:
+                    self._lock.release()
+        return self._snapshot
+
+    def _check(self):
+        """Call with the lock held."""
+        self._checked = time.time()
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        old = self._snapshot
+        if old is not None and (stat.st_ino, stat.st_mtime) == (
+                old.stat.st_ino, old.stat.st_mtime):
+            return
+        try:
+            # The old mapping is unmapped once no request uses it.
+            self._snapshot = Snapshot(self.path)
+        except (IOError, OSError, ValueError, KeyError) as e:
+            log.warning("at=snapshot_failed path=%s error=%s", self.path, e)
+            return
+        self.loads += 1
+        if self.on_change is not None:
+            self.on_change()
+
+
+if __name__ == "__main__":
+    import argparse
+    from appcurator import (conf, APP_REVIEWS, APP_SUMMARY_COLUMNS,
+                            APP_SUMMARY_QUERY, REVIEWS_PAGE_SIZE)
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("path", nargs="?",
+            default=getattr(conf, 'SNAPSHOT_PATH', None),
+            help="the snapshot file (default: SNAPSHOT_PATH)")
+    parser.add_argument("--every", type=int, default=0,
+            help="export again every this many seconds (0 = once)")
+    args = parser.parse_args()
+    if not args.path:
+        parser.error("no path given, and SNAPSHOT_PATH is not set")
+
+    # When started by gunicorn (see gunicorn_sync.py), stop once it is gone.
+    parent = os.getppid()
+    while True:
+        start = time.time()
+        db = conf.connect_db()
+        try:
+            # One more review than a page, to know if there are more.
+            size = export(db, args.path, APP_SUMMARY_QUERY,
+                          APP_SUMMARY_COLUMNS, APP_REVIEWS.columns,
+                          REVIEWS_PAGE_SIZE + 1)
+            print "Wrote %s (%d bytes) in %.1f s." % (
+                    args.path, size, time.time() - start)
+        except pg8000.Error as e:
+            if args.every <= 0:
+                raise
+            print "Failed (%s); trying again in %d s." % (e, args.every)
+        finally:
+            db.close()
+        if args.every <= 0:
+            break
+        time.sleep(args.every)
+        if os.getppid() != parent:
+            break
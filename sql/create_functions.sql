@@ -45,23 +45,68 @@ CREATE OR REPLACE FUNCTION
 $$ LANGUAGE SQL;
 
 
+/* One page of get_reviews($1), newest first.
+ *
+ * Keyset pagination: pass the (sort_date, review_id) of the last review
+ * on the previous page as $2, $3 (NULL, NULL for the first page), and
+ * the page size as $4. Every page is a range scan of
+ * app_review_app_date_idx, so page N costs the same as page 1.
+ */
+CREATE OR REPLACE FUNCTION
+  get_reviews_page(integer, date, integer, integer) RETURNS TABLE (
+      nickname varchar,
+      avatar varchar,
+      platform varchar,
+      user_role role,
+      usability int,
+      effectiveness int,
+      review varchar,
+      review_date varchar,
+      sort_date date,
+      review_id integer
+      ) AS $$
+
+  SELECT nickname, avatar, platform, user_role,
+    CASE WHEN usability = 'bad' THEN 1
+         WHEN usability = 'ok' THEN 2
+         ELSE 3
+    END AS usability,
+    CASE WHEN effectiveness = 'bad' THEN 1
+         WHEN effectiveness = 'ok' THEN 2
+         ELSE 3
+    END AS effectiveness,
+    review,
+    to_char(ar.review_date, 'FMDD Mon YYYY') as review_date,
+    ar.review_date AS sort_date,
+    ar.review_id
+  FROM app_review AS ar
+  JOIN user_details AS u
+    ON u.user_id = ar.user_id
+  LEFT JOIN platform AS p
+    ON p.platform_id = ar.platform_id
+  WHERE ar.app_id = $1
+    AND (ar.review_date, ar.review_id) <
+        (COALESCE($2, 'infinity'::date), COALESCE($3, 2147483647))
+  ORDER BY ar.review_date DESC, ar.review_id DESC
+  LIMIT $4;
+
+$$ LANGUAGE SQL STABLE;
+
+
+/* The users who may act for user $1, directly or through others.
+ * Reads user_closure, which trigger_user_closure() keeps current.
+ */
 CREATE OR REPLACE FUNCTION
   get_authorized_users(integer) RETURNS SETOF integer AS $$
 
-  WITH RECURSIVE q AS (
-      SELECT parent_id, sub_id
-        FROM user_hierarchy
-        WHERE parent_id = $1
-      UNION
-      SELECT uh.parent_id, uh.sub_id
-        FROM user_hierarchy uh
-        JOIN q ON q.sub_id = uh.parent_id
-  )
-  SELECT sub_id FROM q AS answer;
+  SELECT descendant_id FROM user_closure WHERE ancestor_id = $1;
 
-$$ LANGUAGE SQL;
+$$ LANGUAGE SQL STABLE;
 
 
+/* Add tag $1 below the tag named $2 (or at the top level if NULL).
+ * The tag_closure rows are added by trigger_tag_closure().
+ */
 CREATE OR REPLACE FUNCTION
   insert_tag(varchar, varchar) RETURNS BOOLEAN AS $$
 
@@ -92,18 +137,60 @@ CREATE OR REPLACE FUNCTION
 $$ LANGUAGE 'plpgsql';
 
 
+/* The users whom user $1 may act for, directly or through others. */
 CREATE OR REPLACE FUNCTION
   is_authorized_for(integer) RETURNS SETOF integer AS $$
 
-  WITH RECURSIVE q AS (
-      SELECT parent_id, sub_id
-        FROM user_hierarchy
-        WHERE sub_id = $1
-      UNION
-      SELECT uh.parent_id, uh.sub_id
-        FROM user_hierarchy uh
-        JOIN q ON q.parent_id = uh.sub_id
-  )
-  SELECT parent_id FROM q AS answer;
+  SELECT ancestor_id FROM user_closure WHERE descendant_id = $1;
 
-$$ LANGUAGE SQL;
+$$ LANGUAGE SQL STABLE;
+
+
+/* May user $1 act for user $2? Everyone may act for themselves. One
+ * primary key lookup on user_closure.
+ */
+CREATE OR REPLACE FUNCTION
+  may_act_for(integer, integer) RETURNS boolean AS $$
+
+  SELECT $1 = $2 OR EXISTS (SELECT 1 FROM user_closure
+                            WHERE ancestor_id = $2 AND descendant_id = $1);
+
+$$ LANGUAGE SQL STABLE;
+
+
+/* Search the apps: the best $3 matches of the search text $1 among at
+ * most $2 candidates, best first.
+ *
+ * $1 is a tsquery in to_tsquery() syntax ('heart:* & rate:*' for
+ * typeahead prefixes; see search_query() in appcurator.py). Matches
+ * come from the GIN index on app_summaries.document. The text rank is
+ * boosted by the number of recommendations and by the best rating.
+ *
+ * ts_rank() reads each match's whole document, so for very broad
+ * queries only the $2 most recommended matches are ranked (ordering by
+ * a column is cheap). Up to $2 matches the order is the exact rank;
+ * beyond, a well-matching app with few recommendations can be missed.
+ */
+CREATE OR REPLACE FUNCTION
+  search_apps(text, integer, integer) RETURNS TABLE (
+      found_app_id integer,
+      rank real
+      ) AS $$
+
+  SELECT app_id,
+    (ts_rank(document, q, 1) *
+     (1 + ln(1 + recommendations)) *
+     (1 + coalesce(greatest(user_usability, provider_usability,
+                            user_effectiveness, provider_effectiveness),
+                   2) / 3))::real AS rank
+  FROM (SELECT app_id, document, recommendations,
+               user_usability, provider_usability,
+               user_effectiveness, provider_effectiveness, q
+          FROM app_summaries, to_tsquery('english', $1) AS q
+          WHERE document @@ q
+          ORDER BY recommendations DESC, app_id
+          LIMIT $2) AS candidates
+  ORDER BY rank DESC, app_id
+  LIMIT $3;
+
+$$ LANGUAGE SQL STABLE;
@@ -19,17 +19,115 @@ CREATE TABLE IF NOT EXISTS user_details (
 );
 
 
+/* Server-side sessions (see sessions.py): the cookie holds only
+ * session_id and version; data is the session's contents as JSON.
+ */
 CREATE TABLE IF NOT EXISTS session_lookup (
-  session_start timestamp with time zone NOT NULL,
-  facebook_user_id bigint UNIQUE NOT NULL,
-  user_id int REFERENCES user_details (user_id)
+  session_id varchar(64) PRIMARY KEY,
+  version int NOT NULL DEFAULT 1,
+  data text NOT NULL DEFAULT '{}',
+  session_start timestamp with time zone NOT NULL DEFAULT now(),
+  last_seen timestamp with time zone NOT NULL DEFAULT now(),
+  facebook_user_id bigint UNIQUE,
+  user_id int REFERENCES user_details (user_id) ON DELETE CASCADE
 );
+CREATE INDEX session_lookup_user_idx ON session_lookup (user_id);
+CREATE INDEX session_lookup_last_seen_idx ON session_lookup (last_seen);
 
 
+/* sub_id may act for parent_id (e.g. a nurse for a doctor), and so
+ * for everyone parent_id may act for.
+ */
 CREATE TABLE IF NOT EXISTS user_hierarchy (
-  parent_id int REFERENCES user_details (user_id),
-  sub_id int REFERENCES user_details (user_id)
+  parent_id int REFERENCES user_details (user_id) ON DELETE CASCADE NOT NULL,
+  sub_id int REFERENCES user_details (user_id) ON DELETE CASCADE NOT NULL,
+  PRIMARY KEY (parent_id, sub_id),
+  CHECK (parent_id <> sub_id)
+);
+CREATE INDEX user_hierarchy_sub_idx ON user_hierarchy (sub_id);
+
+/* Every (ancestor, descendant) pair of user_hierarchy, i.e. every user
+ * (descendant_id) who may act for another (ancestor_id), directly or
+ * through others. A user may have several parents, so there may be
+ * several paths between two users: 'paths' counts them, so that
+ * removing one edge removes only the pairs that no other path joins.
+ * Kept current by trigger_user_closure(); nothing walks the hierarchy
+ * recursively at query time.
+ */
+CREATE TABLE IF NOT EXISTS user_closure (
+  ancestor_id int REFERENCES user_details (user_id) ON DELETE CASCADE NOT NULL,
+  descendant_id int REFERENCES user_details (user_id) ON DELETE CASCADE NOT NULL,
+  paths bigint NOT NULL,
+  PRIMARY KEY (ancestor_id, descendant_id)
 );
+CREATE INDEX user_closure_descendant_idx ON user_closure (descendant_id);
+
+CREATE OR REPLACE FUNCTION trigger_user_closure() RETURNS TRIGGER
+AS $trigger_user_closure$
+   BEGIN
+      -- Writers take turns, so the path counts stay exact.
+      LOCK TABLE user_closure IN SHARE ROW EXCLUSIVE MODE;
+
+      IF (TG_OP = 'DELETE' OR TG_OP = 'UPDATE') THEN
+        -- Every path through the old edge: (ancestors of its parent,
+        -- and the parent) x (the sub, and its descendants).
+        WITH pairs AS (
+          SELECT a.ancestor_id, d.descendant_id, a.paths * d.paths AS paths
+            FROM (SELECT ancestor_id, paths FROM user_closure
+                   WHERE descendant_id = OLD.parent_id
+                  UNION ALL SELECT OLD.parent_id, 1) AS a
+            CROSS JOIN
+                 (SELECT descendant_id, paths FROM user_closure
+                   WHERE ancestor_id = OLD.sub_id
+                  UNION ALL SELECT OLD.sub_id, 1) AS d
+        )
+        UPDATE user_closure AS c
+          SET paths = c.paths - p.paths
+          FROM pairs AS p
+          WHERE c.ancestor_id = p.ancestor_id
+            AND c.descendant_id = p.descendant_id;
+        DELETE FROM user_closure WHERE paths <= 0;
+      END IF;
+
+      IF (TG_OP = 'INSERT' OR TG_OP = 'UPDATE') THEN
+        IF EXISTS (SELECT 1 FROM user_closure
+                   WHERE ancestor_id = NEW.sub_id
+                     AND descendant_id = NEW.parent_id) THEN
+          RAISE EXCEPTION 'User % already acts for user %; no cycles.',
+            NEW.parent_id, NEW.sub_id;
+        END IF;
+        WITH pairs AS (
+          SELECT a.ancestor_id, d.descendant_id, a.paths * d.paths AS paths
+            FROM (SELECT ancestor_id, paths FROM user_closure
+                   WHERE descendant_id = NEW.parent_id
+                  UNION ALL SELECT NEW.parent_id, 1) AS a
+            CROSS JOIN
+                 (SELECT descendant_id, paths FROM user_closure
+                   WHERE ancestor_id = NEW.sub_id
+                  UNION ALL SELECT NEW.sub_id, 1) AS d
+        ), updated AS (
+          UPDATE user_closure AS c
+            SET paths = c.paths + p.paths
+            FROM pairs AS p
+            WHERE c.ancestor_id = p.ancestor_id
+              AND c.descendant_id = p.descendant_id
+            RETURNING c.ancestor_id, c.descendant_id
+        )
+        INSERT INTO user_closure (ancestor_id, descendant_id, paths)
+          SELECT p.ancestor_id, p.descendant_id, p.paths
+            FROM pairs AS p
+            WHERE NOT EXISTS (SELECT 1 FROM updated AS u
+                              WHERE u.ancestor_id = p.ancestor_id
+                                AND u.descendant_id = p.descendant_id);
+      END IF;
+      RETURN NULL;
+   END;
+$trigger_user_closure$
+LANGUAGE plpgsql;
+
+CREATE TRIGGER user_closure_trigger
+  AFTER INSERT OR DELETE OR UPDATE ON user_hierarchy
+  FOR EACH ROW EXECUTE PROCEDURE trigger_user_closure();
 
 
 CREATE TABLE IF NOT EXISTS organization_details (
@@ -61,11 +159,72 @@ CREATE TABLE IF NOT EXISTS tag (
   category_name varchar(128) UNIQUE NOT NULL
 );
 
+/* Case-insensitive lookup of tags by name. */
+CREATE INDEX tag_lower_name_idx ON tag (lower(category_name));
+
+/* Every (ancestor, descendant) pair in the tag tree, including each tag
+ * paired with itself at depth 0. Kept current by trigger_tag_closure()
+ * on every insert into (e.g. by insert_tag()) or move within 'tag', so
+ * nothing has to walk the tree recursively at query time.
+ */
+CREATE TABLE IF NOT EXISTS tag_closure (
+  ancestor_id int REFERENCES tag (category_id) ON DELETE CASCADE NOT NULL,
+  descendant_id int REFERENCES tag (category_id) ON DELETE CASCADE NOT NULL,
+  depth int NOT NULL,
+  PRIMARY KEY (ancestor_id, descendant_id)
+);
+
+CREATE INDEX tag_closure_descendant_idx ON tag_closure (descendant_id);
+
+CREATE OR REPLACE FUNCTION trigger_tag_closure() RETURNS TRIGGER
+AS $trigger_tag_closure$
+   BEGIN
+      IF (TG_OP = 'INSERT') THEN
+        INSERT INTO tag_closure (ancestor_id, descendant_id, depth)
+          SELECT NEW.category_id, NEW.category_id, 0
+          UNION ALL
+          SELECT ancestor_id, NEW.category_id, depth + 1
+            FROM tag_closure
+            WHERE descendant_id = NEW.parent_category_id;
+
+      ELSIF (NEW.parent_category_id IS DISTINCT FROM OLD.parent_category_id) THEN
+        -- Move the subtree rooted at NEW.category_id.
+        IF EXISTS (SELECT 1 FROM tag_closure
+                   WHERE ancestor_id = NEW.category_id
+                     AND descendant_id = NEW.parent_category_id) THEN
+          RAISE EXCEPTION 'Tag % cannot be moved below itself.', NEW.category_name;
+        END IF;
+
+        DELETE FROM tag_closure
+          WHERE descendant_id IN (SELECT descendant_id FROM tag_closure
+                                  WHERE ancestor_id = NEW.category_id)
+            AND ancestor_id NOT IN (SELECT descendant_id FROM tag_closure
+                                    WHERE ancestor_id = NEW.category_id);
+
+        INSERT INTO tag_closure (ancestor_id, descendant_id, depth)
+          SELECT sup.ancestor_id, sub.descendant_id, sup.depth + sub.depth + 1
+            FROM tag_closure AS sup
+            CROSS JOIN tag_closure AS sub
+            WHERE sup.descendant_id = NEW.parent_category_id
+              AND sub.ancestor_id = NEW.category_id;
+      END IF;
+      RETURN NULL;
+   END;
+$trigger_tag_closure$
+LANGUAGE plpgsql;
+
+CREATE TRIGGER tag_closure_trigger
+  AFTER INSERT OR UPDATE OF parent_category_id ON tag
+  FOR EACH ROW EXECUTE PROCEDURE trigger_tag_closure();
+
 CREATE TABLE IF NOT EXISTS app_tag (
   app_id int REFERENCES app (app_id) NOT NULL,
   category_id int REFERENCES tag(category_id)
 );
 
+CREATE INDEX app_tag_category_idx ON app_tag (category_id);
+CREATE INDEX app_tag_app_idx ON app_tag (app_id);
+
 
 CREATE TABLE IF NOT EXISTS app_recommendation (
   app_id int REFERENCES app (app_id) NOT NULL,
@@ -112,6 +271,7 @@ CREATE TYPE evaluation AS ENUM(
 
 
 CREATE TABLE IF NOT EXISTS app_review (
+  review_id serial PRIMARY KEY,
   app_id int REFERENCES app (app_id) NOT NULL,
   user_id int REFERENCES user_details (user_id) NOT NULL,
   user_role role DEFAULT 'user',
@@ -123,6 +283,44 @@ CREATE TABLE IF NOT EXISTS app_review (
   CONSTRAINT unique_app_user_pairs UNIQUE (app_id, user_id)
 );
 
+/* Newest-first pages of an app's reviews (see get_reviews_page). */
+CREATE INDEX app_review_app_date_idx
+  ON app_review (app_id, review_date DESC, review_id DESC);
+
+/* Running totals of each app's reviews by reviewer role, so that
+ * nothing (neither the pages nor the app_summaries refresh) has to
+ * aggregate app_review. Scores count bad = 1, ok = 2, good = 3.
+ * add_to_review_rollup() (in create_views.sql) adds new reviews in
+ * the transaction that inserts them; reconcile_review_rollup() checks
+ * the totals against app_review and corrects them.
+ */
+CREATE TABLE IF NOT EXISTS app_review_rollup (
+  app_id int PRIMARY KEY REFERENCES app (app_id) ON DELETE CASCADE,
+  user_reviews int NOT NULL DEFAULT 0,
+  user_usability int NOT NULL DEFAULT 0,
+  user_effectiveness int NOT NULL DEFAULT 0,
+  provider_reviews int NOT NULL DEFAULT 0,
+  provider_usability int NOT NULL DEFAULT 0,
+  provider_effectiveness int NOT NULL DEFAULT 0,
+  last_review_date date
+);
+
+/* Every app starts with a row of zeros, so adding to the totals is
+ * always an UPDATE.
+ */
+CREATE OR REPLACE FUNCTION trigger_app_review_rollup_row() RETURNS TRIGGER
+AS $trigger_app_review_rollup_row$
+   BEGIN
+      INSERT INTO app_review_rollup (app_id) VALUES (NEW.app_id);
+      RETURN NULL;
+   END;
+$trigger_app_review_rollup_row$
+LANGUAGE plpgsql;
+
+CREATE TRIGGER app_review_rollup_row
+  AFTER INSERT ON app
+  FOR EACH ROW EXECUTE PROCEDURE trigger_app_review_rollup_row();
+
 
 CREATE TABLE IF NOT EXISTS user_role (
   user_id int REFERENCES user_details (user_id),
@@ -151,6 +349,106 @@ CREATE TABLE IF NOT EXISTS organization_admin (
 );
 
 
+/* ================ PRECOMPUTED (MATERIALIZED) TABLES ================= */
+/* Rows of app_summaries_view (see create_views.sql), stored so that
+ * the pages do not re-aggregate reviews and recommendations on every
+ * request. Kept current by refresh_app_summaries(), which recomputes
+ * only the apps queued in app_summaries_dirty.
+ */
+CREATE TABLE IF NOT EXISTS app_summaries (
+  app_id int PRIMARY KEY REFERENCES app (app_id) ON DELETE CASCADE,
+  app_name varchar(128),
+  organization_name varchar(64),
+  icon varchar(64),
+  objective varchar(256),
+  recommendations bigint NOT NULL DEFAULT 0,
+  recommenders bigint NOT NULL DEFAULT 0,
+  user_usability numeric,
+  provider_usability numeric,
+  user_effectiveness numeric,
+  provider_effectiveness numeric,
+  last_review_date date,
+  devices text,
+  platforms text,
+  categories text,
+  refreshed_at timestamp with time zone NOT NULL DEFAULT now(),
+  -- Full-text search document (see update_app_search() in create_views.sql)
+  document tsvector
+);
+-- max(refreshed_at) is the validator for HTTP conditional requests.
+CREATE INDEX app_summaries_refreshed_at_idx ON app_summaries (refreshed_at);
+CREATE INDEX app_summaries_document_idx ON app_summaries USING gin (document);
+
+CREATE TABLE IF NOT EXISTS app_summaries_dirty (
+  app_id int NOT NULL,
+  queued_at timestamp with time zone NOT NULL DEFAULT now()
+);
+
+
+/* Recommendations, computed offline by recommender.py from the reviews
+ * and recommendations: for each app, the apps most often used by the
+ * same people (app_neighbors), and for each user, the apps used by
+ * people like them that they have not used yet (user_suggestions).
+ * Pages read them with one primary key range scan.
+ */
+CREATE TABLE IF NOT EXISTS app_neighbors (
+  app_id int REFERENCES app (app_id) ON DELETE CASCADE NOT NULL,
+  rank smallint NOT NULL,
+  neighbor_id int REFERENCES app (app_id) ON DELETE CASCADE NOT NULL,
+  score real NOT NULL,
+  PRIMARY KEY (app_id, rank)
+);
+
+CREATE TABLE IF NOT EXISTS user_suggestions (
+  user_id int REFERENCES user_details (user_id) ON DELETE CASCADE NOT NULL,
+  rank smallint NOT NULL,
+  app_id int REFERENCES app (app_id) ON DELETE CASCADE NOT NULL,
+  score real NOT NULL,
+  PRIMARY KEY (user_id, rank)
+);
+
+/* Users whose reviews or recommendations changed since recommender.py
+ * last ran; it recomputes just those (and the apps they used).
+ */
+CREATE TABLE IF NOT EXISTS recommender_dirty (
+  user_id int NOT NULL,
+  queued_at timestamp with time zone NOT NULL DEFAULT now()
+);
+
+CREATE OR REPLACE FUNCTION trigger_recommender_dirty() RETURNS TRIGGER
+AS $trigger_recommender_dirty$
+   BEGIN
+      IF (TG_TABLE_NAME = 'app_review') THEN
+        IF (TG_OP <> 'INSERT') THEN
+          INSERT INTO recommender_dirty (user_id) VALUES (OLD.user_id);
+        END IF;
+        IF (TG_OP <> 'DELETE') THEN
+          INSERT INTO recommender_dirty (user_id) VALUES (NEW.user_id);
+        END IF;
+      ELSE
+        IF (TG_OP <> 'INSERT') THEN
+          INSERT INTO recommender_dirty (user_id)
+            VALUES (OLD.recommender_id), (OLD.recipient_id);
+        END IF;
+        IF (TG_OP <> 'DELETE') THEN
+          INSERT INTO recommender_dirty (user_id)
+            VALUES (NEW.recommender_id), (NEW.recipient_id);
+        END IF;
+      END IF;
+      RETURN NULL;
+   END;
+$trigger_recommender_dirty$
+LANGUAGE plpgsql;
+
+CREATE TRIGGER recommender_dirty_review
+  AFTER INSERT OR UPDATE OR DELETE ON app_review
+  FOR EACH ROW EXECUTE PROCEDURE trigger_recommender_dirty();
+
+CREATE TRIGGER recommender_dirty_recommendation
+  AFTER INSERT OR UPDATE OR DELETE ON app_recommendation
+  FOR EACH ROW EXECUTE PROCEDURE trigger_recommender_dirty();
+
+
 /* ==================== STAGING TABLES AND TRIGGERS =================== */
 CREATE SCHEMA IF NOT EXISTS staging;
 CREATE TABLE IF NOT EXISTS staging.app_view_loader (
@@ -164,68 +462,68 @@ CREATE TABLE IF NOT EXISTS staging.app_view_loader (
   load boolean DEFAULT TRUE
 );
 
+/* Unloaded rows are found through a partial index, so each load does
+ * not rescan everything staged before it.
+ */
+CREATE INDEX app_view_loader_load_idx
+  ON staging.app_view_loader (load) WHERE load = TRUE;
+
+/* Load every staged row in a few set-based statements: the apps, then
+ * their platforms, devices and tags by unnesting the arrays and joining
+ * to the lookup tables. If an app name occurs twice in one load, the
+ * dimensions go to the newer app.
+ */
 CREATE OR REPLACE FUNCTION trigger_app_view_loader() RETURNS TRIGGER
 AS $trigger_app_view_loader$
-   DECLARE
-    current_app_id integer;
-    matched_id integer;
-    element varchar(128);
-    r RECORD;
    BEGIN
 
-      INSERT INTO app (app_name, organization_id, icon, objective) (
-        SELECT app_name, organization_id, icon, objective
+      -- One statement: the app rows are visible to the dimension
+      -- inserts through the RETURNING of the first one.
+      WITH new_apps AS (
+        INSERT INTO app (app_name, organization_id, icon, objective) (
+          SELECT app_name, organization_id, icon, objective
+            FROM staging.app_view_loader AS avl
+          JOIN organization_details AS od
+            ON avl.organization_name = od.organization_name
+          WHERE load = TRUE
+        )
+        RETURNING app_id, app_name
+      ), loaded AS (
+        SELECT avl.*, la.app_id
           FROM staging.app_view_loader AS avl
-        JOIN organization_details AS od
-          ON avl.organization_name = od.organization_name
-        WHERE load = TRUE
-      );
-
-      -- Go row by row and insert into the respective correct dimensional tables.
-      FOR r IN SELECT * FROM staging.app_view_loader WHERE load=TRUE LOOP
-          SELECT max(app_id) INTO current_app_id FROM app WHERE r.app_name = app.app_name;
-
-          -- app_platform
-          IF (r.platforms  IS NOT NULL) THEN
-            FOREACH element in ARRAY r.platforms
-            LOOP
-              SELECT platform_id INTO matched_id FROM platform AS pl WHERE pl.platform = element;
-
-              IF (matched_id IS NOT NULL) THEN
-                INSERT INTO app_platform(app_id, platform_id)
-                  VALUES(current_app_id, matched_id);
-              END IF;
-            END LOOP;
-          END IF;
-
-          -- app_device
-          IF (r.devices IS NOT NULL) THEN
-            FOREACH element in ARRAY r.devices
-            LOOP
-              SELECT device_id INTO matched_id FROM device WHERE device.device = element;
-
-              IF (matched_id IS NOT NULL) THEN
-                INSERT INTO app_device(app_id, device_id)
-                  VALUES(current_app_id, matched_id);
-              END IF;
-            END LOOP;
-         END IF;
-
-          -- app_tag
-          IF (r.tags IS NOT NULL) THEN
-            FOREACH element in ARRAY r.tags
-            LOOP
-              SELECT category_id INTO matched_id FROM tag WHERE tag.category_name = element;
-
-              IF (matched_id IS NOT NULL) THEN
-                INSERT INTO app_tag(app_id, category_id)
-                  VALUES(current_app_id, matched_id);
-              END IF;
-            END LOOP;
-         END IF;
-      END LOOP;
-
-      UPDATE staging.app_view_loader SET load = FALSE;
+          JOIN (SELECT app_name, max(app_id) AS app_id
+                  FROM new_apps
+                  GROUP BY app_name) AS la
+            ON avl.app_name = la.app_name
+          WHERE avl.load = TRUE
+      ), new_platforms AS (
+        -- app_platform
+        INSERT INTO app_platform (app_id, platform_id)
+          SELECT l.app_id, pl.platform_id
+            FROM loaded AS l
+            CROSS JOIN LATERAL unnest(l.platforms) AS element
+            JOIN platform AS pl
+              ON pl.platform = element
+        RETURNING app_id
+      ), new_devices AS (
+        -- app_device
+        INSERT INTO app_device (app_id, device_id)
+          SELECT l.app_id, d.device_id
+            FROM loaded AS l
+            CROSS JOIN LATERAL unnest(l.devices) AS element
+            JOIN device AS d
+              ON d.device = element
+        RETURNING app_id
+      )
+      -- app_tag
+      INSERT INTO app_tag (app_id, category_id)
+        SELECT l.app_id, t.category_id
+          FROM loaded AS l
+          CROSS JOIN LATERAL unnest(l.tags) AS element
+          JOIN tag AS t
+            ON t.category_name = element;
+
+      UPDATE staging.app_view_loader SET load = FALSE WHERE load = TRUE;
       RETURN NULL;
 
     END;
@@ -245,6 +543,9 @@ CREATE TABLE IF NOT EXISTS staging.app_recommendation_loader (
   load boolean DEFAULT TRUE
 );
 
+CREATE INDEX app_recommendation_loader_load_idx
+  ON staging.app_recommendation_loader (load) WHERE load = TRUE;
+
 CREATE OR REPLACE FUNCTION trigger_app_recommendation_loader() RETURNS TRIGGER
 AS $trigger_app_recommendation_loader$
    BEGIN
@@ -263,7 +564,7 @@ AS $trigger_app_recommendation_loader$
         WHERE load = TRUE
       );
 
-      UPDATE staging.app_recommendation_loader SET load = FALSE;
+      UPDATE staging.app_recommendation_loader SET load = FALSE WHERE load = TRUE;
       RETURN NULL;
 
     END;
@@ -289,25 +590,35 @@ CREATE TABLE IF NOT EXISTS staging.app_review_loader (
   unique(app_name, user_nickname)
 );
 
+CREATE INDEX app_review_loader_load_idx
+  ON staging.app_review_loader (load) WHERE load = TRUE;
+
 CREATE OR REPLACE FUNCTION trigger_app_review_loader() RETURNS TRIGGER
 AS $trigger_app_review_loader$
+   DECLARE
+     added integer[];
    BEGIN
 
-      INSERT INTO
-        app_review (app_id, user_id, user_role, usability, effectiveness, review, platform_id)
-        (
-        SELECT app_id, user_id, user_role, usability, effectiveness, review, platform_id
-          FROM staging.app_review_loader AS arl
-        JOIN app
-          ON arl.app_name = app.app_name
-        JOIN user_details AS ud
-          ON arl.user_nickname = ud.nickname
-        LEFT OUTER JOIN platform AS p
-          ON arl.platform = p.platform
-        WHERE load = TRUE
-      );
-
-      UPDATE staging.app_review_loader SET load = FALSE;
+      WITH new_reviews AS (
+        INSERT INTO
+          app_review (app_id, user_id, user_role, usability, effectiveness, review, platform_id)
+          (
+          SELECT app_id, user_id, user_role, usability, effectiveness, review, platform_id
+            FROM staging.app_review_loader AS arl
+          JOIN app
+            ON arl.app_name = app.app_name
+          JOIN user_details AS ud
+            ON arl.user_nickname = ud.nickname
+          LEFT OUTER JOIN platform AS p
+            ON arl.platform = p.platform
+          WHERE load = TRUE
+        )
+        RETURNING review_id
+      )
+      SELECT array_agg(review_id) INTO added FROM new_reviews;
+      PERFORM add_to_review_rollup(added);
+
+      UPDATE staging.app_review_loader SET load = FALSE WHERE load = TRUE;
       RETURN NULL;
 
     END;
@@ -332,14 +643,11 @@ CREATE TABLE IF NOT EXISTS staging.user_details_loader (
   load boolean DEFAULT TRUE
 );
 
+CREATE INDEX user_details_loader_load_idx
+  ON staging.user_details_loader (load) WHERE load = TRUE;
+
 CREATE OR REPLACE FUNCTION trigger_user_details_loader() RETURNS TRIGGER
 AS $trigger_user_details_loader$
-   DECLARE
-    current_user_id integer;
-    matched_id integer;
-    element varchar(128);
-    role_element role;
-    r RECORD;
    BEGIN
 
       INSERT INTO user_details (avatar, nickname, first_name, last_name) (
@@ -368,47 +676,42 @@ AS $trigger_user_details_loader$
           ON udl.organization_name = od.organization_name
         WHERE udl.load=TRUE AND udl.is_organization_admin=TRUE);
 
-      -- Go row by row and insert into the respective correct dimensional tables.
-      FOR r IN SELECT * FROM staging.user_details_loader WHERE load=TRUE LOOP
-          SELECT max(user_id) INTO current_user_id FROM user_details AS u WHERE r.nickname = u.nickname;
-
-          -- user_role 
-          IF (r.roles IS NOT NULL) THEN
-            FOREACH role_element in ARRAY r.roles
-            LOOP
-              INSERT INTO user_role(user_id, role_code)
-                VALUES(current_user_id, role_element);
-            END LOOP;
-          END IF;
-
-          -- patient_professional
-          IF (r.authorized_professionals IS NOT NULL) THEN
-            FOREACH element in ARRAY r.authorized_professionals
-            LOOP
-              SELECT user_id INTO matched_id FROM user_details AS u WHERE u.nickname = element;
-
-              IF (matched_id IS NOT NULL) THEN
-                INSERT INTO patient_professional(patient_id, professional_id)
-                  VALUES(current_user_id, matched_id);
-              END IF;
-            END LOOP;
-         END IF;
-
-          -- user_hierarchy
-          IF (r.authorized_subs IS NOT NULL) THEN
-            FOREACH element in ARRAY r.authorized_subs
-            LOOP
-              SELECT user_id INTO matched_id FROM user_details AS u WHERE u.nickname = element;
-
-              IF (matched_id IS NOT NULL) THEN
-                INSERT INTO user_hierarchy(parent_id, sub_id)
-                  VALUES(current_user_id, matched_id);
-              END IF;
-            END LOOP;
-         END IF;
-      END LOOP;
-
-      UPDATE staging.user_details_loader SET load = FALSE;
+      -- user_role
+      INSERT INTO user_role (user_id, role_code)
+        SELECT user_id, role_element
+        FROM user_details AS ud
+        JOIN staging.user_details_loader AS udl
+          ON udl.nickname = ud.nickname
+        CROSS JOIN LATERAL unnest(udl.roles) AS role_element
+        WHERE udl.load=TRUE;
+
+      -- patient_professional
+      INSERT INTO patient_professional (patient_id, professional_id)
+        SELECT ud.user_id, pro.user_id
+        FROM user_details AS ud
+        JOIN staging.user_details_loader AS udl
+          ON udl.nickname = ud.nickname
+        CROSS JOIN LATERAL unnest(udl.authorized_professionals) AS element
+        JOIN user_details AS pro
+          ON pro.nickname = element
+        WHERE udl.load=TRUE;
+
+      -- user_hierarchy
+      INSERT INTO user_hierarchy (parent_id, sub_id)
+        SELECT DISTINCT ud.user_id, sub.user_id
+        FROM user_details AS ud
+        JOIN staging.user_details_loader AS udl
+          ON udl.nickname = ud.nickname
+        CROSS JOIN LATERAL unnest(udl.authorized_subs) AS element
+        JOIN user_details AS sub
+          ON sub.nickname = element
+        WHERE udl.load=TRUE
+          AND sub.user_id <> ud.user_id
+          AND NOT EXISTS (SELECT 1 FROM user_hierarchy AS uh
+                          WHERE uh.parent_id = ud.user_id
+                            AND uh.sub_id = sub.user_id);
+
+      UPDATE staging.user_details_loader SET load = FALSE WHERE load = TRUE;
       RETURN NULL;
 
     END;
@@ -67,77 +67,41 @@ CREATE OR REPLACE VIEW app_platform_view AS
 ;
 
 
-/* Map all parent tags to all descendant tags. */
+/* Map all parent tags to all descendant tags
+ * (and each top-level tag to NULL). Read from tag_closure.
+ */
 CREATE OR REPLACE VIEW cat_to_parents AS
-  WITH RECURSIVE q AS (
-    SELECT parent_category_id, category_id
-      FROM tag
-      WHERE parent_category_id IS NULL
-    UNION
-    SELECT t.parent_category_id, t.category_id
-      FROM tag t
-      JOIN q ON q.category_id = t.parent_category_id
-  )
-  SELECT * FROM q
+  SELECT ancestor_id AS parent_category_id, descendant_id AS category_id
+    FROM tag_closure
+    WHERE depth > 0
+  UNION ALL
+  SELECT NULL, category_id
+    FROM tag
+    WHERE parent_category_id IS NULL
 ;
 
 /* Map app_id to all tags and parent tags. */
 CREATE OR REPLACE VIEW app_category_view AS
-  WITH intermediate AS (
-      SELECT DISTINCT app_id, category_id
-        FROM app_tag
-      UNION
-      SELECT DISTINCT
-        app_id,
-        ctp.parent_category_id AS category_id
-        FROM app_tag AS at
-        JOIN cat_to_parents AS ctp
-          ON at.category_id = ctp.category_id
-  )
-  SELECT DISTINCT app_id, category_name
-    FROM intermediate
-    JOIN tag ON intermediate.category_id = tag.category_id
+  SELECT DISTINCT at.app_id, tag.category_name
+    FROM app_tag AS at
+    JOIN tag_closure AS tc
+      ON at.category_id = tc.descendant_id
+    JOIN tag
+      ON tc.ancestor_id = tag.category_id
 ;
 
-/* Map all parent tags to all descendant tags */
-CREATE OR REPLACE VIEW app_summaries AS 
+/* Per-app aggregates of recommendations, reviews (from their running
+ * totals in app_review_rollup), devices, platforms and tags. This is
+ * expensive: read the precomputed app_summaries table instead, which
+ * refresh_app_summaries() fills from this view.
+ */
+CREATE OR REPLACE VIEW app_summaries_view AS 
   WITH recs AS (
     SELECT app_id,
            COUNT(app_id) AS recommendations,
            COUNT(DISTINCT recommender_id) AS recommenders
     FROM app_recommendation
     GROUP BY app_id
-  ), user_review AS (
-    SELECT app_id,
-    SUM( CASE WHEN usability = 'bad' THEN 1.0
-              WHEN usability = 'ok' THEN 2.0
-              ELSE 3.0
-          END ) / COUNT( usability ) AS avg_usability, 
-    SUM( CASE WHEN effectiveness = 'bad' THEN 1.0
-              WHEN effectiveness = 'ok' THEN 2.0
-              ELSE 3.0
-         END ) / COUNT ( effectiveness ) AS avg_effectiveness
-    FROM app_review
-    WHERE user_role = 'user'
-    GROUP BY app_id
-  ), provider_review AS (
-    SELECT app_id,
-    SUM( CASE WHEN usability = 'bad' THEN 1.0
-              WHEN usability = 'ok' THEN 2.0
-              ELSE 3.0
-          END ) / COUNT( usability ) AS avg_usability, 
-    SUM( CASE WHEN effectiveness = 'bad' THEN 1.0
-              WHEN effectiveness = 'ok' THEN 2.0
-              ELSE 3.0
-         END ) / COUNT ( effectiveness ) AS avg_effectiveness
-    FROM app_review
-    WHERE user_role = 'health provider'
-    GROUP BY app_id
-  ), last_review AS (
-    SELECT app_id,
-    MAX (review_date) AS last_review_date
-    FROM app_review
-    GROUP BY app_id
   ), devices AS (
     SELECT app_id,
       string_agg(device, '|') AS devices
@@ -157,11 +121,11 @@ CREATE OR REPLACE VIEW app_summaries AS
   SELECT app.app_id, app_name, organization_name, icon, objective,
         CASE WHEN recommendations IS NULL THEN 0 ELSE recommendations END AS recommendations,
         CASE WHEN recommenders IS NULL THEN 0 ELSE recommenders END AS recommenders,
-        u.avg_usability AS user_usability,
-        p.avg_usability AS provider_usability,   
-        u.avg_effectiveness AS user_effectiveness,
-        p.avg_effectiveness AS provider_effectiveness,
-        l.last_review_date,
+        r.user_usability / NULLIF(r.user_reviews, 0)::numeric AS user_usability,
+        r.provider_usability / NULLIF(r.provider_reviews, 0)::numeric AS provider_usability,
+        r.user_effectiveness / NULLIF(r.user_reviews, 0)::numeric AS user_effectiveness,
+        r.provider_effectiveness / NULLIF(r.provider_reviews, 0)::numeric AS provider_effectiveness,
+        r.last_review_date,
         d.devices,
         pl.platforms,
         c.categories
@@ -170,21 +134,348 @@ CREATE OR REPLACE VIEW app_summaries AS
     ON app.organization_id = o.organization_id
   LEFT JOIN recs
     ON app.app_id = recs.app_id
-  LEFT JOIN user_review AS u
-    ON app.app_id = u.app_id
-  LEFT JOIN provider_review AS p
-    ON app.app_id = p.app_id
+  LEFT JOIN app_review_rollup AS r
+    ON app.app_id = r.app_id
   LEFT JOIN devices AS d
     ON app.app_id = d.app_id
   LEFT JOIN platforms AS pl
     ON app.app_id = pl.app_id
   JOIN categories AS c
     ON app.app_id = c.app_id
-  LEFT JOIN last_review AS l
-    ON app.app_id = l.app_id
 ;
 
 
+/* Recompute the search documents of the given app_summaries rows (of
+ * every row if app_ids is NULL).
+ *
+ * The app name weighs most (A), then the organization and tags (B),
+ * the objective (C), and the text of the app's most recent 200 reviews
+ * (D). Capping the reviews keeps every document small, so a search
+ * ranks at most one modest document per app however many reviews
+ * there are.
+ */
+CREATE OR REPLACE FUNCTION
+  update_app_search(app_ids integer[]) RETURNS void
+AS $update_app_search$
+  UPDATE app_summaries AS s
+    SET document =
+      setweight(to_tsvector('english', coalesce(s.app_name, '')), 'A') ||
+      setweight(to_tsvector('english',
+          coalesce(s.organization_name, '') || ' ' ||
+          replace(coalesce(s.categories, ''), '|', ' ')), 'B') ||
+      setweight(to_tsvector('english', coalesce(s.objective, '')), 'C') ||
+      setweight(to_tsvector('english', coalesce(
+          (SELECT string_agg(recent.review, ' ')
+             FROM (SELECT review FROM app_review AS ar
+                    WHERE ar.app_id = s.app_id
+                    ORDER BY ar.review_date DESC
+                    LIMIT 200) AS recent), '')), 'D')
+    WHERE $1 IS NULL OR s.app_id = ANY($1);
+$update_app_search$
+LANGUAGE SQL;
+
+
+/* What each review adds to its app's totals in app_review_rollup. */
+CREATE OR REPLACE VIEW review_scores AS
+  SELECT review_id, app_id, review_date,
+    CASE WHEN user_role = 'user' THEN 1 ELSE 0 END AS by_user,
+    CASE WHEN user_role = 'health provider' THEN 1 ELSE 0 END AS by_provider,
+    CASE usability WHEN 'bad' THEN 1 WHEN 'ok' THEN 2 ELSE 3 END AS usability,
+    CASE effectiveness WHEN 'bad' THEN 1 WHEN 'ok' THEN 2 ELSE 3 END AS effectiveness
+  FROM app_review;
+
+
+/* Add the reviews with ids $1, just inserted, to their apps' totals.
+ * Call it in the transaction that inserts them. The rows are found by
+ * primary key, so the cost is that of the batch, not of app_review.
+ */
+CREATE OR REPLACE FUNCTION
+  add_to_review_rollup(integer[]) RETURNS void AS $$
+
+  UPDATE app_review_rollup AS r
+    SET user_reviews = r.user_reviews + d.user_reviews,
+        user_usability = r.user_usability + d.user_usability,
+        user_effectiveness = r.user_effectiveness + d.user_effectiveness,
+        provider_reviews = r.provider_reviews + d.provider_reviews,
+        provider_usability = r.provider_usability + d.provider_usability,
+        provider_effectiveness = r.provider_effectiveness + d.provider_effectiveness,
+        last_review_date = GREATEST(r.last_review_date, d.last_review_date)
+    FROM (SELECT app_id,
+                 sum(by_user) AS user_reviews,
+                 sum(by_user * usability) AS user_usability,
+                 sum(by_user * effectiveness) AS user_effectiveness,
+                 sum(by_provider) AS provider_reviews,
+                 sum(by_provider * usability) AS provider_usability,
+                 sum(by_provider * effectiveness) AS provider_effectiveness,
+                 max(review_date) AS last_review_date
+            FROM review_scores
+            WHERE review_id = ANY($1)
+            GROUP BY app_id) AS d
+    WHERE r.app_id = d.app_id;
+
+$$ LANGUAGE SQL;
+
+
+/* Check app_review_rollup against app_review, and correct the totals
+ * that differ (e.g. after reviews were edited or deleted by hand).
+ * The corrected apps are queued for the next app_summaries refresh.
+ * Reviews cannot be added meanwhile. Returns the number corrected.
+ */
+CREATE OR REPLACE FUNCTION
+  reconcile_review_rollup() RETURNS integer
+AS $reconcile_review_rollup$
+  DECLARE
+    corrected integer[];
+  BEGIN
+      LOCK TABLE app_review IN SHARE MODE;
+
+      INSERT INTO app_review_rollup (app_id)
+        SELECT app_id FROM app
+        WHERE NOT EXISTS (SELECT 1 FROM app_review_rollup AS r
+                          WHERE r.app_id = app.app_id);
+
+      WITH totals AS (
+        SELECT r.app_id,
+               COALESCE(t.user_reviews, 0) AS user_reviews,
+               COALESCE(t.user_usability, 0) AS user_usability,
+               COALESCE(t.user_effectiveness, 0) AS user_effectiveness,
+               COALESCE(t.provider_reviews, 0) AS provider_reviews,
+               COALESCE(t.provider_usability, 0) AS provider_usability,
+               COALESCE(t.provider_effectiveness, 0) AS provider_effectiveness,
+               t.last_review_date
+          FROM app_review_rollup AS r
+          LEFT JOIN (SELECT app_id,
+                            sum(by_user) AS user_reviews,
+                            sum(by_user * usability) AS user_usability,
+                            sum(by_user * effectiveness) AS user_effectiveness,
+                            sum(by_provider) AS provider_reviews,
+                            sum(by_provider * usability) AS provider_usability,
+                            sum(by_provider * effectiveness) AS provider_effectiveness,
+                            max(review_date) AS last_review_date
+                       FROM review_scores
+                       GROUP BY app_id) AS t
+            ON t.app_id = r.app_id
+      ), fixed AS (
+        UPDATE app_review_rollup AS r
+          SET user_reviews = t.user_reviews,
+              user_usability = t.user_usability,
+              user_effectiveness = t.user_effectiveness,
+              provider_reviews = t.provider_reviews,
+              provider_usability = t.provider_usability,
+              provider_effectiveness = t.provider_effectiveness,
+              last_review_date = t.last_review_date
+          FROM totals AS t
+          WHERE r.app_id = t.app_id
+            AND (r.user_reviews, r.user_usability, r.user_effectiveness,
+                 r.provider_reviews, r.provider_usability,
+                 r.provider_effectiveness, r.last_review_date)
+                IS DISTINCT FROM
+                (t.user_reviews, t.user_usability, t.user_effectiveness,
+                 t.provider_reviews, t.provider_usability,
+                 t.provider_effectiveness, t.last_review_date)
+          RETURNING r.app_id
+      )
+      SELECT array_agg(app_id) INTO corrected FROM fixed;
+
+      IF corrected IS NULL THEN
+        RETURN 0;
+      END IF;
+      INSERT INTO app_summaries_dirty (app_id) SELECT unnest(corrected);
+      RETURN array_length(corrected, 1);
+  END;
+$reconcile_review_rollup$
+LANGUAGE plpgsql;
+
+
+/* Recompute the stored app_summaries rows.
+ *
+ * With full_rebuild = TRUE, every row is recomputed. Otherwise only the
+ * apps queued in app_summaries_dirty (by the triggers below) are.
+ * Only one refresh runs at a time; a concurrent call returns -1 at once
+ * rather than waiting. Returns the number of rows written.
+ *
+ * Writers of app_summaries lock each app they recompute, in app_id
+ * order (the two-key advisory lock (hashtext('refresh_app_summaries'),
+ * app_id)), so a refresh waits only for reviews of the same apps and
+ * never deadlocks with them. A full rebuild instead holds
+ * hashtext('app_summaries_rebuild') exclusively, which the per-app
+ * writers take shared.
+ */
+CREATE OR REPLACE FUNCTION
+  refresh_app_summaries(full_rebuild boolean DEFAULT FALSE) RETURNS integer
+AS $refresh_app_summaries$
+  DECLARE
+    touched integer[];
+    n integer;
+  BEGIN
+      IF NOT pg_try_advisory_xact_lock(hashtext('refresh_app_summaries')) THEN
+        RETURN -1;
+      END IF;
+
+      IF full_rebuild THEN
+        PERFORM pg_advisory_xact_lock(hashtext('app_summaries_rebuild'));
+        DELETE FROM app_summaries_dirty;
+        DELETE FROM app_summaries;
+        INSERT INTO app_summaries (app_id, app_name, organization_name, icon,
+            objective, recommendations, recommenders,
+            user_usability, provider_usability,
+            user_effectiveness, provider_effectiveness,
+            last_review_date, devices, platforms, categories)
+          SELECT app_id, app_name, organization_name, icon,
+            objective, recommendations, recommenders,
+            user_usability, provider_usability,
+            user_effectiveness, provider_effectiveness,
+            last_review_date, devices, platforms, categories
+          FROM app_summaries_view;
+        GET DIAGNOSTICS n = ROW_COUNT;
+        PERFORM update_app_search(NULL);
+        RETURN n;
+      END IF;
+
+      SELECT array_agg(DISTINCT app_id ORDER BY app_id) INTO touched
+      FROM app_summaries_dirty;
+
+      IF touched IS NULL THEN
+        RETURN 0;
+      END IF;
+
+      /* Lock before dequeueing: a review of one of these apps holds its
+       * app lock while it deletes the app's queue rows. */
+      PERFORM pg_advisory_xact_lock_shared(hashtext('app_summaries_rebuild'));
+      PERFORM pg_advisory_xact_lock(hashtext('refresh_app_summaries'), app_id)
+      FROM unnest(touched) AS app_id
+      ORDER BY app_id;
+
+      DELETE FROM app_summaries_dirty WHERE app_id = ANY(touched);
+      DELETE FROM app_summaries WHERE app_id = ANY(touched);
+      INSERT INTO app_summaries (app_id, app_name, organization_name, icon,
+          objective, recommendations, recommenders,
+          user_usability, provider_usability,
+          user_effectiveness, provider_effectiveness,
+          last_review_date, devices, platforms, categories)
+        SELECT app_id, app_name, organization_name, icon,
+          objective, recommendations, recommenders,
+          user_usability, provider_usability,
+          user_effectiveness, provider_effectiveness,
+          last_review_date, devices, platforms, categories
+        FROM app_summaries_view
+        WHERE app_id = ANY(touched);
+      GET DIAGNOSTICS n = ROW_COUNT;
+      PERFORM update_app_search(touched);
+      RETURN n;
+  END;
+$refresh_app_summaries$
+LANGUAGE plpgsql;
+
+
+/* Recompute the stored app_summaries rows of the apps app_ids now,
+ * e.g. in the transaction that saves a review, so its author sees it
+ * on the next page. Waits for a running refresh of the same apps (or a
+ * full rebuild) rather than skipping. Returns the number of rows
+ * written.
+ */
+CREATE OR REPLACE FUNCTION
+  refresh_app_summaries(app_ids integer[]) RETURNS integer
+AS $refresh_app_summaries_of$
+  DECLARE
+    n integer;
+  BEGIN
+      PERFORM pg_advisory_xact_lock_shared(hashtext('app_summaries_rebuild'));
+      PERFORM pg_advisory_xact_lock(hashtext('refresh_app_summaries'), app_id)
+      FROM (SELECT DISTINCT unnest(app_ids) AS app_id) AS ids
+      ORDER BY app_id;
+
+      DELETE FROM app_summaries_dirty WHERE app_id = ANY(app_ids);
+      DELETE FROM app_summaries WHERE app_id = ANY(app_ids);
+      INSERT INTO app_summaries (app_id, app_name, organization_name, icon,
+          objective, recommendations, recommenders,
+          user_usability, provider_usability,
+          user_effectiveness, provider_effectiveness,
+          last_review_date, devices, platforms, categories)
+        SELECT app_id, app_name, organization_name, icon,
+          objective, recommendations, recommenders,
+          user_usability, provider_usability,
+          user_effectiveness, provider_effectiveness,
+          last_review_date, devices, platforms, categories
+        FROM app_summaries_view
+        WHERE app_id = ANY(app_ids);
+      GET DIAGNOSTICS n = ROW_COUNT;
+      PERFORM update_app_search(app_ids);
+      RETURN n;
+  END;
+$refresh_app_summaries_of$
+LANGUAGE plpgsql;
+
+
+/* Queue the app(s) touched by a change for the next refresh. */
+CREATE OR REPLACE FUNCTION trigger_app_summaries_dirty() RETURNS TRIGGER
+AS $trigger_app_summaries_dirty$
+   BEGIN
+      IF (TG_OP = 'DELETE' OR
+          (TG_OP = 'UPDATE' AND OLD.app_id IS DISTINCT FROM NEW.app_id)) THEN
+        INSERT INTO app_summaries_dirty (app_id) VALUES (OLD.app_id);
+      END IF;
+      IF (TG_OP <> 'DELETE') THEN
+        INSERT INTO app_summaries_dirty (app_id) VALUES (NEW.app_id);
+      END IF;
+      RETURN NULL;
+   END;
+$trigger_app_summaries_dirty$
+LANGUAGE plpgsql;
+
+CREATE TRIGGER app_summaries_dirty_app
+  AFTER INSERT OR UPDATE OR DELETE ON app
+  FOR EACH ROW EXECUTE PROCEDURE trigger_app_summaries_dirty();
+
+CREATE TRIGGER app_summaries_dirty_review
+  AFTER INSERT OR UPDATE OR DELETE ON app_review
+  FOR EACH ROW EXECUTE PROCEDURE trigger_app_summaries_dirty();
+
+CREATE TRIGGER app_summaries_dirty_recommendation
+  AFTER INSERT OR UPDATE OR DELETE ON app_recommendation
+  FOR EACH ROW EXECUTE PROCEDURE trigger_app_summaries_dirty();
+
+CREATE TRIGGER app_summaries_dirty_tag
+  AFTER INSERT OR UPDATE OR DELETE ON app_tag
+  FOR EACH ROW EXECUTE PROCEDURE trigger_app_summaries_dirty();
+
+CREATE TRIGGER app_summaries_dirty_device
+  AFTER INSERT OR UPDATE OR DELETE ON app_device
+  FOR EACH ROW EXECUTE PROCEDURE trigger_app_summaries_dirty();
+
+
+/* Renaming or moving a tag, or renaming an organization, changes the
+ * summaries of every app filed under it.
+ * (Renamed devices or platforms need a full rebuild.)
+ */
+CREATE OR REPLACE FUNCTION trigger_app_summaries_dirty_parent() RETURNS TRIGGER
+AS $trigger_app_summaries_dirty_parent$
+   BEGIN
+      IF (TG_TABLE_NAME = 'tag') THEN
+        INSERT INTO app_summaries_dirty (app_id)
+          SELECT DISTINCT at.app_id
+          FROM app_tag AS at
+          JOIN tag_closure AS tc
+            ON at.category_id = tc.descendant_id
+          WHERE tc.ancestor_id = OLD.category_id;
+      ELSE
+        INSERT INTO app_summaries_dirty (app_id)
+          SELECT app_id FROM app WHERE organization_id = OLD.organization_id;
+      END IF;
+      RETURN NULL;
+   END;
+$trigger_app_summaries_dirty_parent$
+LANGUAGE plpgsql;
+
+CREATE TRIGGER app_summaries_dirty_tag_name
+  AFTER UPDATE ON tag
+  FOR EACH ROW EXECUTE PROCEDURE trigger_app_summaries_dirty_parent();
+
+CREATE TRIGGER app_summaries_dirty_organization_name
+  AFTER UPDATE ON organization_details
+  FOR EACH ROW EXECUTE PROCEDURE trigger_app_summaries_dirty_parent();
+
+
 /* Combine the app and recommender names and images with recommender. */
 CREATE OR REPLACE VIEW recommendation_view AS 
   SELECT app.app_id, app_name, icon,
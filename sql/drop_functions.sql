@@ -1,4 +1,7 @@
 DROP FUNCTION IF EXISTS get_authorized_users(integer);
 DROP FUNCTION IF EXISTS is_authorized_for(integer);
+DROP FUNCTION IF EXISTS may_act_for(integer, integer);
 DROP FUNCTION IF EXISTS insert_tag(varchar, varchar);
 DROP FUNCTION IF EXISTS get_reviews(integer);
+DROP FUNCTION IF EXISTS get_reviews_page(integer, date, integer, integer);
+DROP FUNCTION IF EXISTS search_apps(text, integer, integer);
@@ -1,4 +1,16 @@
-DROP VIEW IF EXISTS app_summaries CASCADE;
+/* Before app_summaries was a table (create_tables.sql) it was a view;
+ * drop that one too, or upgrading an old database fails on DROP TABLE.
+ * A plain DROP VIEW IF EXISTS would fail on the table instead. */
+DO $$
+BEGIN
+  IF EXISTS (SELECT 1 FROM pg_class
+             WHERE relname = 'app_summaries' AND relkind = 'v'
+               AND pg_table_is_visible(oid)) THEN
+    DROP VIEW app_summaries CASCADE;
+  END IF;
+END
+$$;
+DROP VIEW IF EXISTS app_summaries_view CASCADE;
 DROP VIEW IF EXISTS app_category_view CASCADE;
 DROP VIEW IF EXISTS cat_to_parents CASCADE;
 DROP VIEW IF EXISTS app_platform_view CASCADE;
@@ -6,5 +18,14 @@ DROP VIEW IF EXISTS app_device_view CASCADE;
 DROP VIEW IF EXISTS app_view CASCADE;
 DROP VIEW IF EXISTS recommendation_view CASCADE;
 DROP VIEW IF EXISTS review_view CASCADE;
+DROP VIEW IF EXISTS review_scores CASCADE;
 
 DROP FUNCTION IF EXISTS trigger_app_view() CASCADE;
+
+DROP FUNCTION IF EXISTS refresh_app_summaries(boolean) CASCADE;
+DROP FUNCTION IF EXISTS refresh_app_summaries(integer[]) CASCADE;
+DROP FUNCTION IF EXISTS update_app_search(integer[]) CASCADE;
+DROP FUNCTION IF EXISTS add_to_review_rollup(integer[]) CASCADE;
+DROP FUNCTION IF EXISTS reconcile_review_rollup() CASCADE;
+DROP FUNCTION IF EXISTS trigger_app_summaries_dirty() CASCADE;
+DROP FUNCTION IF EXISTS trigger_app_summaries_dirty_parent() CASCADE;
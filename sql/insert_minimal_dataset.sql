@@ -126,3 +126,6 @@ INSERT INTO staging.app_review_loader (app_name, user_nickname, user_role, usabi
 ('Swim Workout Time Split Tracker','valentina','user','ok','good','I loved competing and collaborating with old swim team friends across the country, but the UI could be easier.','Android');
 
 
+/* ------------------------------------- for 'app_summaries' --- */
+-- Precompute the summaries of everything loaded above.
+SELECT refresh_app_summaries(TRUE);
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# statements.py
+"""
+A registry of named statements.
+
+Queries that run on every request are declared once:
+
+    registry = StatementRegistry()
+    USER_BY_NICKNAME = registry.register("user_by_nickname",
+            "SELECT nickname, user_id, avatar FROM user_details "
+            "WHERE nickname = %s",
+            columns=["nickname", "user_id", "avatar"])
+
+and run with registry.execute(cursor, connection, USER_BY_NICKNAME, args).
+The name is what the query profiler reports them under, and the columns
+are the default keys of their rows.
+
+They are not PREPAREd here: pg8000 already keeps one server-side
+prepared statement per distinct query text (and parameter types) on
+each connection, so Postgres parses a registered statement once per
+pooled connection and reuses its plan. (An explicit 'EXECUTE name(%s)'
+would not work anyway: the driver sends its arguments as bind
+parameters, which Postgres refuses in utility statements.) What matters
+is that the text never changes between calls, so build no query text
+from the arguments.
+"""
+import re
+import threading
+
+
+class Statement(object):
+    """One named query. Create these with StatementRegistry.register()."""
+
+    def __init__(self, registry, name, text, columns=None):
+        self.registry = registry
+        self.name = name
+        self.text = text.strip().rstrip(';')
+        self.columns = columns
+
+    def execute(self, cur, conn, args=None):
+        self.registry.execute(cur, conn, self, args)
+
+    def __repr__(self):
+        return "<Statement %s>" % self.name
+
+
+class StatementRegistry(object):
+    """Declared statements, and how often each has run."""
+
+    def __init__(self):
+        self.statements = {}
+        self._lock = threading.Lock()
+        self._counts = {}  # name -> executes
+
+    def register(self, name, text, columns=None):
+        """Declare a statement and return it. Names must be SQL identifiers."""
+        if not re.match(r'^[a-z_][a-z0-9_]*$', name):
+            raise ValueError("Bad statement name: %r" % name)
+        with self._lock:
+            if name in self.statements:
+                raise ValueError("Statement already registered: %r" % name)
+            statement = self.statements[name] = Statement(
+                    self, name, text, columns=columns)
+            self._counts[name] = 0
+        return statement
+
+    def combined(self, name, text, columns=None):
+        """Return the statement called name, registering it if new.
+
+        For statements that are built at run time from registered ones
+        (such as the batches made by db_select_many).
+        """
+        with self._lock:
+            statement = self.statements.get(name)
+        if statement is None:
+            try:
+                statement = self.register(name, text, columns=columns)
+            except ValueError:
+                statement = self.statements[name]
+        return statement
+
+    def execute(self, cur, conn, statement, args=None):
+        """Execute the statement on cursor cur of connection conn."""
+        cur.execute(statement.text, args)
+        with self._lock:
+            self._counts[statement.name] += 1
+
+    def stats(self):
+        """Return {name: {'executes': n}} for every statement."""
+        with self._lock:
+            return dict((name, dict(executes=n))
+                        for name, n in self._counts.items())
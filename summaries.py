@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# summaries.py
+"""
+Keep the precomputed 'app_summaries' table current.
+
+The table holds the rows of the (expensive) 'app_summaries_view'.
+Triggers queue the app_id of every changed review, recommendation,
+tag, or device in 'app_summaries_dirty'; the SQL function
+refresh_app_summaries() recomputes just those apps.
+
+A SummaryRefresher runs that refresh at most every 'max_staleness'
+seconds from the request path, and every 'interval' seconds from a
+background thread, so the pages never show data older than the bound.
+
+To force a full rebuild from the command line:
+
+    python summaries.py --full
+
+The ratings come from the running totals in app_review_rollup, which
+are kept as reviews are added. To check them against app_review (and
+correct any that have drifted, e.g. after reviews were edited by hand):
+
+    python summaries.py --reconcile
+"""
+import threading
+import time
+
+import pg8000
+
+
+def refresh(db, full=False):
+    """Refresh app_summaries on the connection 'db' and commit.
+
+    Return the number of rows rewritten, or -1 if another refresh was
+    already running.
+    """
+    cur = db.cursor()
+    try:
+        cur.execute("SELECT refresh_app_summaries(%s);", [bool(full)])
+        n = cur.fetchall()[0][0]
+        db.commit()
+    except pg8000.Error:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
+    return n
+
+
+def reconcile(db):
+    """Correct the review totals that differ from app_review, and commit.
+
+    Return the number of apps corrected; they are queued for the next
+    refresh.
+    """
+    cur = db.cursor()
+    try:
+        cur.execute("SELECT reconcile_review_rollup();")
+        n = cur.fetchall()[0][0]
+        db.commit()
+    except pg8000.Error:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
+    return n
+
+
+class SummaryRefresher(object):
+    """Bound the staleness of app_summaries for one process.
+
+    Keyword arguments
+    pool -- a dbpool.ConnectionPool used when no connection is given.
+    max_staleness -- seconds after which ensure_fresh() refreshes.
+    interval -- seconds between background refreshes (0 = no thread).
+    on_change -- called with no arguments after a refresh rewrites rows.
+    """
+    def __init__(self, pool, max_staleness=30, interval=15, on_change=None):
+        self.pool = pool
+        self.on_change = on_change
+        self.max_staleness = max_staleness
+        self.interval = interval
+        self.last_refresh = 0
+        self.rows_refreshed = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def refresh(self, db=None, full=False):
+        """Refresh now, using 'db' or else a pooled connection."""
+        with self._lock:
+            return self._refresh(db, full)
+
+    def ensure_fresh(self, db=None):
+        """Refresh if the last refresh is older than max_staleness.
+
+        If another thread is already refreshing, return at once.
+        Database errors are swallowed so that pages still render from
+        the (stale) precomputed rows; the next call tries again.
+        """
+        if time.time() - self.last_refresh < self.max_staleness:
+            return
+        if not self._lock.acquire(False):
+            return
+        try:
+            self._refresh(db, False)
+        except pg8000.Error:
+            pass
+        finally:
+            self._lock.release()
+
+    def _refresh(self, db, full):
+        """Call with the lock held."""
+        if db is not None:
+            n = refresh(db, full=full)
+        else:
+            db = self.pool.getconn()
+            try:
+                n = refresh(db, full=full)
+            finally:
+                self.pool.putconn(db)
+        self.last_refresh = time.time()
+        self.rows_refreshed += max(n, 0)
+        if n > 0 and self.on_change is not None:
+            self.on_change()
+        return n
+
+    def start(self):
+        """Start the background refresh thread, if an interval is set."""
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run,
+                                        name="SummaryRefresher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception:
+                # Never let the scheduler die; the request path
+                # (ensure_fresh) still bounds the staleness.
+                pass
+
+
+if __name__ == "__main__":
+    import argparse
+    from appcurator import pool
+
+    parser = argparse.ArgumentParser(
+            description="Refresh the precomputed app_summaries table.")
+    parser.add_argument("--full", action="store_true",
+            help="recompute every app, not only the queued ones")
+    parser.add_argument("--reconcile", action="store_true",
+            help="first check the review totals against app_review")
+    args = parser.parse_args()
+
+    db = pool.getconn()
+    try:
+        start = time.time()
+        if args.reconcile:
+            print "Corrected the review totals of %d apps." % reconcile(db)
+        n = refresh(db, full=args.full)
+    finally:
+        pool.putconn(db)
+    if n < 0:
+        print "Another refresh is running; try again shortly."
+    else:
+        print "Refreshed %d app summaries in %.2f s." % (n, time.time() - start)